@@ -0,0 +1,405 @@
+import arrow
+import click
+import csv
+import datetime
+import json
+import os
+import platform
+import random
+import rechnung
+import statistics
+import subprocess
+import sys
+import time
+import yaml
+
+from pathlib import Path
+from shutil import copytree, rmtree
+
+from .billed_items import get_billed_items_store
+from .invoice import generate_invoice, save_invoice_yaml
+from .settings import SETTINGS_FILE, get_settings_from_cwd, copy_assets
+
+# File in the data directory describing the synthetic data set
+BENCHMARK_DATASET_FILE = "benchmark.yaml"
+
+# Version of the format of the benchmark results
+BENCHMARK_RESULTS_VERSION = 1
+
+# Products the contracts of a synthetic data set are made of
+BENCHMARK_PRODUCTS = [
+    ("Internet 16", 16.0),
+    ("Internet 50", 25.0),
+    ("Internet 100", 35.0),
+    ("Fixed IP address", 5.0),
+    ("Phone line", 7.5),
+    ("Router rental", 3.0),
+]
+
+BENCHMARK_SETTINGS = {
+    "company_name": "Benchmark Networks",
+    "company_address": ["Benchmark Street 1", "04229 Leipzig"],
+    "company_bank": ["Benchmark Bank", "DE12 3456 7890 0987 6543 21"],
+    "contract_mail_subject": "Your new contract",
+    "insecure": True,
+    "password": None,
+    "sender": None,
+    "server": None,
+    "username": None,
+    "vat": 19,
+}
+
+# Booking texts of the transactions of a synthetic GLS statement
+BENCHMARK_BOOKING_TEXTS = [
+    "Überweisungsgutschr.",
+    "Dauerauftragsgutschr",
+    "Basislastschrift",
+    "Überweisungsauftrag",
+]
+
+
+def get_months(start, months):
+    """
+    Returns a list of (year, month) tuples of the months following start
+    (a "YYYY-MM" string), including start.
+    """
+    first = arrow.get(start)
+    return [
+        (date.year, date.month)
+        for date in (first.shift(months=n) for n in range(months))
+    ]
+
+
+def generate_contract(rng, cid, start):
+    """
+    Returns a random contract starting at start (a "YYYY-MM" string).
+    """
+    items = [
+        {
+            "description": description,
+            "price": price,
+            "quantity": rng.choice([1, 1, 1, 2]),
+        }
+        for description, price in rng.sample(BENCHMARK_PRODUCTS, rng.randint(1, 3))
+    ]
+    return {
+        "address": [f"Customer Street {cid}", "04229 Leipzig"],
+        "cid": cid,
+        "dob": datetime.date(1950 + rng.randrange(50), 1, 1),
+        "email": f"{cid}@customers.tld",
+        "items": items,
+        "name": f"Customer {cid}",
+        "notify": False,
+        "phone": "+491234567890",
+        "start": f"{start}-01",
+    }
+
+
+def generate_gls_statement(csv_path, rows, year, month, contracts=1000, seed=0):
+    """
+    Writes a synthetic GLS bank statement with the given number of rows for
+    the month to csv_path, mostly payments of the invoices of the contracts.
+    """
+    rng = random.Random(seed)
+    csv_path.parent.mkdir(parents=True, exist_ok=True)
+    days = arrow.get(year, month, 1).ceil("month").day
+    with open(csv_path, "w", encoding="iso-8859-1", newline="") as csv_file:
+        writer = csv.writer(csv_file, delimiter=";")
+        writer.writerow(
+            [
+                "Buchungstag",
+                "Valuta",
+                "Textschlüssel",
+                "Auftraggeber/Empfänger",
+                "Konto",
+                "BLZ",
+                "IBAN",
+                "BIC",
+                "Verwendungszweck",
+                "Kundenreferenz",
+                "Währung",
+                "Umsatz",
+            ]
+        )
+        for n in range(rows):
+            cid = 10000 + rng.randrange(contracts)
+            date = f"{rng.randint(1, days):02}.{month:02}.{year}"
+            amount = rng.randint(300, 20000)
+            iban = f"DE{rng.randrange(10 ** 20):020}"
+            writer.writerow(
+                [
+                    date,
+                    date,
+                    "166",
+                    f"Customer {cid}",
+                    "",
+                    "",
+                    iban,
+                    "GENODEM1GLS",
+                    f"{rng.choice(BENCHMARK_BOOKING_TEXTS)}{cid}.{year}.{month:02}\n"
+                    f"IBAN: {iban} BIC: GENODEM1GLS",
+                    f"REF{n}",
+                    "EUR",
+                    f"{amount // 100},{amount % 100:02}",
+                ]
+            )
+
+
+def generate_dataset(
+    path,
+    contracts,
+    months,
+    invoices,
+    start="2019-01",
+    locale="de_DE.utf8",
+    seed=0,
+    statement_rows=0,
+):
+    """
+    Creates a synthetic data directory in path for benchmarking, with the
+    given number of contracts, all of them starting at start. Every contract
+    has months months of billed items, of which the first invoices months are
+    put on (monthly) invoices already.
+
+    The data set only depends on the arguments, so results of benchmarks
+    against data sets created with the same arguments are comparable. The
+    arguments are saved in BENCHMARK_DATASET_FILE in the data directory.
+
+    With statement_rows, a GLS bank statement with that many transactions is
+    written for the month following the billed months.
+
+    Returns the settings of the data directory.
+    """
+    if invoices > months:
+        raise ValueError("There can not be more invoices than months billed.")
+
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    with open(path / SETTINGS_FILE, "w") as settings_file:
+        yaml.dump(dict(BENCHMARK_SETTINGS, locale=locale), settings_file)
+    settings = get_settings_from_cwd(path, create_non_existing_dirs=True)
+    copy_assets(settings.assets_dir)
+
+    rng = random.Random(seed)
+    billed_months = get_months(start, months)
+    with get_billed_items_store(settings) as store:
+        for n in range(contracts):
+            cid = str(10000 + n)
+            contract = generate_contract(rng, cid, start)
+            with open(settings.contracts_dir / f"{cid}.yaml", "w") as contract_file:
+                yaml.dump(contract, contract_file)
+
+            billed_items = []
+            for number, (year, month) in enumerate(billed_months):
+                invoice_id = None
+                if number < invoices:
+                    invoice_data = generate_invoice(settings, contract, year, month)
+                    save_invoice_yaml(settings, invoice_data)
+                    invoice_id = invoice_data["id"]
+                for item in contract["items"]:
+                    billed_items.append(
+                        {
+                            "description": f"{item['description']} {year}-{month:02}",
+                            "invoice": invoice_id,
+                            "key": f"{year}-{month:02}",
+                            "price": item["price"],
+                            "quantity": item["quantity"],
+                            "subtotal": item["price"] * item["quantity"],
+                        }
+                    )
+            store.save_items(cid, billed_items)
+
+    if statement_rows:
+        year, month = get_months(start, months + 1)[-1]
+        generate_gls_statement(
+            settings.csv_dir / "gls" / f"{year}{month:02}.csv",
+            statement_rows,
+            year,
+            month,
+            contracts,
+            seed,
+        )
+
+    dataset = {
+        "contracts": contracts,
+        "months": months,
+        "invoices": invoices,
+        "start": start,
+        "seed": seed,
+        "statement_rows": statement_rows,
+    }
+    with open(path / BENCHMARK_DATASET_FILE, "w") as dataset_file:
+        yaml.dump(dataset, dataset_file)
+    return settings
+
+
+def get_stages(dataset):
+    """
+    Returns the benchmarked cli commands as (name, arguments) tuples, in the
+    order they are run. They work on the month following the billed months.
+    """
+    year, month = get_months(dataset["start"], dataset["months"] + 1)[-1]
+    return [
+        ("print-contracts", ["print-contracts"]),
+        ("print-stats", ["print-stats"]),
+        ("ingest-csv", ["ingest-csv"]),
+        ("print-csv", ["print-csv", str(year), str(month)]),
+        ("bill-items", ["bill-items", str(year), str(month)]),
+        ("create-invoices", ["create-invoices", str(year), str(month)]),
+        ("create-billed-invoices", ["create-billed-invoices", f"{year}.B{month}"]),
+        ("render-all", ["render-all"]),
+    ]
+
+
+def run_stage(path, args):
+    """
+    Runs the rechnung cli with args in a new process, like a user does.
+
+    Returns the wall clock time it took and the completed process.
+    """
+    # the benchmark may run from a checkout, which is not installed
+    env = dict(os.environ)
+    package_parent = str(Path(rechnung.__file__).parent.parent)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [package_parent, env.get("PYTHONPATH")])
+    )
+    started = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-m", "rechnung.cli", *args],
+        cwd=path,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    return time.perf_counter() - started, process
+
+
+def run_benchmark(path, repeat=3, stages=None):
+    """
+    Times the cli stages against the data set in path (created by
+    generate_dataset). Every repetition runs all stages in order against a
+    fresh copy of the data set, so every stage always does the same work.
+
+    Returns the results as a dict, which can be dumped as json.
+    """
+    path = Path(path)
+    with open(path / BENCHMARK_DATASET_FILE) as dataset_file:
+        dataset = yaml.safe_load(dataset_file)
+
+    selected = [
+        (name, args)
+        for name, args in get_stages(dataset)
+        if stages is None or name in stages
+    ]
+    runs = {name: [] for name, args in selected}
+    failures = {}
+
+    for repetition in range(repeat):
+        work_path = path.parent / f".{path.name}.run"
+        if work_path.exists():
+            rmtree(work_path)
+        copytree(path, work_path)
+        try:
+            for name, args in selected:
+                seconds, process = run_stage(work_path, args)
+                print(f"{name}: {seconds:.3f}s")
+                if process.returncode:
+                    failures[name] = process.stderr[-2000:]
+                    print(f"{name} failed with exit code {process.returncode}")
+                runs[name].append(seconds)
+        finally:
+            rmtree(work_path)
+
+    return {
+        "version": BENCHMARK_RESULTS_VERSION,
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "dataset": dataset,
+        "repeat": repeat,
+        "stages": {
+            name: {
+                "runs": times,
+                "min": min(times),
+                "median": statistics.median(times),
+                "failed": name in failures,
+            }
+            for name, times in runs.items()
+        },
+        "failures": failures,
+    }
+
+
+@click.group()
+def benchmark():
+    """
+    Synthetic data sets and benchmarks of the rechnung cli.
+    """
+    pass
+
+
+@benchmark.command()
+@click.argument("path", type=click.Path(file_okay=False))
+@click.option("-n", "--contracts", type=click.IntRange(min=0), default=1000)
+@click.option("-m", "--months", type=click.IntRange(min=0), default=12)
+@click.option("-k", "--invoices", type=click.IntRange(min=0), default=6)
+@click.option("--start", default="2019-01", help="First billed month (YYYY-MM).")
+@click.option("--locale", "locale_name", default="de_DE.utf8")
+@click.option("--seed", type=int, default=0)
+@click.option(
+    "-t",
+    "--statement-rows",
+    type=click.IntRange(min=0),
+    default=0,
+    help="Transactions of the GLS statement of the month after the billed months.",
+)
+def generate(
+    path, contracts, months, invoices, start, locale_name, seed, statement_rows
+):
+    """
+    Create a data directory with N contracts, M months of billed items and
+    K invoices per contract (and a bank statement with T transactions).
+    """
+    if invoices > months:
+        raise click.BadParameter("must not be more than --months", param_hint="-k")
+    if Path(path).exists() and any(Path(path).iterdir()):
+        raise click.BadParameter(f"{path} is not empty", param_hint="PATH")
+    print(f"Generating {contracts} contracts in {path}...")
+    generate_dataset(
+        path, contracts, months, invoices, start, locale_name, seed, statement_rows
+    )
+    print("Finished.")
+
+
+@benchmark.command()
+@click.argument("path", type=click.Path(exists=True, file_okay=False))
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False),
+    default="benchmark.json",
+    help="File the results are written to.",
+)
+@click.option("-r", "--repeat", type=click.IntRange(min=1), default=3)
+@click.option(
+    "-s",
+    "--stage",
+    "stages",
+    multiple=True,
+    help="Only run this stage, can be given multiple times.",
+)
+def run(path, output, repeat, stages):
+    """
+    Time the cli commands against the data set in PATH and write the results
+    as json.
+    """
+    results = run_benchmark(path, repeat, stages or None)
+    with open(output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"Results written to {output}")
+    if results["failures"]:
+        exit(1)
+
+
+if __name__ == "__main__":
+    benchmark()
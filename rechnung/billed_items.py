@@ -0,0 +1,392 @@
+import sqlite3
+import yaml
+
+from abc import ABC, abstractmethod
+from .helpers import read_cache, write_cache
+
+# Fields every billed item has, everything else is kept as extra data
+BILLED_ITEM_FIELDS = ["description", "price", "quantity", "subtotal", "key", "invoice"]
+
+# Directory in settings.cache_dir holding the indexes of the yaml backend
+BILLED_ITEMS_INDEX_DIR = "billed_items"
+BILLED_ITEMS_INDEX_VERSION = 1
+
+
+class UnknownBilledItemsBackendError(Exception):
+    """
+    If settings.billed_items_backend names an unknown storage backend, this
+    exception is thrown.
+    """
+
+    pass
+
+
+class BilledItemsStore(ABC):
+    """
+    Interface of the billed items storage backends.
+
+    Besides loading and saving the whole list of billed items of a customer,
+    stores implement the operations billing and invoicing need, so backends
+    can do them without touching the complete history of a customer.
+
+    Open items are returned as (ref, billed_item) tuples. The ref is only
+    meaningful to the store and is passed back to set_invoice.
+
+    Stores are context managers, which close the store when leaving the context.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        pass
+
+    @abstractmethod
+    def get_items(self, cid):
+        """
+        Returns all billed items of the customer, an empty list if there are none.
+        """
+
+    @abstractmethod
+    def save_items(self, cid, billed_items):
+        """
+        Replaces all billed items of the customer.
+        """
+
+    def is_billed(self, cid, key):
+        """
+        Checks if there are billed items with the key (i.e. the month) already.
+        """
+        return any(item["key"] == key for item in self.get_items(cid))
+
+    def get_keys(self, cid):
+        """
+        Returns the set of keys (i.e. months) billed for the customer already.
+        """
+        return set(item["key"] for item in self.get_items(cid))
+
+    def add_items(self, cid, billed_items):
+        """
+        Appends billed items to the ones of the customer.
+        """
+        self.save_items(cid, self.get_items(cid) + billed_items)
+
+    def get_open_items(self, cid):
+        """
+        Returns the billed items which are not on an invoice yet, as
+        (ref, billed_item) tuples.
+        """
+        return [
+            (position, item)
+            for position, item in enumerate(self.get_items(cid))
+            if not item["invoice"]
+        ]
+
+    def set_invoice(self, cid, refs, invoice_id):
+        """
+        Enters the invoice id into the billed items given by refs.
+        """
+        billed_items = self.get_items(cid)
+        for position in refs:
+            billed_items[position]["invoice"] = invoice_id
+        self.save_items(cid, billed_items)
+
+    @abstractmethod
+    def get_cids(self):
+        """
+        Returns the cids of all customers with billed items.
+        """
+
+    def rebuild_index(self):
+        """
+        Rebuilds the indexes of the store from the stored billed items.
+
+        Returns the number of customers indexed.
+        """
+        return 0
+
+
+class YamlBilledItemsStore(BilledItemsStore):
+    """
+    Stores the billed items of every customer in a yaml file in
+    settings.billed_items_dir.
+
+    For every customer an index with the billed keys and the open items
+    (by position in the yaml file) is kept in settings.cache_dir. It is
+    updated on every write and rebuilt when the yaml file was changed by
+    other means, so checking for double billing and collecting the open
+    items don't need to parse the customers history. New billed items are
+    appended to the yaml file instead of rewriting it.
+    """
+
+    def __init__(self, settings):
+        self.billed_items_dir = settings.billed_items_dir
+        self.index_dir = settings.cache_dir / BILLED_ITEMS_INDEX_DIR
+
+    def get_path(self, cid):
+        return self.billed_items_dir / f"{cid}.yaml"
+
+    def get_index_path(self, cid):
+        return self.index_dir / f"{cid}.index"
+
+    def get_signature(self, cid):
+        """
+        Returns mtime and size of the yaml file, None if there is none.
+        """
+        try:
+            stat = self.get_path(cid).stat()
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def build_index(self, cid, billed_items=None):
+        """
+        (Re)builds and saves the index of the customer from billed_items,
+        or from the yaml file if not given.
+        """
+        if billed_items is None:
+            billed_items = self.get_items(cid)
+        index = {
+            "signature": self.get_signature(cid),
+            "count": len(billed_items),
+            "keys": set(item["key"] for item in billed_items),
+            "open": {
+                position: item
+                for position, item in enumerate(billed_items)
+                if not item["invoice"]
+            },
+        }
+        write_cache(self.get_index_path(cid), BILLED_ITEMS_INDEX_VERSION, index)
+        return index
+
+    def get_index(self, cid):
+        """
+        Returns the index of the customer, rebuilding it if it is out of date.
+        """
+        signature = self.get_signature(cid)
+        if signature is None:
+            return {"signature": None, "count": 0, "keys": set(), "open": {}}
+        index = read_cache(self.get_index_path(cid), BILLED_ITEMS_INDEX_VERSION)
+        if index is None or index["signature"] != signature:
+            index = self.build_index(cid)
+        return index
+
+    def rebuild_index(self):
+        cids = self.get_cids()
+        for cid in cids:
+            self.build_index(cid)
+        return len(cids)
+
+    def get_items(self, cid):
+        billed_items_path = self.get_path(cid)
+        if not billed_items_path.is_file():
+            return []
+        with open(billed_items_path) as infile:
+            return yaml.safe_load(infile) or []
+
+    def save_items(self, cid, billed_items):
+        with open(self.get_path(cid), "w") as outfile:
+            yaml.dump(billed_items, outfile)
+        self.build_index(cid, billed_items)
+
+    def is_billed(self, cid, key):
+        return key in self.get_index(cid)["keys"]
+
+    def get_keys(self, cid):
+        return set(self.get_index(cid)["keys"])
+
+    def is_block_list(self, cid):
+        """
+        Checks if the yaml file holds a list in block style, which items
+        can be appended to.
+        """
+        with open(self.get_path(cid)) as infile:
+            return infile.read(2) == "- "
+
+    def add_items(self, cid, billed_items):
+        index = self.get_index(cid)
+        if not index["count"] or not self.is_block_list(cid):
+            return self.save_items(cid, self.get_items(cid) + billed_items)
+
+        with open(self.get_path(cid), "a") as outfile:
+            yaml.dump(billed_items, outfile)
+
+        for position, item in enumerate(billed_items, start=index["count"]):
+            index["keys"].add(item["key"])
+            if not item["invoice"]:
+                index["open"][position] = item
+        index["count"] += len(billed_items)
+        index["signature"] = self.get_signature(cid)
+        write_cache(self.get_index_path(cid), BILLED_ITEMS_INDEX_VERSION, index)
+
+    def get_open_items(self, cid):
+        return sorted(self.get_index(cid)["open"].items())
+
+    def get_cids(self):
+        return sorted(path.stem for path in self.billed_items_dir.glob("*.yaml"))
+
+
+class SqliteBilledItemsStore(BilledItemsStore):
+    """
+    Stores the billed items of all customers in one SQLite database
+    (settings.billed_items_db_file), indexed by (cid, key) and (cid, invoice).
+    Billing a month and collecting the open items of a customer don't depend
+    on the length of its history.
+    """
+
+    def __init__(self, settings):
+        self.conn = sqlite3.connect(settings.billed_items_db_file)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            # Columns without type keep the values as they are, like yaml does
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS billed_items (
+                    id INTEGER PRIMARY KEY,
+                    cid TEXT NOT NULL,
+                    key TEXT,
+                    invoice TEXT,
+                    description,
+                    price,
+                    quantity,
+                    subtotal,
+                    extra TEXT
+                )""")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS billed_items_cid_key "
+                "ON billed_items (cid, key)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS billed_items_cid_invoice "
+                "ON billed_items (cid, invoice)"
+            )
+
+    def close(self):
+        self.conn.close()
+
+    @staticmethod
+    def to_row(cid, item):
+        extra = {k: v for k, v in item.items() if k not in BILLED_ITEM_FIELDS}
+        return (
+            cid,
+            item.get("key"),
+            item.get("invoice"),
+            item.get("description"),
+            item.get("price"),
+            item.get("quantity"),
+            item.get("subtotal"),
+            yaml.safe_dump(extra) if extra else None,
+        )
+
+    @staticmethod
+    def from_row(row):
+        key, invoice, description, price, quantity, subtotal, extra = row
+        item = {
+            "description": description,
+            "invoice": invoice,
+            "key": key,
+            "price": price,
+            "quantity": quantity,
+            "subtotal": subtotal,
+        }
+        if extra:
+            item.update(yaml.safe_load(extra))
+        return item
+
+    def get_items(self, cid):
+        rows = self.conn.execute(
+            "SELECT key, invoice, description, price, quantity, subtotal, extra "
+            "FROM billed_items WHERE cid = ? ORDER BY id",
+            (cid,),
+        )
+        return [self.from_row(row) for row in rows]
+
+    def save_items(self, cid, billed_items):
+        with self.conn:
+            self.conn.execute("DELETE FROM billed_items WHERE cid = ?", (cid,))
+            self.insert(cid, billed_items)
+
+    def insert(self, cid, billed_items):
+        self.conn.executemany(
+            "INSERT INTO billed_items "
+            "(cid, key, invoice, description, price, quantity, subtotal, extra) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [self.to_row(cid, item) for item in billed_items],
+        )
+
+    def is_billed(self, cid, key):
+        row = self.conn.execute(
+            "SELECT 1 FROM billed_items WHERE cid = ? AND key = ? LIMIT 1", (cid, key)
+        ).fetchone()
+        return row is not None
+
+    def get_keys(self, cid):
+        rows = self.conn.execute(
+            "SELECT DISTINCT key FROM billed_items WHERE cid = ?", (cid,)
+        )
+        return set(row[0] for row in rows)
+
+    def add_items(self, cid, billed_items):
+        with self.conn:
+            self.insert(cid, billed_items)
+
+    def get_open_items(self, cid):
+        rows = self.conn.execute(
+            "SELECT id, key, invoice, description, price, quantity, subtotal, extra "
+            "FROM billed_items WHERE cid = ? AND (invoice IS NULL OR invoice = '') "
+            "ORDER BY id",
+            (cid,),
+        )
+        return [(row[0], self.from_row(row[1:])) for row in rows]
+
+    def set_invoice(self, cid, refs, invoice_id):
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE billed_items SET invoice = ? WHERE cid = ? AND id = ?",
+                [(invoice_id, cid, ref) for ref in refs],
+            )
+
+    def get_cids(self):
+        rows = self.conn.execute("SELECT DISTINCT cid FROM billed_items ORDER BY cid")
+        return [row[0] for row in rows]
+
+
+billed_items_backends = {
+    "yaml": YamlBilledItemsStore,
+    "sqlite": SqliteBilledItemsStore,
+}
+
+
+def get_billed_items_store(settings, backend=None):
+    """
+    Returns the billed items store configured in settings.billed_items_backend
+    (or the given backend).
+    """
+    backend = backend or settings.billed_items_backend
+    try:
+        store_class = billed_items_backends[backend]
+    except KeyError:
+        raise UnknownBilledItemsBackendError(
+            f"Billed items backend {backend} is unknown, use one of "
+            f"{', '.join(billed_items_backends)}."
+        )
+    return store_class(settings)
+
+
+def migrate_billed_items(settings, source="yaml", target="sqlite"):
+    """
+    Copies the billed items of all customers from the source to the target
+    backend. Billed items already in the target are replaced, so the migration
+    can be repeated.
+
+    Returns the number of migrated customers.
+    """
+    with get_billed_items_store(settings, source) as source_store:
+        with get_billed_items_store(settings, target) as target_store:
+            cids = source_store.get_cids()
+            for cid in cids:
+                print(f"Migrating billed items of {cid}")
+                target_store.save_items(cid, source_store.get_items(cid))
+    return len(cids)
@@ -0,0 +1,226 @@
+import sqlite3
+import yaml
+
+from pathlib import Path
+
+# File in settings.cache_dir holding the invoice catalog
+INVOICE_CATALOG_FILE = "invoices.sqlite3"
+INVOICE_CATALOG_VERSION = 2
+
+
+def escape_glob(value):
+    """
+    Escapes the wildcards of a GLOB pattern, so they match themselves.
+    """
+    return "".join(f"[{c}]" if c in "*?[" else c for c in value)
+
+
+class InvoiceCatalog:
+    """
+    Index of the invoice yaml files in settings.invoices_dir, with id, cid,
+    suffix (the part of the id after the cid, i.e. the period), totals, sent
+    flag, payment (date and IBAN of the payer, see reconcile) and if the pdf
+    is present, kept in a SQLite database in
+    settings.cache_dir.
+
+    Selecting invoices queries the catalog, instead of walking all customer
+    directories and parsing every invoice yaml. Invoices written by rechnung
+    are entered when they are saved. Only when customer directories were
+    added or removed (i.e. the mtime of settings.invoices_dir changed), the
+    customer directories whose mtime changed are scanned again (only files
+    with changed mtime or size are parsed). Invoice files changed by hand are
+    entered by rebuild (rebuild-invoice-catalog).
+
+    The catalog is only a cache, it can be rebuilt from the invoice files at
+    any time. Use it as a context manager to close the database when done.
+    """
+
+    def __init__(self, settings):
+        self.invoices_dir = settings.invoices_dir
+        settings.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(settings.cache_dir / INVOICE_CATALOG_FILE)
+        self.conn.row_factory = sqlite3.Row
+        # the catalog can be rebuilt, it doesn't need to survive a crash
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=OFF")
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        with self.conn:
+            if version != INVOICE_CATALOG_VERSION:
+                self.conn.execute("DROP TABLE IF EXISTS invoices")
+                self.conn.execute("DROP TABLE IF EXISTS directories")
+                self.conn.execute(f"PRAGMA user_version = {INVOICE_CATALOG_VERSION}")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS invoices (
+                    path TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    id TEXT,
+                    cid TEXT NOT NULL,
+                    suffix TEXT NOT NULL,
+                    total_net REAL,
+                    total_vat REAL,
+                    total_gross REAL,
+                    sent INTEGER NOT NULL,
+                    paid TEXT,
+                    payer_iban TEXT,
+                    pdf INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    size INTEGER NOT NULL
+                )""")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS invoices_cid_suffix "
+                "ON invoices (cid, suffix)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS invoices_suffix ON invoices (suffix)"
+            )
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS directories (
+                    path TEXT PRIMARY KEY,
+                    mtime_ns INTEGER NOT NULL
+                )""")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def update(self, invoice_path, invoice_data=None):
+        """
+        Enters the invoice yaml file into the catalog, from invoice_data if
+        given (i.e. the data just written to the file) or by reading the file.
+        """
+        if invoice_data is None:
+            with open(invoice_path) as yaml_file:
+                invoice_data = yaml.safe_load(yaml_file) or {}
+        stat = invoice_path.stat()
+        cid = invoice_path.parent.name
+        suffix = invoice_path.stem[len(cid) + 1 :]
+        payment = invoice_data.get("paid") or {}
+        if not isinstance(payment, dict):
+            # marked as paid by hand, e.g. paid: true
+            payment = {"date": payment}
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO invoices (path, name, id, cid, suffix, "
+                "total_net, total_vat, total_gross, sent, paid, payer_iban, pdf, "
+                "mtime_ns, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    str(invoice_path),
+                    invoice_path.name,
+                    invoice_data.get("id"),
+                    cid,
+                    suffix,
+                    invoice_data.get("total_net"),
+                    invoice_data.get("total_vat"),
+                    invoice_data.get("total_gross"),
+                    bool(invoice_data.get("sent")),
+                    str(payment["date"]) if payment else None,
+                    payment.get("iban"),
+                    invoice_path.with_suffix(".pdf").is_file(),
+                    stat.st_mtime_ns,
+                    stat.st_size,
+                ),
+            )
+
+    def set_pdf(self, invoice_path, pdf=True):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE invoices SET pdf = ? WHERE path = ?", (pdf, str(invoice_path))
+            )
+
+    def remove(self, invoice_path):
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM invoices WHERE path = ?", (str(invoice_path),)
+            )
+
+    def scan_directory(self, directory):
+        """
+        Brings the entries of a customer directory up to date, parsing only
+        new and changed invoice files.
+        """
+        known = dict(
+            (path, (mtime_ns, size))
+            for path, mtime_ns, size in self.conn.execute(
+                "SELECT path, mtime_ns, size FROM invoices WHERE cid = ?",
+                (directory.name,),
+            )
+        )
+        for invoice_path in directory.glob("*.yaml"):
+            stat = invoice_path.stat()
+            if known.pop(str(invoice_path), None) != (stat.st_mtime_ns, stat.st_size):
+                self.update(invoice_path)
+        for removed in known:
+            self.remove(removed)
+
+    def refresh(self, force=False):
+        """
+        Scans the customer directories which changed since the last scan, if
+        the invoices_dir changed (or force is given).
+        """
+        directories = dict(self.conn.execute("SELECT path, mtime_ns FROM directories"))
+        top = self.invoices_dir.stat().st_mtime_ns
+        if not force and directories.get(str(self.invoices_dir)) == top:
+            return
+        # taken before the scan, so files added meanwhile are found next time
+        current = {str(self.invoices_dir): top}
+        for directory in self.invoices_dir.iterdir():
+            if directory.is_dir():
+                current[str(directory)] = directory.stat().st_mtime_ns
+                if force or directories.get(str(directory)) != current[str(directory)]:
+                    self.scan_directory(directory)
+        with self.conn:
+            for removed in set(directories) - set(current):
+                self.conn.execute(
+                    "DELETE FROM invoices WHERE cid = ?", (Path(removed).name,)
+                )
+            self.conn.execute("DELETE FROM directories")
+            self.conn.executemany(
+                "INSERT INTO directories (path, mtime_ns) VALUES (?, ?)",
+                current.items(),
+            )
+
+    def rebuild(self):
+        """
+        Rebuilds the catalog from the invoice files.
+
+        Returns the number of invoices in the catalog.
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM invoices")
+            self.conn.execute("DELETE FROM directories")
+        self.refresh(force=True)
+        return self.conn.execute("SELECT COUNT(*) FROM invoices").fetchone()[0]
+
+    def get(self, invoice_path):
+        row = self.conn.execute(
+            "SELECT * FROM invoices WHERE path = ?", (str(invoice_path),)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def select(self, year=None, month=None, cid_only=None, suffix=None):
+        """
+        Returns the catalog entries of the invoices for a specific
+        month-year-combination (or suffix, i.e. the period, like 2019.Q4, or a
+        part of it, like 2019), of all customers or just cid_only, ordered by
+        path. Without year, month and suffix all invoices are returned.
+        """
+        self.refresh()
+        # exact and prefix matches, which are looked up in the suffix indexes
+        if suffix:
+            query = "SELECT * FROM invoices WHERE (suffix = ? OR suffix GLOB ?)"
+            parameters = [suffix, escape_glob(suffix) + ".*"]
+        elif year and month:
+            query = "SELECT * FROM invoices WHERE suffix = ?"
+            parameters = [f"{year}.{month:02}"]
+        else:
+            query = "SELECT * FROM invoices WHERE 1"
+            parameters = []
+        if cid_only:
+            query += " AND cid = ?"
+            parameters.append(str(cid_only))
+
+        rows = self.conn.execute(query + " ORDER BY path", parameters).fetchall()
+        return [dict(row) for row in rows]
@@ -1,14 +1,75 @@
-import arrow
 import click
+import csv
+import datetime
+import json
 import os
+import sys
 import rechnung.invoice as invoice
 import rechnung.contract as contract
+import rechnung.billed_items as billed_items
+import rechnung.stats as stats
 
+from .catalog import InvoiceCatalog
 from .settings import get_settings_from_cwd, copy_assets, create_required_settings_file
-from .transactions import read_csv_files
+from .transactions import TransactionStore, get_month_range, read_transactions
 
 cwd = os.getcwd()
 
+no_cache_option = click.option(
+    "--no-cache",
+    "no_cache",
+    is_flag=True,
+    default=False,
+    help="Parse all contracts, instead of using the contract cache.",
+)
+
+sessions_option = click.option(
+    "-p",
+    "--sessions",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of parallel SMTP sessions (default: smtp_sessions setting).",
+)
+
+# the names of mail.mail_deliveries, mail is only imported by the commands sending
+delivery_option = click.option(
+    "-d",
+    "--delivery",
+    type=click.Choice(["smtp", "maildir", "mbox", "sendmail"]),
+    default=None,
+    help="Send over SMTP, write to the maildir or mbox spool, or pipe to sendmail "
+    "(default: mail_delivery setting).",
+)
+
+rate_option = click.option(
+    "-r",
+    "--rate",
+    "per_minute",
+    type=click.IntRange(min=0),
+    default=None,
+    help="Messages per minute, 0 for no limit (default: smtp_messages_per_minute).",
+)
+
+wait_option = click.option(
+    "-w",
+    "--wait",
+    is_flag=True,
+    help="Wait for the retries of deferred emails, instead of leaving them "
+    "for the next run.",
+)
+
+
+def parse_month_option(ctx, param, value):
+    """
+    Returns the month index of a YYYY-MM option, see contract.parse_month.
+    """
+    if value is None:
+        return None
+    try:
+        return contract.parse_month(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
 
 @click.group()
 def cli1():
@@ -33,22 +94,53 @@ def init():
 
 
 @cli1.command()
-@click.argument("year", type=int)
-@click.argument("month", type=int)
+@click.argument("year", type=int, required=False)
+@click.argument("month", type=int, required=False)
+@click.option(
+    "--from",
+    "first",
+    callback=parse_month_option,
+    help="First month (YYYY-MM) to bill.",
+)
+@click.option(
+    "--to",
+    "last",
+    callback=parse_month_option,
+    help="Last month (YYYY-MM), the current one by default.",
+)
 @click.option("-c", "--cid-only", help="One customer only.")
 @click.option(
     "-d", "--dry", is_flag=True, default=False, help="Don't write the changes."
 )
-def bill_items(year, month, cid_only, dry):
+@no_cache_option
+def bill_items(year, month, first, last, cid_only, dry, no_cache):
     """
     Bill items for all active contracts (or just one with --cid-only).
 
-    The items will be added to a list, and put into an invoice, the 
-    next time create-invoices is run.
+    The items will be added to a list, and put into an invoice, the
+    next time create-invoices is run. With --from (and --to) all missing
+    months of the range are billed at once.
     """
-    print(f"Billing items for month {month} in {year}.")
     settings = get_settings_from_cwd(cwd)
-    invoice.bill_items(settings, year, month, cid_only, dry)
+    if year and (first is not None or last is not None):
+        raise click.UsageError("Give YEAR and MONTH, or --from and --to, not both.")
+    if year and month:
+        print(f"Billing items for month {month} in {year}.")
+        invoice.bill_items(settings, year, month, cid_only, dry, not no_cache)
+        return
+    if year or first is None:
+        raise click.UsageError("Give YEAR and MONTH, or --from and --to.")
+
+    if last is None:
+        now = datetime.date.today()
+        last = contract.month_index(now.year, now.month)
+    if first > last:
+        raise click.BadParameter("must not be after --to", param_hint="--from")
+    print(
+        f"Billing items for months {contract.format_month(first)} "
+        f"to {contract.format_month(last)}."
+    )
+    invoice.bill_months(settings, first, last, cid_only, dry, not no_cache)
 
 
 @cli1.command()
@@ -69,22 +161,73 @@ def create_billed_invoices(suffix, cid_only=None, force=False):
 @click.argument("month", type=int)
 @click.option("-c", "--cid-only")
 @click.option("-f", "--force-recreate", "force", is_flag=True)
-def create_invoices(year, month, cid_only=None, force=False):
+@no_cache_option
+def create_invoices(year, month, cid_only=None, force=False, no_cache=False):
     """
     Mass create invoices.
     """
     print("Creating invoices...")
     settings = get_settings_from_cwd(cwd)
-    invoice.create_invoices(settings, year, month, cid_only, force)
+    invoice.create_invoices(settings, year, month, cid_only, force, not no_cache)
+
+
+@cli1.command()
+@click.option(
+    "--from",
+    "source",
+    type=click.Choice(list(billed_items.billed_items_backends)),
+    default="yaml",
+    help="Backend to read the billed items from.",
+)
+@click.option(
+    "--to",
+    "target",
+    type=click.Choice(list(billed_items.billed_items_backends)),
+    default="sqlite",
+    help="Backend to write the billed items to.",
+)
+def migrate_billed_items(source, target):
+    """
+    Copy all billed items from one storage backend to another.
+
+    Set billed_items_backend in the settings.yaml afterwards, to use the
+    migrated billed items.
+    """
+    settings = get_settings_from_cwd(cwd)
+    migrated = billed_items.migrate_billed_items(settings, source, target)
+    print(f"Migrated billed items of {migrated} customers from {source} to {target}.")
+
+
+@cli1.command()
+def rebuild_billed_items_index():
+    """
+    Rebuild the billed items indexes from the billed items files.
+    """
+    settings = get_settings_from_cwd(cwd)
+    with billed_items.get_billed_items_store(settings) as store:
+        indexed = store.rebuild_index()
+    print(f"Rebuilt billed items index of {indexed} customers.")
 
 
 @cli1.command()
-def print_contracts():
+def rebuild_invoice_catalog():
+    """
+    Rebuild the invoice catalog from the invoice files.
+    """
+    settings = get_settings_from_cwd(cwd)
+    with InvoiceCatalog(settings) as catalog:
+        indexed = catalog.rebuild()
+    print(f"Rebuilt invoice catalog with {indexed} invoices.")
+
+
+@cli1.command()
+@no_cache_option
+def print_contracts(no_cache):
     """
     Print an overview of all contracs
     """
     settings = get_settings_from_cwd(cwd)
-    for cid, data in contract.get_contracts(settings).items():
+    for cid, data in contract.get_contracts(settings, use_cache=not no_cache).items():
         company_name = data.get("company", "")
         name = data.get("name", "unknown")
         if company_name:
@@ -97,50 +240,170 @@ def print_contracts():
         print(f"{cid}: {company_name} {data['start']} {total_monthly}€")
 
 
+@cli1.command()
+@click.argument("year", type=int, required=False)
+@click.argument("month", type=int, required=False)
+@click.option(
+    "--from", "start", type=click.DateTime(["%Y-%m-%d"]), help="First day (YYYY-MM-DD)."
+)
+@click.option("--to", "end", type=click.DateTime(["%Y-%m-%d"]), help="Last day.")
+@click.option("-b", "--bank", "banks", multiple=True, help="Only this bank.")
+def print_csv(year, month, start, end, banks):
+    """
+    Print the transactions of a year/month combo (or of a date range)
+
+    The transactions are selected by their booking date, from all CSV files
+    read by ingest-csv.
+    """
+    settings = get_settings_from_cwd(cwd)
+    if year and month:
+        print(f"Parsing CSV files for {year}{month}")
+        start, end = get_month_range(year, month)
+    elif year or not (start or end):
+        raise click.UsageError("Give YEAR and MONTH, or --from and/or --to.")
+    else:
+        start = start and start.date()
+        end = end and end.date()
+        print(f"Transactions from {start or 'the start'} to {end or 'the end'}")
+    for transaction in read_transactions(settings, start, end, banks):
+        print("{date}: {type[0]} {amount:>6}€ {sender}".format(**transaction))
+
+
+@cli1.command()
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of worker processes to parse with.",
+)
+@click.option("--rebuild", is_flag=True, help="Parse all CSV files again.")
+def ingest_csv(jobs, rebuild):
+    """
+    Parse new and changed CSV files of all banks into the transaction store
+    """
+    settings = get_settings_from_cwd(cwd)
+    with TransactionStore(settings) as store:
+        new = store.rebuild(jobs) if rebuild else store.sync(jobs)
+    print(f"Ingested {new} new transactions.")
+
+
 @cli1.command()
 @click.argument("year", type=int)
 @click.argument("month", type=int)
-def print_csv(year, month):
+@click.option("--dry", is_flag=True, help="Only report, don't mark invoices as paid.")
+def reconcile(year, month, dry):
     """
-    Parse CSV files for a specific year/month combo
+    Match the payments of a year/month combo against the open invoices
+
+    The payments are selected by their booking date, from all CSV files read
+    by ingest-csv.
     """
+    from .reconcile import reconcile
+
     settings = get_settings_from_cwd(cwd)
-    print(f"Parsing CSV files for {year}{month}")
-    for transaction in read_csv_files(settings, year, month):
-        print("{date}: {type[0]} {amount:>6}€ {sender}".format(**transaction))
+    print(f"Reconciling payments of {year}.{month:02}")
+    reconcile(settings, year, month, dry)
 
 
 @cli1.command()
-def print_stats():
+@no_cache_option
+@click.option(
+    "--from",
+    "first",
+    callback=parse_month_option,
+    help="First month (YYYY-MM) of a time series.",
+)
+@click.option(
+    "--to",
+    "last",
+    callback=parse_month_option,
+    help="Last month (YYYY-MM), the current one by default.",
+)
+@click.option(
+    "-f",
+    "--format",
+    "output_format",
+    type=click.Choice(["text", "csv", "json"]),
+    default="text",
+    help="Format of the time series.",
+)
+def print_stats(no_cache, first, last, output_format):
     """
-    Print stats about the contracts
+    Print stats about the contracts (or a monthly time series of them)
     """
     settings = get_settings_from_cwd(cwd)
-    contracts = contract.get_contracts(settings).items()
-    now = arrow.now()
-    contracts_totals = list()
-    for cid, data in contracts:
-        # fetch dates, if no end date is set or know, it will be set to 1 year in the future
-        start_date = arrow.get(data["start"])
-        end_date = arrow.get(data.get("end", now + arrow.arrow.relativedelta(years=1)))
-        if start_date > now or now > end_date:
-            continue
-        contracts_totals.append(
-            sum(map(lambda i: i.get("quantity", i) * i["price"], data["items"]))
-        )
-    print(f"{len(contracts_totals)} active contracts of {len(contracts)} in total")
-    print(f"{sum(contracts_totals):.2f}€ per month")
+    contracts = contract.get_contracts(settings, use_cache=not no_cache)
+    now = datetime.date.today()
+    current = contract.month_index(now.year, now.month)
+    if first is None and last is None:
+        month = stats.get_revenue_series(
+            contracts.values(), settings.vat, current, current
+        )[0]
+        print(f"{month['active']} active contracts of {len(contracts)} in total")
+        print(f"{month['mrr']:.2f}€ per month")
+        return
+
+    last = current if last is None else last
+    first = last if first is None else first
+    if first > last:
+        raise click.BadParameter("must not be after --to", param_hint="--from")
+    series = stats.get_revenue_series(contracts.values(), settings.vat, first, last)
+    if output_format == "json":
+        print(json.dumps(series, indent=2))
+    elif output_format == "csv":
+        writer = csv.DictWriter(sys.stdout, stats.REVENUE_SERIES_FIELDS)
+        writer.writeheader()
+        writer.writerows(series)
+    else:
+        print("Month    Active   New Churned  Churn        MRR")
+        for month in series:
+            print(
+                "{month}  {active:>6} {new:>5} {churned:>7} {churn_rate:>6.1%} "
+                "{mrr:>9.2f}€".format(**month)
+            )
 
 
 @cli1.command()
-def render_all():
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of worker processes to render with.",
+)
+def render_all(jobs):
     """
     Render all unrendered invoices and contracs
     """
     print("Rendering invoices and contracts...")
     settings = get_settings_from_cwd(cwd)
-    invoice.render_invoices(settings)
-    contract.render_contracts(settings)
+    failed = invoice.render_invoices(settings, jobs)
+    failed += contract.render_contracts(settings, jobs)
+    if failed:
+        print(f"Failed to render {len(failed)} documents.")
+        exit(1)
+
+
+@cli1.command()
+@click.argument("period")
+@click.option(
+    "-c", "--cid", "cids", multiple=True, help="Only print the invoices of the cid."
+)
+@click.option(
+    "--postal",
+    is_flag=True,
+    default=False,
+    help="Only print the invoices of contracts with postal: true.",
+)
+@click.option("-o", "--output", type=click.Path(dir_okay=False), default=None)
+def render_print_run(period, cids, postal, output):
+    """
+    Render the invoices of a period (YEAR.MONTH or suffix) into one pdf for printing.
+    """
+    settings = get_settings_from_cwd(cwd)
+    if not invoice.render_print_run(settings, None, None, period, cids, postal, output):
+        exit(1)
 
 
 @cli1.command()
@@ -148,37 +411,145 @@ def render_all():
 @click.argument("month", type=int)
 @click.option("-c", "--cid_only")
 @click.option("-f", "--force-resend", "force", is_flag=True)
-def send_invoices(year, month, cid_only=None, force=False):
+@sessions_option
+@rate_option
+@delivery_option
+@wait_option
+def send_invoices(
+    year,
+    month,
+    cid_only=None,
+    force=False,
+    sessions=None,
+    per_minute=None,
+    delivery=None,
+    wait=False,
+):
     """
     Send invoices by email.
     """
     print(f"Sending invoices for {year}.{month:02}")
     settings = get_settings_from_cwd(cwd)
-    invoice.send_invoices(settings, year, month, cid_only, force)
+    failed = invoice.send_invoices(
+        settings,
+        year,
+        month,
+        cid_only,
+        force,
+        None,
+        sessions,
+        per_minute,
+        delivery,
+        wait,
+    )
+    if failed:
+        exit(1)
+
 
 @cli1.command()
 @click.argument("suffix")
 @click.option("-c", "--cid_only")
 @click.option("-f", "--force-resend", "force", is_flag=True)
-def send_invoices_suffix(suffix, cid_only=None, force=False):
+@sessions_option
+@rate_option
+@delivery_option
+@wait_option
+def send_invoices_suffix(
+    suffix,
+    cid_only=None,
+    force=False,
+    sessions=None,
+    per_minute=None,
+    delivery=None,
+    wait=False,
+):
     """
     Send invoices by email (selected by suffix instead of year and month).
+
+    The suffix is the period of the invoices, like 2019.Q4, or its start, like 2019.
     """
     print(f"Sending invoices for {suffix}")
     settings = get_settings_from_cwd(cwd)
-    invoice.send_invoices(settings, None, None, cid_only, force, suffix)
+    failed = invoice.send_invoices(
+        settings,
+        None,
+        None,
+        cid_only,
+        force,
+        suffix,
+        sessions,
+        per_minute,
+        delivery,
+        wait,
+    )
+    if failed:
+        exit(1)
+
+
+@cli1.command()
+def print_outbox():
+    """
+    Print the state of the invoice mails in the outbox
+    """
+    from .outbox import Outbox
 
+    settings = get_settings_from_cwd(cwd)
+    with Outbox(settings) as outbox:
+        for state, count in outbox.get_states().items():
+            print(f"{state}: {count}")
+        for mail in outbox.get_failed():
+            print(
+                f"  {mail['invoice']}: {mail['state']} after {mail['attempts']} "
+                f"attempts, {mail['error']}"
+            )
 
 
 @cli1.command()
 @click.argument("cid", type=int)
-def send_contract(cid):
+@delivery_option
+def send_contract(cid, delivery=None):
     """
     Send contract by email.
     """
-    print(f"Sending contract {cid}")
     settings = get_settings_from_cwd(cwd)
-    contract.send_contract(settings, cid)
+    contract.send_contract(settings, cid, delivery)
+
+
+@cli1.command()
+@click.argument("cids", nargs=-1, required=True)
+@delivery_option
+def send_contracts(cids, delivery=None):
+    """
+    Send several contracts by email.
+    """
+    print(f"Sending {len(cids)} contracts")
+    settings = get_settings_from_cwd(cwd)
+    sent = contract.send_contracts(settings, cids, delivery)
+    print(f"Sent {sent} of {len(cids)} contracts.")
+
+
+@cli1.command()
+@click.option(
+    "-s",
+    "--spool",
+    type=click.Choice(["maildir", "mbox"]),
+    default="maildir",
+    help="Spool to hand off.",
+)
+@click.option(
+    "--command", default=None, help="Command to pipe into (default: sendmail_command)."
+)
+def hand_off_spool(spool, command):
+    """
+    Pipe all spooled emails into sendmail, to be delivered by the local MTA.
+
+    Spooled invoices are marked as sent, once sendmail accepted their emails.
+    """
+    settings = get_settings_from_cwd(cwd)
+    handed_off, failed = invoice.hand_off_spool(settings, spool, command)
+    print(f"Handed off {handed_off} emails, {failed} failed.")
+    if failed:
+        exit(1)
 
 
 cli = click.CommandCollection(sources=[cli1])
@@ -1,133 +1,466 @@
 import arrow
+import bisect
 import datetime
 import locale
+import re
 import yaml
-from collections import OrderedDict
 
 from pathlib import Path
-from .helpers import generate_pdf, get_template, generate_email, send_email
+from .helpers import (
+    AttachmentCache,
+    generate_pdf,
+    get_template,
+    generate_email,
+    run_jobs,
+    RenderContext,
+    read_cache,
+    write_cache,
+)
+from .manifest import RenderManifest
 
+# File in settings.cache_dir holding the parsed contracts
+CONTRACTS_CACHE_FILE = "contracts.pickle"
+CONTRACTS_CACHE_VERSION = 2
 
-def get_contracts(settings, year=None, month=None, cid_only=None, inactive=False):
+# Months given as YYYY-MM, e.g. on the command line
+MONTH = re.compile(r"(\d{4})-(\d{1,2})")
+
+
+def to_date(value):
+    """
+    Returns the date of a contract start or end, which yaml gives as date
+    (or datetime), or as string if it is no valid date.
+    """
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.date.fromisoformat(str(value)[:10])
+
+
+def month_index(year, month):
+    """
+    Returns the number of the month, counted from year 0, so months can be
+    used as indices and subtracted.
+    """
+    return year * 12 + month - 1
+
+
+def format_month(index):
+    return f"{index // 12}-{index % 12 + 1:02}"
+
+
+def parse_month(value):
+    """
+    Returns the index of a YYYY-MM month, raises ValueError if value is no
+    such month.
+    """
+    match = MONTH.fullmatch(value)
+    if not match or not 1 <= int(match.group(2)) <= 12:
+        raise ValueError(f"{value} is no month (YYYY-MM).")
+    return month_index(int(match.group(1)), int(match.group(2)))
+
+
+def get_active_months(contract):
+    """
+    Returns the index of the first and of the last month the contract is
+    active in (None if it doesn't end): a contract is active in a month, if
+    it started on its first day at the latest and did not end before.
+    """
+    start = to_date(contract["start"])
+    first = month_index(start.year, start.month) + (start.day > 1)
+    last = None
+    if contract.get("end"):
+        end = to_date(contract["end"])
+        last = month_index(end.year, end.month)
+    return first, last
+
+
+class ContractIndex:
+    """
+    Interval index over the months the contracts are active in.
+
+    The months in which any contract starts or stops being active split the
+    time into segments with the same active contracts. The segments are
+    computed once, so the active contracts of any month are looked up by
+    bisecting the segment boundaries, without looking at the contracts.
+    """
+
+    def __init__(self, months):
+        """
+        Args:
+            months: dict of cids and their first and last active month, see
+                get_active_months.
+        """
+        changes = {}
+        for cid, (first, last) in months.items():
+            if last is not None and last < first:
+                continue
+            changes.setdefault(first, ([], []))[0].append(cid)
+            if last is not None:
+                changes.setdefault(last + 1, ([], []))[1].append(cid)
+
+        self.boundaries = sorted(changes)
+        self.segments = []
+        active = set()
+        for boundary in self.boundaries:
+            started, stopped = changes[boundary]
+            active.update(started)
+            active.difference_update(stopped)
+            self.segments.append(tuple(sorted(active)))
+
+    def get_active_cids(self, year, month):
+        """
+        Returns the cids of the contracts active in the month, ordered by cid.
+        """
+        segment = bisect.bisect_right(self.boundaries, month_index(year, month))
+        return self.segments[segment - 1] if segment else ()
+
+
+def read_contracts(settings, cid_only=None, use_cache=True):
+    """
+    Returns a dict of all (or just the cid_only) contract yaml paths and the
+    parsed contracts, and the ContractIndex of these contracts.
+
+    Parsed contracts are kept in a single cache file in settings.cache_dir,
+    keyed by path, mtime and size of the yaml files, together with their
+    active months and the index of all contracts. Only new or changed
+    contracts are parsed again, the others are loaded from the cache.
+    """
+    paths = sorted(settings.contracts_dir.glob("*.yaml"))
+    if cid_only:
+        paths = [path for path in paths if path.stem == cid_only]
+
+    if not use_cache:
+        contracts = {}
+        for path in paths:
+            with open(path, "r") as contract_file:
+                contracts[path] = yaml.safe_load(contract_file)
+        index = ContractIndex(
+            {
+                contract["cid"]: get_active_months(contract)
+                for contract in contracts.values()
+            }
+        )
+        return contracts, index
+
+    cache_path = settings.cache_dir / CONTRACTS_CACHE_FILE
+    cache = read_cache(cache_path, CONTRACTS_CACHE_VERSION)
+    if cache is None:
+        cache = {"contracts": {}, "index": None}
+    entries = cache["contracts"]
+    changed = False
+
+    contracts = {}
+    months = {}
+    for path in paths:
+        stat = path.stat()
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = entries.get(str(path))
+        if cached is None or cached[0] != signature:
+            with open(path, "r") as contract_file:
+                contract = yaml.safe_load(contract_file)
+            cached = (signature, contract, get_active_months(contract))
+            entries[str(path)] = cached
+            changed = True
+        contracts[path] = cached[1]
+        months[cached[1]["cid"]] = cached[2]
+
+    if cid_only:
+        # the index of all contracts is only known if all contracts were listed
+        index = ContractIndex(months)
+        if changed:
+            cache["index"] = None
+    else:
+        # forget removed contracts
+        for removed in set(entries) - set(map(str, paths)):
+            del entries[removed]
+            changed = True
+        if changed or cache["index"] is None:
+            cache["index"] = ContractIndex(months)
+            changed = True
+        index = cache["index"]
+
+    if changed:
+        write_cache(cache_path, CONTRACTS_CACHE_VERSION, cache)
+    return contracts, index
+
+
+def is_active(contract, year=None, month=None):
+    """
+    Checks if the contract is active in the given month, i.e. started before
+    and did not end before. Without year and month every contract is active.
+    """
+    if not (year and month):
+        return True
+    first, last = get_active_months(contract)
+    requested = month_index(year, month)
+    return first <= requested and (last is None or requested <= last)
+
+
+def get_contract_index(settings, cid_only=None, use_cache=True):
+    """
+    Returns a dict of all (or just the cid_only) contracts by cid, ordered
+    by cid, and the ContractIndex of their active months. Commands working
+    on several months look up the active contracts of every month in the
+    index, instead of filtering all contracts again.
+    """
+    contracts, index = read_contracts(settings, cid_only, use_cache)
+    contracts = {contract["cid"]: contract for contract in contracts.values()}
+    return {cid: contracts[cid] for cid in sorted(contracts)}, index
+
+
+def get_contracts(
+    settings, year=None, month=None, cid_only=None, inactive=False, use_cache=True
+):
     """
     Fetches all contracts from the settings.contracts_dir directory.
-    Returns a dict with all active contracts, i.e. contracts with started
-    in the past.
+    Returns a dict with all contracts, or with the contracts active in the
+    given month, ordered by cid.
+
+    The contracts are read through the contract cache, unless use_cache is False.
     """
-    contracts = OrderedDict()
-    for filename in settings.contracts_dir.glob("*.yaml"):
-        if cid_only and cid_only != filename.stem:
-            continue
+    contracts, index = get_contract_index(settings, cid_only, use_cache)
+    if not (year and month):
+        return contracts
+    return {cid: contracts[cid] for cid in index.get_active_cids(year, month)}
+
 
-        with open(Path(settings.contracts_dir / filename), "r") as contract_file:
+def iterate_contracts(settings, year=None, month=None, cid_only=None):
+    """
+    Generator which yields the cid and the contract of all active contracts
+    (or just cid_only) ordered by cid, like get_contracts, but parses every
+    contract file only when it is its turn. Only one contract is held in
+    memory at a time, besides the list of contract file paths.
+    """
+    paths = sorted(settings.contracts_dir.glob("*.yaml"))
+    for path in paths:
+        if cid_only and cid_only != path.stem:
+            continue
+        with open(path, "r") as contract_file:
             contract = yaml.safe_load(contract_file)
+        if is_active(contract, year, month):
+            yield contract["cid"], contract
 
-        if year and month:
-            requested_date = arrow.get(f"{year}-{month:02}")
-            if "end" in contract.keys():
-                if arrow.get(contract["end"]) < requested_date:
-                    print(f"Ignoring {contract['cid']} with end {contract['end']}")
-                    continue
-            if arrow.get(contract["start"]) > requested_date:
-                print(f"Ignoring {contract['cid']} with start {contract['start']}")
-                continue
-            contracts[contract["cid"]] = contract
-        else:
-            contracts[contract["cid"]] = contract
 
-    return {k: contracts[k] for k in sorted(contracts)}
+# Per process state of the render workers, see _init_render_worker
+_render_worker = {}
 
 
-def render_contracts(settings):
+def _init_render_worker(settings):
     """
-    Renders all contracts as pdfs to settings.contracts_dir
+    Prepares the current process for rendering contracts. Worker processes
+    do not necessarily inherit the locale, and the template is only loaded
+    once per process, as is the render context holding fonts and stylesheets.
     """
-    template = get_template(settings.contract_template_file)
-    logo_path = settings.assets_dir / "logo.png"
+    locale.setlocale(locale.LC_ALL, settings.locale)
+    _render_worker["template"] = get_template(settings, settings.contract_template_file)
+    _render_worker["context"] = RenderContext(settings.assets_dir)
 
-    for contract_filename in Path(settings.contracts_dir).glob("*.yaml"):
-        contract_pdf_filename = "{}.pdf".format(str(contract_filename).split(".")[0])
-        if not Path(contract_pdf_filename).is_file():
 
-            with open(contract_filename) as yaml_file:
-                contract_data = yaml.safe_load(yaml_file)
-            print("Rendering contract pdf for {}".format(contract_data["cid"]))
-            contract_data.update(settings._asdict())
+def _render_contract_job(settings, contract_yaml_path, contract_pdf_path):
+    """
+    Renders one contract in a render worker. Returns the result of render_contract
+    and the number of stylesheet parses it took.
+    """
+    context = _render_worker["context"]
+    parses = context.stylesheet_parses
+    result = render_contract(
+        settings,
+        _render_worker["template"],
+        contract_yaml_path,
+        contract_pdf_path,
+        context,
+    )
+    return result, context.stylesheet_parses - parses
 
-            contract_data["price_total"] = locale.format_string(
-                "%.2f", sum([item["price"] for item in contract_data["items"]])
-            )
-            contract_data["initial_total"] = locale.format_string(
-                "%.2f", sum([item["initial"] for item in contract_data["items"]])
-            )
 
-            if "start" in contract_data.keys():
-                contract_data["start"] = arrow.get(contract_data["start"]).format(
-                    "DD.MM.YYYY", locale=settings.arrow_locale
-                )
+def render_contract(
+    settings, template, contract_yaml_path, contract_pdf_path, render_context=None
+):
+    """
+    Renders a single contract yaml file to contract_pdf_path, using the
+    (optional) shared RenderContext.
+
+    Returns the cid of the rendered contract.
+    """
+    with open(contract_yaml_path) as yaml_file:
+        contract_data = yaml.safe_load(yaml_file)
+    contract_data.update(settings._asdict())
+
+    contract_data["price_total"] = locale.format_string(
+        "%.2f", sum([item["price"] for item in contract_data["items"]])
+    )
+    contract_data["initial_total"] = locale.format_string(
+        "%.2f", sum([item["initial"] for item in contract_data["items"]])
+    )
+
+    if "start" in contract_data.keys():
+        contract_data["start"] = arrow.get(contract_data["start"]).format(
+            "DD.MM.YYYY", locale=settings.arrow_locale
+        )
 
-            contract_html = template.render(**contract_data)
+    contract_html = template.render(**contract_data)
 
-            generate_pdf(
-                contract_html, settings.contract_css_asset_file, contract_pdf_filename
+    generate_pdf(
+        contract_html,
+        settings.contract_css_asset_file,
+        contract_pdf_path,
+        render_context,
+    )
+    return contract_data["cid"]
+
+
+def get_contract_render_inputs(settings, contract_yaml_path):
+    """
+    Returns the files the pdf of the contract is rendered from.
+    """
+    return [
+        contract_yaml_path,
+        settings.contract_template_file,
+        settings.contract_css_asset_file,
+        settings.logo_asset_file,
+    ]
+
+
+def render_contracts(settings, jobs=1):
+    """
+    Renders all contracts as pdfs to settings.contracts_dir
+
+    Only contracts without pdf, or with inputs changed since the pdf was
+    rendered, are rendered, see RenderManifest.
+
+    With jobs > 1 the contracts are rendered by that many worker processes.
+    Output is printed in the order of the contract files in any case. Every
+    process reuses one RenderContext for all of its documents.
+
+    Returns a list of the contract yaml files which failed to render.
+    """
+    with RenderManifest(settings) as manifest:
+        tasks = []
+        for contract_filename in sorted(Path(settings.contracts_dir).glob("*.yaml")):
+            contract_pdf_filename = Path(
+                "{}.pdf".format(str(contract_filename).split(".")[0])
             )
+            inputs = get_contract_render_inputs(settings, contract_filename)
+            if manifest.is_stale(contract_pdf_filename, inputs):
+                if contract_pdf_filename.is_file():
+                    print(f"Contract {contract_pdf_filename} is outdated")
+                tasks.append((settings, contract_filename, contract_pdf_filename))
+
+        failed = []
+        parses = 0
+        for task, result, error in run_jobs(
+            _render_contract_job, tasks, jobs, _init_render_worker, (settings,)
+        ):
+            if error:
+                print(f"Error rendering contract {task[1]}: {error}")
+                failed.append(task[1])
+            else:
+                cid, job_parses = result
+                parses += job_parses
+                manifest.record(task[2], get_contract_render_inputs(settings, task[1]))
+                print(f"Rendered contract pdf for {cid}")
+
+    rendered = len(tasks) - len(failed)
+    if rendered:
+        print(
+            f"Rendered {rendered} contracts with {parses} stylesheet parses "
+            f"({rendered - parses} avoided by the shared render context)"
+        )
+    return failed
 
 
-def send_contract(settings, cid):
+def generate_contract_email(settings, mail_template, cid, attachment_cache=None):
     """
-    Sends the contract specified with the cid via email to the customer.
+    Returns the email with the contract of cid, the product descriptions of
+    its items and the policy attached, None if the contract pdf or the email
+    address is missing.
 
-    If set, the policy and the product description of the main product 
-    will be attached.
+    The product descriptions and the policy are shared by many contracts, with
+    an AttachmentCache they are only read and encoded once.
     """
-    mail_template = get_template(settings.contract_mail_template_file)
     contract_pdf_path = Path(settings.contracts_dir) / f"{cid}.pdf"
     contract_yaml_filename = Path(settings.contracts_dir) / f"{cid}.yaml"
 
     if not contract_pdf_path.is_file():
         print(f"Contract {cid} not found")
+        return None
 
     with open(contract_yaml_filename) as yaml_file:
         contract_data = yaml.safe_load(yaml_file)
 
-        if contract_data["email"] is None:
-            print("No email given for contract {cid}")
-            quit()
+    if contract_data["email"] is None:
+        print(f"No email given for contract {cid}")
+        return None
 
-        contract_pdf_filename = f"{settings.company_name} {contract_yaml_filename.stem}.pdf"
-        contract_mail_text = mail_template.render()
+    contract_pdf_filename = f"{settings.company_name} {contract_yaml_filename.stem}.pdf"
+    contract_mail_text = mail_template.render()
 
-        attachments = [(contract_pdf_path, contract_pdf_filename)]
+    attachments = [(contract_pdf_path, contract_pdf_filename)]
+    shared_attachments = []
 
-        for item in contract_data["items"]:
-            item_pdf_file = f"{item['description']}.pdf"
-            item_pdf_path = Path(settings.assets_dir / item_pdf_file)
-            if item_pdf_path.is_file():
-                attachments.append((item_pdf_path, item_pdf_file))
-            else:
-                print(f"Item file {item_pdf_file} not found")
+    for item in contract_data["items"]:
+        item_pdf_file = f"{item['description']}.pdf"
+        item_pdf_path = Path(settings.assets_dir / item_pdf_file)
+        if item_pdf_path.is_file():
+            shared_attachments.append((item_pdf_path, item_pdf_file))
+        else:
+            print(f"Item file {item_pdf_file} not found")
 
-        if settings.policy_attachment_asset_file:
-            policy_pdf_path = settings.policy_attachment_asset_file
-            if policy_pdf_path.is_file():
-                attachments.append((policy_pdf_path, policy_pdf_path.name))
-            else:
-                print(f"Missing {settings.policy_attachment_asset_file.name}")
-
-        contract_email = generate_email(
-            settings,
-            contract_data["email"],
-            settings.contract_mail_subject,
-            contract_mail_text,
-            attachments,
-        )
+    if settings.policy_attachment_asset_file:
+        policy_pdf_path = settings.policy_attachment_asset_file
+        if policy_pdf_path.is_file():
+            shared_attachments.append((policy_pdf_path, policy_pdf_path.name))
+        else:
+            print(f"Missing {settings.policy_attachment_asset_file.name}")
 
-        print("Sending contract {}".format(contract_data["cid"]))
+    return generate_email(
+        settings,
+        contract_data["email"],
+        settings.contract_mail_subject,
+        contract_mail_text,
+        attachments,
+        shared_attachments,
+        attachment_cache,
+    )
 
-        send_email(
-            contract_email,
-            settings.server,
-            settings.username,
-            settings.password,
-            settings.insecure,
-        )
+
+def send_contract(settings, cid, delivery=None):
+    """
+    Sends the contract specified with the cid via email to the customer.
+
+    If set, the policy and the product description of the main product
+    will be attached.
+
+    The email is delivered as configured in settings.mail_delivery, unless
+    another delivery is given.
+    """
+    send_contracts(settings, [cid], delivery)
+
+
+def send_contracts(settings, cids, delivery=None):
+    """
+    Sends the contracts specified with the cids via email to the customers,
+    over one session (or spool) and with one AttachmentCache for all of them,
+    so the shared attachments are encoded once per run.
+
+    Returns the number of contracts sent.
+    """
+    from .mail import get_sender
+
+    mail_template = get_template(settings, settings.contract_mail_template_file)
+    attachment_cache = AttachmentCache()
+    sent = 0
+
+    with get_sender(settings, delivery) as sender:
+        for cid in cids:
+            contract_email = generate_contract_email(
+                settings, mail_template, cid, attachment_cache
+            )
+            if contract_email is None:
+                continue
+            print(f"Sending contract {cid}")
+            if sender.send(contract_email):
+                sent += 1
+    return sent
@@ -1,53 +1,127 @@
-import smtplib
-import ssl
+import os
+import pickle  # nosec
 import yaml
 
-from email.header import Header
-from email.message import EmailMessage
-from email.utils import formatdate
-import mimetypes
-from jinja2 import Template
-from weasyprint import HTML, CSS
-from weasyprint.text.fonts import FontConfiguration
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from .settings import od
 
+# WeasyPrint, Jinja2 and the email and SMTP modules are imported by the
+# functions using them, so commands which only read contracts, billed items
+# or transactions don't pay for loading them (WeasyPrint loads Pango).
 
-def get_template(template_filename):
+
+# Directory in settings.cache_dir holding the compiled templates
+TEMPLATE_CACHE_DIR = "templates"
+
+# Jinja2 environments of this process, by search path and cache directory
+_environments = {}
+
+
+def get_environment(settings, search_path=None):
+    """
+    Returns the Jinja2 Environment loading templates from search_path (the
+    assets_dir, and the templates shipped with rechnung as a fallback, by
+    default), so templates can include and extend each other.
+
+    The environment is created once per process. The compiled templates are
+    kept in settings.cache_dir, so they are reused by later runs and worker
+    processes, and compiled again when their source changes.
+    """
+    from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+    if search_path is None:
+        search_path = [settings.assets_dir, od]
+    search_path = tuple(str(path) for path in search_path)
+    key = (search_path, str(settings.cache_dir))
+    if key not in _environments:
+        bytecode_dir = settings.cache_dir / TEMPLATE_CACHE_DIR
+        bytecode_dir.mkdir(parents=True, exist_ok=True)
+        _environments[key] = Environment(
+            loader=FileSystemLoader(search_path),
+            bytecode_cache=FileSystemBytecodeCache(str(bytecode_dir)),
+        )
+    return _environments[key]
+
+
+def get_template(settings, template_filename):
     """
-    Takes the path to the jinja2 template and returns a jinja2 Template instance
-    with the contents of the file.
+    Takes the path to the jinja2 template and returns the jinja2 Template
+    instance from the shared Environment, see get_environment.
 
     Args:
-        template_filename (str): full path to the template file (jinja2)
+        settings
+        template_filename (str): full path to the template file (jinja2),
+                                 usually in assets_dir
 
     Returns:
         Template: jinja2 Template instance.
     """
+    environment, name = get_template_environment(settings, template_filename)
+    return environment.get_template(name)
+
+
+def get_template_environment(settings, template_filename):
+    """
+    Returns the Environment the template is loaded from and its name in there.
+    """
+    template_path = Path(template_filename)
+    try:
+        name = template_path.relative_to(settings.assets_dir)
+        environment = get_environment(settings)
+    except ValueError:
+        # templates outside of the assets get an environment of their own
+        name = template_path.name
+        environment = get_environment(settings, [template_path.parent])
+    return environment, name.as_posix()
 
-    with open(template_filename) as template_file:
-        return Template(template_file.read())
+
+def get_template_variables(settings, template_filename):
+    """
+    Returns the names of the variables the template (and the templates it
+    extends, includes or imports) reads from the context it is rendered with.
+    """
+    from jinja2 import meta
+
+    environment, name = get_template_environment(settings, template_filename)
+    variables = set()
+    names = [name]
+    seen = set()
+    while names:
+        name = names.pop()
+        if name is None or name in seen:
+            # names computed at render time can't be followed
+            continue
+        seen.add(name)
+        source = environment.loader.get_source(environment, name)[0]
+        ast = environment.parse(source)
+        variables |= meta.find_undeclared_variables(ast)
+        names.extend(meta.find_referenced_templates(ast))
+    return variables
 
 
 def send_email(msg, server, username, password, insecure=True):
     """
-    Sends the email.
+    Sends the email over a new connection. Use mail.SMTPSender to send
+    many emails over one session.
 
     Args:
         msg (email.MIMEMultipart): The email to be sent.
     """
-    try:
-        conn = smtplib.SMTP(server, 587)
-        context = ssl.create_default_context() if not insecure else None
-        conn.starttls(context=context)
-        conn.login(username, password)
-        conn.send_message(msg)
-        conn.quit()
-        return True
-    except Exception as e:
-        print(e)
+    from .mail import SMTPSender
+
+    with SMTPSender(server, username, password, insecure) as sender:
+        return sender.send(msg)
 
 
 def generate_email(
-    settings, mail_to: str, mail_subject: str, mail_text: str, files=None
+    settings,
+    mail_to: str,
+    mail_subject: str,
+    mail_text: str,
+    files=None,
+    shared_files=None,
+    attachment_cache=None,
 ):
     """
     Generate EmailMessage
@@ -58,11 +132,19 @@ def generate_email(
         mail_subject: mail subject
         mail_text: mail text
         files (touple): list of file_path and file_name
+        shared_files (touple): list of file_path and file_name, of files
+                               attached to many emails of a run
+        attachment_cache (AttachmentCache): cache the shared files are
+                                            attached from, if given
 
     Returns:
         email.EmailMessage
 
     """
+    from email.header import Header
+    from email.message import EmailMessage
+    from email.utils import formatdate
+
     msg = EmailMessage()
     msg["To"] = Header(mail_to, "utf-8")
     msg["Subject"] = mail_subject
@@ -71,37 +153,253 @@ def generate_email(
 
     msg.set_content(mail_text)
 
-    for file_path, file_name in files:
-        ctype, encoding = mimetypes.guess_type(file_path)
-        if ctype is None or encoding is not None:
-            ctype = "application/octet-stream"
-        maintype, subtype = ctype.split("/", 1)
+    if attachment_cache is None:
+        files = [*(files or ()), *(shared_files or ())]
+        shared_files = None
+
+    for file_path, file_name in files or ():
+        maintype, subtype = guess_mime_type(file_path)
         with open(file_path, "rb") as fp:
             msg.add_attachment(
                 fp.read(), maintype=maintype, subtype=subtype, filename=file_name
             )
 
-    with open("outgoing.msg", "wb") as email_file:
-        email_file.write(bytes(msg))
+    for file_path, file_name in shared_files or ():
+        if msg.get_content_type() != "multipart/mixed":
+            msg.make_mixed()
+        msg.attach(attachment_cache.get(file_path, file_name))
 
     return msg
 
 
-def generate_pdf(html_data, css_data, path):
+def guess_mime_type(file_path):
+    """
+    Returns maintype and subtype of the file, application/octet-stream if
+    unknown.
+    """
+    import mimetypes
+
+    ctype, encoding = mimetypes.guess_type(file_path)
+    if ctype is None or encoding is not None:
+        ctype = "application/octet-stream"
+    return ctype.split("/", 1)
+
+
+class AttachmentCache:
+    """
+    Holds the encoded MIME parts of attachments which are the same for many
+    emails of a run, e.g. the product descriptions and the policy attached to
+    the contracts.
+
+    Every file is read, its type guessed and its content base64-encoded only
+    once, the part is attached to all further emails as it is. The counters
+    show how many encodings were avoided.
+    """
+
+    def __init__(self):
+        self.parts = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, file_path, file_name):
+        """
+        Returns the MIME part attaching the file as file_name.
+        """
+        from email.message import MIMEPart
+
+        key = (str(file_path), file_name)
+        if key in self.parts:
+            self.hits += 1
+            return self.parts[key]
+        self.misses += 1
+        maintype, subtype = guess_mime_type(file_path)
+        part = MIMEPart()
+        with open(file_path, "rb") as fp:
+            part.set_content(
+                fp.read(), maintype=maintype, subtype=subtype, filename=file_name
+            )
+        self.parts[key] = part
+        return part
+
+
+class RenderContext:
+    """
+    Holds everything WeasyPrint needs, which is the same for all documents
+    of a run: the font configuration, the parsed stylesheets and the base
+    url relative links are resolved against.
+
+    Font discovery and CSS parsing are expensive, so a context should be
+    created once per run (or once per worker process) and be passed to every
+    generate_pdf call. The counters show how many stylesheet parses were
+    avoided by reusing the context.
+
+    Args:
+        base_url: directory relative urls in the documents are resolved against.
+    """
+
+    def __init__(self, base_url=None):
+        from weasyprint.text.fonts import FontConfiguration
+
+        self.font_config = FontConfiguration()
+        self.base_url = str(base_url) if base_url else None
+        self.stylesheets = {}
+        self.documents = 0
+        self.stylesheet_parses = 0
+        self.stylesheet_reuses = 0
+
+    def get_stylesheet(self, css_path):
+        """
+        Returns the parsed stylesheet for css_path, parsing it on first use only.
+        """
+        from weasyprint import CSS
+
+        key = str(css_path)
+        if key in self.stylesheets:
+            self.stylesheet_reuses += 1
+        else:
+            self.stylesheet_parses += 1
+            self.stylesheets[key] = CSS(filename=key, font_config=self.font_config)
+        return self.stylesheets[key]
+
+
+def generate_pdf(html_data, css_data, path, context=None):
     """
     Takes rendered HTML template and filename and converts it to a PDF invoice
     using weasyprint.
 
     Args:
         rendered (str): Rendered invoice HTML
+        css_data: Path of the stylesheet to be applied
         invoice_path: Complete path where the invoice will be written to
+        context (RenderContext): Shared render context, if None a new one is
+                                 created for this document only.
     """
-    font_config = FontConfiguration()
-    html = HTML(string=html_data)
-    css = CSS(css_data, font_config=font_config)
+    from weasyprint import HTML
+
+    if context is None:
+        context = RenderContext()
+    html = HTML(string=html_data, base_url=context.base_url)
     html.write_pdf(
-        path, stylesheets=[css], font_config=font_config, presentational_hints=True
+        path,
+        stylesheets=[context.get_stylesheet(css_data)],
+        font_config=context.font_config,
+        presentational_hints=True,
+    )
+    context.documents += 1
+
+
+def render_document(html_data, css_data, context):
+    """
+    Lays out the rendered HTML template with weasyprint, without writing it.
+
+    Args:
+        html_data (str): Rendered HTML
+        css_data: Path of the stylesheet to be applied
+        context (RenderContext): Shared render context
+
+    Returns:
+        weasyprint.Document: the laid out pages.
+    """
+    from weasyprint import HTML
+
+    html = HTML(string=html_data, base_url=context.base_url)
+    document = html.render(
+        stylesheets=[context.get_stylesheet(css_data)],
+        font_config=context.font_config,
+        presentational_hints=True,
     )
+    context.documents += 1
+    return document
+
+
+def write_combined_pdf(documents, path):
+    """
+    Writes the pages of all documents into one PDF file at path, in one pass.
+    """
+    pages = [page for document in documents for page in document.pages]
+    documents[0].copy(pages).write_pdf(path)
+    return len(pages)
+
+
+def run_jobs(function, tasks, jobs=1, initializer=None, initargs=()):
+    """
+    Calls function for every task, either one after another in the current
+    process, or spread over a pool of worker processes.
+
+    Whatever the order the workers finish in, the results are yielded in the
+    order of the tasks, so output and error reporting stay reproducible.
+    Exceptions raised by the function are yielded instead of raised, so one
+    broken task does not stop the others.
+
+    Args:
+        function: module level function to be called (it has to be picklable).
+        tasks: list of argument tuples, one tuple per call.
+        jobs (int): number of worker processes, 1 runs everything serially.
+        initializer: called once per worker process (or once in the current
+                     process for serial runs) with initargs.
+        initargs (tuple): arguments for the initializer.
+
+    Yields:
+        tuple: (task, result, error), where error is None on success.
+    """
+    if jobs <= 1:
+        if initializer:
+            initializer(*initargs)
+        for task in tasks:
+            try:
+                yield task, function(*task), None
+            except Exception as e:
+                yield task, None, e
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=jobs, initializer=initializer, initargs=initargs
+    ) as executor:
+        futures = [executor.submit(function, *task) for task in tasks]
+        for task, future in zip(tasks, futures):
+            try:
+                yield task, future.result(), None
+            except Exception as e:
+                yield task, None, e
+
+
+def read_cache(cache_path, version):
+    """
+    Reads a cache file written by write_cache.
+
+    Args:
+        cache_path: path of the cache file.
+        version: version of the cache format the caller expects.
+
+    Returns:
+        The cached data, or None if the file is missing, unreadable or was
+        written with another version.
+    """
+    try:
+        with open(cache_path, "rb") as cache_file:
+            cached_version, data = pickle.load(cache_file)  # nosec
+    except Exception:
+        return None
+    if cached_version != version:
+        return None
+    return data
+
+
+def write_cache(cache_path, version, data):
+    """
+    Writes data to a cache file. The file is replaced atomically, so
+    concurrent readers never see a half written cache.
+
+    Args:
+        cache_path: path of the cache file, its directory is created if missing.
+        version: version of the cache format.
+        data: picklable data to be cached.
+    """
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_name(f".{cache_path.name}.{os.getpid()}")
+    with open(tmp_path, "wb") as cache_file:
+        pickle.dump((version, data), cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
 
 
 def generate_yaml(object, filename):
@@ -3,44 +3,67 @@ import datetime
 import locale
 import yaml
 
-from .contract import get_contracts
-from .helpers import generate_pdf, get_template, generate_email, send_email
-
-
-def fill_invoice_items(settings, items):
+from pathlib import Path
+from .billed_items import get_billed_items_store
+from .catalog import InvoiceCatalog
+from .contract import (
+    get_contract_index,
+    get_contracts,
+    iterate_contracts,
+    month_index,
+)
+from .helpers import (
+    generate_pdf,
+    render_document,
+    write_combined_pdf,
+    get_template,
+    generate_email,
+    run_jobs,
+    RenderContext,
+)
+from .manifest import RenderManifest
+from .money import (
+    compute_gross_totals,
+    compute_totals,
+    from_cents,
+    multiply_cents,
+    to_cents,
+)
+
+
+def fill_invoice_items(settings, items, totals=None):
     """
     Calculates the items which will appear on the invoice, as well as the total_gross,
     total_net and total_vat value.
+
+    The amounts are calculated in integer cents, see money.compute_totals.
+    Totals computed for many invoices in one batch can be given.
     """
-    invoice_total_net = float()
-    invoice_total_vat = float()
-    invoice_total_gross = float()
+    if totals is None:
+        totals = compute_totals([items], settings.vat)[0]
 
     invoice_items = []
 
-    for n_e, item in enumerate(items):
-        final_quantity = item.get("quantity", 1)
-        subtotal = round(final_quantity * item["price"], 2)
-
+    for n_e, (item, subtotal) in enumerate(zip(items, totals.subtotals)):
         invoice_items.append(
             {
                 "item": n_e + 1,
                 "description": item["description"],
                 "price": item["price"],
-                "quantity": final_quantity,
-                "subtotal": subtotal,
+                "quantity": item.get("quantity", 1),
+                "subtotal": from_cents(subtotal),
             }
         )
 
-        invoice_total_gross += subtotal
-
-    invoice_total_net = round(invoice_total_gross / (1.0 + settings.vat / 100.0), 2)
-    invoice_total_vat = round(invoice_total_gross - invoice_total_net, 2)
-
-    return (invoice_items, invoice_total_net, invoice_total_vat, invoice_total_gross)
+    return (
+        invoice_items,
+        from_cents(totals.net),
+        from_cents(totals.vat),
+        from_cents(totals.gross),
+    )
 
 
-def generate_invoice(settings, contract, year, month):
+def generate_invoice(settings, contract, year, month, totals=None):
     """
     Creates an invoice, i.e. calls the fill_invoice_items function, to get
     all the numbers right, as well as filling all the remaining required meta
@@ -48,7 +71,9 @@ def generate_invoice(settings, contract, year, month):
 
     It returns the invoice dict.
     """
-    invoice_items, net, vat, gross = fill_invoice_items(settings, contract["items"])
+    invoice_items, net, vat, gross = fill_invoice_items(
+        settings, contract["items"], totals
+    )
 
     invoice_data = {}
     invoice_data["address"] = contract.get("address", ["", "", ""])
@@ -67,69 +92,220 @@ def generate_invoice(settings, contract, year, month):
     return invoice_data
 
 
-def iterate_invoices(settings):
+# Per process state of the render workers, see _init_render_worker
+_render_worker = {}
+
+
+def _init_render_worker(settings):
     """
-    Generator which iterates over all contract directories and
-    included invoice yamls, yields contract_invoice_dir and filename.
+    Prepares the current process for rendering invoices. Worker processes
+    do not necessarily inherit the locale, and the template is only loaded
+    once per process, as is the render context holding fonts and stylesheets.
     """
-    for d in settings.invoices_dir.iterdir():
-        contract_invoice_dir = settings.invoices_dir / d
-        if contract_invoice_dir.is_dir():
-            for filename in contract_invoice_dir.glob("*.yaml"):
-                yield contract_invoice_dir, filename
+    locale.setlocale(locale.LC_ALL, settings.locale)
+    _render_worker["template"] = get_template(settings, settings.invoice_template_file)
+    _render_worker["context"] = RenderContext(settings.assets_dir)
 
 
-def render_invoices(settings):
+def _render_invoice_job(settings, invoice_yaml_path, invoice_pdf_path):
     """
-    Renders all invoices and saves pdfs to settings.invoices_dir.
+    Renders one invoice in a render worker. Returns the result of render_invoice
+    and the number of stylesheet parses it took.
     """
-    template = get_template(settings.invoice_template_file)
+    context = _render_worker["context"]
+    parses = context.stylesheet_parses
+    result = render_invoice(
+        settings,
+        _render_worker["template"],
+        invoice_yaml_path,
+        invoice_pdf_path,
+        context,
+    )
+    return result, context.stylesheet_parses - parses
 
-    for contract_invoice_dir, filename in iterate_invoices(settings):
-        invoice_pdf_filename = filename.with_suffix(".pdf")
-        if not invoice_pdf_filename.is_file():
-            with open(filename) as yaml_file:
-                invoice_data = yaml.safe_load(yaml_file.read())
-            invoice_data.update(settings._asdict())
 
-            print(f"Rendering invoice pdf for {invoice_data['id']}")
+def format_invoice_html(settings, template, invoice_yaml_path):
+    """
+    Renders the template with the data of the invoice yaml file, formatted
+    for printing.
 
-            # Format data for printing
-            for element in ["total_net", "total_gross", "total_vat"]:
-                invoice_data[element] = locale.format_string(
-                    "%.2f", invoice_data[element]
-                )
-            for item in invoice_data["items"]:
-                for key in ["price", "subtotal"]:
-                    item[key] = locale.format_string("%.2f", item[key])
+    Returns the invoice data and the HTML.
+    """
+    with open(invoice_yaml_path) as yaml_file:
+        invoice_data = yaml.safe_load(yaml_file.read())
+    invoice_data.update(settings._asdict())
 
-            invoice_html = template.render(**invoice_data)
+    # Format data for printing
+    for element in ["total_net", "total_gross", "total_vat"]:
+        invoice_data[element] = locale.format_string("%.2f", invoice_data[element])
+    for item in invoice_data["items"]:
+        for key in ["price", "subtotal"]:
+            item[key] = locale.format_string("%.2f", item[key])
 
-            generate_pdf(
-                invoice_html, settings.invoice_css_asset_file, invoice_pdf_filename
-            )
-        else:
-            print(f"Invoice {invoice_pdf_filename} already exists")
+    return invoice_data, template.render(**invoice_data)
 
 
-def save_invoice_yaml(settings, invoice_data, force=False):
+def render_invoice(
+    settings, template, invoice_yaml_path, invoice_pdf_path, render_context=None
+):
     """
-    Saves the invoice_data to a yaml file in settings.invoices_dir.
+    Renders a single invoice yaml file to invoice_pdf_path, using the
+    (optional) shared RenderContext.
+
+    Returns the id of the rendered invoice.
     """
-    invoice_contract_dir = settings.invoices_dir / invoice_data["cid"]
+    invoice_data, invoice_html = format_invoice_html(
+        settings, template, invoice_yaml_path
+    )
 
-    if not invoice_contract_dir.is_dir():
-        invoice_contract_dir.mkdir()
+    generate_pdf(
+        invoice_html, settings.invoice_css_asset_file, invoice_pdf_path, render_context
+    )
+    return invoice_data["id"]
+
+
+def get_invoice_render_inputs(settings, invoice_yaml_path):
+    """
+    Returns the files the pdf of the invoice is rendered from.
+    """
+    return [
+        invoice_yaml_path,
+        settings.invoice_template_file,
+        settings.invoice_css_asset_file,
+        settings.logo_asset_file,
+    ]
+
+
+def render_invoices(settings, jobs=1):
+    """
+    Renders all invoices and saves pdfs to settings.invoices_dir.
+
+    Only invoices without pdf, or with inputs (yaml, template, stylesheet,
+    logo or settings) changed since the pdf was rendered, are rendered, see
+    RenderManifest.
+
+    With jobs > 1 the invoices are rendered by that many worker processes.
+    Output is printed in the order of the invoice files in any case. Every
+    process reuses one RenderContext for all of its documents.
+
+    Returns a list of the invoice yaml files which failed to render.
+    """
+    with RenderManifest(settings) as manifest, InvoiceCatalog(settings) as catalog:
+        tasks = []
+        for entry in catalog.select():
+            filename = Path(entry["path"])
+            invoice_pdf_filename = filename.with_suffix(".pdf")
+            inputs = get_invoice_render_inputs(settings, filename)
+            if manifest.is_stale(invoice_pdf_filename, inputs):
+                if invoice_pdf_filename.is_file():
+                    print(f"Invoice {invoice_pdf_filename} is outdated")
+                tasks.append((settings, filename, invoice_pdf_filename))
+            else:
+                print(f"Invoice {invoice_pdf_filename} already exists")
+
+        failed = []
+        parses = 0
+        for task, result, error in run_jobs(
+            _render_invoice_job, tasks, jobs, _init_render_worker, (settings,)
+        ):
+            if error:
+                print(f"Error rendering invoice {task[1]}: {error}")
+                failed.append(task[1])
+            else:
+                invoice_id, job_parses = result
+                parses += job_parses
+                manifest.record(task[2], get_invoice_render_inputs(settings, task[1]))
+                catalog.set_pdf(task[1])
+                print(f"Rendered invoice pdf for {invoice_id}")
+
+    rendered = len(tasks) - len(failed)
+    if rendered:
+        print(
+            f"Rendered {rendered} invoices with {parses} stylesheet parses "
+            f"({rendered - parses} avoided by the shared render context)"
+        )
+    return failed
 
-    invoice_path = invoice_contract_dir / f"{invoice_data['id']}.yaml"
-    if not invoice_path.is_file() or force:
-        with open(invoice_path, "w") as invoice_fp:
-            invoice_fp.write(yaml.dump(invoice_data, default_flow_style=False))
-    else:
-        print(f"Invoice {invoice_path} already exists.")
 
+def render_print_run(
+    settings, year, month, suffix=None, cids=None, postal=False, output=None
+):
+    """
+    Lays out all selected invoices of a period (or suffix) into one PDF for
+    printing, with a cover page listing the invoices and their first page.
+    Every invoice starts on a new page.
+
+    The template and the RenderContext are set up once for all invoices, and
+    the PDF is written once, instead of rendering and merging single pdfs.
+
+    Args:
+        cids: only print the invoices of these customers, if given.
+        postal (bool): only print the invoices of contracts with postal: true.
+        output: path of the PDF, invoices_dir/print_run.<suffix>.pdf by default.
+
+    Returns:
+        Path: the PDF written, None if no invoice was selected.
+    """
+    suffix = suffix or f"{year}.{month:02}"
+    output = Path(output or settings.invoices_dir / f"print_run.{suffix}.pdf")
+    postal_cids = None
+    if postal:
+        postal_cids = {
+            cid for cid, data in get_contracts(settings).items() if data.get("postal")
+        }
+
+    with InvoiceCatalog(settings) as catalog:
+        entries = [
+            entry
+            for entry in catalog.select(suffix=suffix)
+            if (not cids or entry["cid"] in cids)
+            and (postal_cids is None or entry["cid"] in postal_cids)
+        ]
+    if not entries:
+        print(f"No invoices to print for {suffix}")
+        return None
+
+    template = get_template(settings, settings.invoice_template_file)
+    context = RenderContext(settings.assets_dir)
+    invoices = []
+    documents = []
+    for entry in entries:
+        invoice_data, invoice_html = format_invoice_html(
+            settings, template, Path(entry["path"])
+        )
+        document = render_document(
+            invoice_html, settings.invoice_css_asset_file, context
+        )
+        print(f"Laid out invoice {invoice_data['id']}")
+        invoices.append(invoice_data)
+        documents.append(document)
+
+    # falls back to the shipped template, see get_environment
+    cover_template = get_template(settings, settings.print_run_template_file)
+
+    # the page numbers depend on the length of the cover, which is one page
+    # unless the index is long
+    cover_pages = 1
+    while True:
+        page = cover_pages + 1
+        for invoice_data, document in zip(invoices, documents):
+            invoice_data["first_page"] = page
+            page += len(document.pages)
+        cover = render_document(
+            cover_template.render(invoices=invoices, suffix=suffix, pages=page - 1),
+            settings.invoice_css_asset_file,
+            context,
+        )
+        if len(cover.pages) == cover_pages:
+            break
+        cover_pages = len(cover.pages)
+
+    pages = write_combined_pdf([cover] + documents, output)
+    print(f"Wrote {len(invoices)} invoices with {pages} pages to {output}")
+    return output
 
-def create_invoices(settings, year, month, cid_only=None, force=False):
+
+def create_invoices(settings, year, month, cid_only=None, force=False, use_cache=True):
     """
     Bulk creates invoice yaml files for a specific month-year-combination.
     """
@@ -139,16 +315,26 @@ def create_invoices(settings, year, month, cid_only=None, force=False):
     if cid_only:
         print(f"Only creating to {cid_only}")
 
-    contracts = get_contracts(settings, year, month, cid_only)
-    for cid, contract in contracts.items():
-        print(f"Creating invoice yaml {cid}.{year}.{month}")
-        invoice_data = generate_invoice(settings, contract, year, month)
-        save_invoice_yaml(settings, invoice_data, force)
+    contracts = get_contracts(settings, year, month, cid_only, use_cache=use_cache)
+    # the totals of all invoices of the period are computed in one batch
+    totals = compute_totals(
+        (contract["items"] for contract in contracts.values()), settings.vat
+    )
+    with InvoiceCatalog(settings) as catalog:
+        for (cid, contract), contract_totals in zip(contracts.items(), totals):
+            print(f"Creating invoice yaml {cid}.{year}.{month}")
+            invoice_data = generate_invoice(
+                settings, contract, year, month, contract_totals
+            )
+            save_invoice_yaml(settings, invoice_data, force, catalog)
 
 
-def save_invoice_yaml(settings, invoice_data, force=False):
+def save_invoice_yaml(settings, invoice_data, force=False, catalog=None):
     """
     Saves the invoice_data to a yaml file in settings.invoices_dir.
+
+    If an InvoiceCatalog is given, the invoice is entered right away, so the
+    catalog doesn't need to read it again.
     """
     invoice_contract_dir = settings.invoices_dir / invoice_data["cid"]
 
@@ -159,6 +345,8 @@ def save_invoice_yaml(settings, invoice_data, force=False):
     if not invoice_path.is_file() or force:
         with open(invoice_path, "w") as invoice_fp:
             invoice_fp.write(yaml.dump(invoice_data, default_flow_style=False))
+        if catalog is not None:
+            catalog.update(invoice_path, invoice_data)
     else:
         print(f"Invoice {invoice_path} already exists.")
 
@@ -174,41 +362,44 @@ def get_period_from_item_keys(item_keys):
     return (start, end)
 
 
-def generate_billed_invoice(settings, contract, suffix):
+def generate_billed_invoice(settings, contract, suffix, store=None):
     """
     Creates an invoice from the already billed items, i.e. collects all unbilled items
     adds it to the invoice, and enters the invoice number into the billed items.
 
     It returns the invoice dict.
+
+    The billed items are read from and written to store, or to the store
+    configured in the settings if not given.
     """
-    billed_items = get_billed_items(settings, contract["cid"])
+    if store is None:
+        with get_billed_items_store(settings) as store:
+            return generate_billed_invoice(settings, contract, suffix, store)
+
+    open_items = store.get_open_items(contract["cid"])
     invoice_date = arrow.now().format("D.M.YYYY", locale=settings.arrow_locale)
     invoice_id = f"{contract['cid']}.{suffix}"
 
-    net = float()
-    vat = float()
-    gross = float()
-
     invoice_items = []
     item_keys = []
-    for billed_item in billed_items:
-        if not billed_item["invoice"]:
-            invoice_items.append(
-                {
-                    "item": len(invoice_items) + 1,
-                    "description": billed_item["description"],
-                    "price": billed_item["price"],
-                    "quantity": billed_item["quantity"],
-                    "subtotal": billed_item["subtotal"],
-                }
-            )
-            item_keys.append(billed_item["key"])
-            billed_item["invoice"] = invoice_id
-            gross += billed_item["subtotal"]
+    for ref, billed_item in open_items:
+        invoice_items.append(
+            {
+                "item": len(invoice_items) + 1,
+                "description": billed_item["description"],
+                "price": billed_item["price"],
+                "quantity": billed_item["quantity"],
+                "subtotal": billed_item["subtotal"],
+            }
+        )
+        item_keys.append(billed_item["key"])
 
-    gross = round(gross, 2)
-    net = round(gross / (1.0 + settings.vat / 100.0), 2)
-    vat = round(gross - net, 2)
+    totals = compute_gross_totals(
+        [item["subtotal"] for item in invoice_items], settings.vat
+    )
+    gross = from_cents(totals.gross)
+    net = from_cents(totals.net)
+    vat = from_cents(totals.vat)
 
     # If there are no unbilled items, an exception is raised, to be cought
     # in the caller function
@@ -233,18 +424,41 @@ def generate_billed_invoice(settings, contract, suffix):
     invoice_data["total_vat"] = vat
     invoice_data["vat"] = settings.vat
 
-    # We have to save the billed items, as we added the invoice number,
+    # We have to enter the invoice number into the billed items,
     # s.t. these items will not be billed again.
     # We do this as the last step, so we can be sure the rest of the
     # invoice creation worked
-    save_billed_items_yaml(settings, billed_items, contract["cid"])
+    store.set_invoice(contract["cid"], [ref for ref, _ in open_items], invoice_id)
 
     return invoice_data
 
 
+def generate_billed_invoices(settings, suffix, store, cid_only=None):
+    """
+    Generator which yields the billed invoice of every customer (or just
+    cid_only) with unbilled items, customer by customer.
+
+    The pipeline holds one customer at a time: its contract (parsed when it
+    is its turn, see iterate_contracts), its open billed items and its
+    invoice. Memory is therefore bounded by the largest single customer,
+    plus the list of contract file paths, independent of the number of
+    customers. (With the yaml backend the billed item history of a customer
+    is only parsed, if its index has to be rebuilt.)
+    """
+    for cid, contract in iterate_contracts(settings, cid_only=cid_only):
+        print(f"Creating billed invoice yaml {cid}.{suffix}")
+        try:
+            yield generate_billed_invoice(settings, contract, suffix, store)
+        except NoUnbilledItemsFound:
+            print(f"No unbilled items found for {cid}")
+
+
 def create_billed_invoices(settings, suffix, cid_only=None, force=False):
     """
     Bulk creates invoice yaml files for the customer from the customers billed items.
+
+    Invoices are created and saved one customer at a time, see
+    generate_billed_invoices.
     """
     if force:
         print("Force create enabled")
@@ -252,49 +466,47 @@ def create_billed_invoices(settings, suffix, cid_only=None, force=False):
     if cid_only:
         print(f"Only creating to {cid_only}")
 
-    contracts = get_contracts(settings, cid_only=cid_only)
-    for cid, contract in contracts.items():
-        print(f"Creating billed invoice yaml {cid}.{suffix}")
-        try:
-            invoice_data = generate_billed_invoice(settings, contract, suffix)
-        except NoUnbilledItemsFound:
-            print(f"No unbilled items found for {cid}")
-            continue
-        save_invoice_yaml(settings, invoice_data, force)
+    with get_billed_items_store(settings) as store, InvoiceCatalog(settings) as catalog:
+        for invoice_data in generate_billed_invoices(settings, suffix, store, cid_only):
+            save_invoice_yaml(settings, invoice_data, force, catalog)
 
 
 def save_billed_items_yaml(settings, billed_items, cid):
     """
-    Saves the billed items to the billed items file of the customer 
+    Saves the billed items of the customer to the billed items store
+    configured in the settings (the customers yaml file by default).
     """
-    billed_items_path = settings.billed_items_dir / f"{cid}.yaml"
-    with open(billed_items_path, "w") as outfile:
-        yaml.dump(billed_items, outfile)
+    with get_billed_items_store(settings) as store:
+        store.save_items(cid, billed_items)
 
 
 def get_billed_items(settings, cid):
     """
-    Returns the billed_items for the given cid. 
+    Returns the billed_items for the given cid from the billed items store
+    configured in the settings.
 
     If there are no billed items yet, an empty list is returned.
     """
-    billed_items_path = settings.billed_items_dir / f"{cid}.yaml"
-
-    if not billed_items_path.is_file():
-        return []
-    else:
-        with open(billed_items_path) as infile:
-            return yaml.safe_load(infile)
+    with get_billed_items_store(settings) as store:
+        return store.get_items(cid)
 
 
-def bill_cid_items(settings, contract, year, month):
+def bill_cid_items(settings, contract, year, month, store, billed_keys=None):
     """
-    Creates billed items for the given month and year. 
+    Creates billed items for the given month and year.
+
+    Returns the new billed items, i.e. an empty list if the month
+    is already billed in the store (or in billed_keys, the keys of the
+    customer in the store, if given).
     """
     billed_item_key = f"{year}-{month:02}"
     month_name = arrow.get(billed_item_key).format("MMMM", locale=settings.arrow_locale)
-    billed_items = get_billed_items(settings, contract["cid"])
-    if any(item["key"] == billed_item_key for item in billed_items):
+    billed_items = []
+    if billed_keys is None:
+        billed = store.is_billed(contract["cid"], billed_item_key)
+    else:
+        billed = billed_item_key in billed_keys
+    if billed:
         print(f"{billed_item_key} already billed for {contract['cid']}")
     else:
         for item in contract["items"]:
@@ -302,7 +514,9 @@ def bill_cid_items(settings, contract, year, month):
                 "description": f"{item['description']} {month_name} {year}",
                 "price": item["price"],
                 "quantity": item["quantity"],
-                "subtotal": item["price"] * item["quantity"],
+                "subtotal": from_cents(
+                    multiply_cents(to_cents(item["price"]), item["quantity"])
+                ),
                 "key": billed_item_key,
                 "invoice": None,
             }
@@ -310,79 +524,248 @@ def bill_cid_items(settings, contract, year, month):
     return billed_items
 
 
-def bill_items(settings, year, month, cid_only=None, dry=False):
+def bill_items(settings, year, month, cid_only=None, dry=False, use_cache=True):
     """
-    Bill all products for all customers (or just one) i.e. mark them to be included 
+    Bill all products for all customers (or just one) i.e. mark them to be included
     in the next invoice to be created.
     """
+    billing_month = month_index(year, month)
+    bill_months(settings, billing_month, billing_month, cid_only, dry, use_cache)
+
+
+def bill_months(settings, first, last, cid_only=None, dry=False, use_cache=True):
+    """
+    Bill all products for all customers (or just one) for every month from
+    first to last (month indices, see month_index) the contract is active in.
+
+    The contracts are read once, the active months are looked up in the
+    ContractIndex. The keys billed already are read once per customer, the
+    missing months are billed in order and added to the billed items store
+    at once.
+    """
     if cid_only:
         print(f"Only creating to {cid_only}")
 
-    contracts = get_contracts(settings, year, month, cid_only)
-    for cid, contract in contracts.items():
-        print(f"Billing items for {cid}.")
-        billed_items = bill_cid_items(settings, contract, year, month)
-        if not dry:
-            save_billed_items_yaml(settings, billed_items, cid)
+    contracts, index = get_contract_index(settings, cid_only, use_cache)
+    months = [divmod(billing_month, 12) for billing_month in range(first, last + 1)]
+    active = {
+        (year, month): set(index.get_active_cids(year, month + 1))
+        for year, month in months
+    }
+    with get_billed_items_store(settings) as store:
+        for cid, contract in contracts.items():
+            cid_months = [
+                (year, month + 1)
+                for year, month in months
+                if cid in active[year, month]
+            ]
+            if not cid_months:
+                continue
+            print(f"Billing items for {cid}.")
+            billed_keys = store.get_keys(cid)
+            billed_items = []
+            for year, month in cid_months:
+                billed_items += bill_cid_items(
+                    settings, contract, year, month, store, billed_keys
+                )
+            if billed_items and not dry:
+                store.add_items(cid, billed_items)
+
+
+def generate_invoice_email(settings, mail_template, invoice_yaml_path):
+    """
+    Returns the invoice data and the email with the invoice pdf attached.
+    """
+    with open(invoice_yaml_path) as yaml_file:
+        invoice_data = yaml.safe_load(yaml_file)
+
+    invoice_pdf_filename = (
+        f"{settings.company_name} {invoice_yaml_path.with_suffix('.pdf').name}"
+    )
+    invoice_pdf_path = invoice_yaml_path.with_suffix(".pdf")
+    invoice_mail_text = mail_template.render(invoice=invoice_data)
+
+    invoice_email = generate_email(
+        settings,
+        invoice_data["email"],
+        f"{settings.invoice_mail_subject} {invoice_data['id']}",
+        invoice_mail_text,
+        [(invoice_pdf_path, invoice_pdf_filename)],
+    )
+    return invoice_data, invoice_email
 
 
-def send_invoices(settings, year, month, cid_only, force, suffix=None):
+def mark_invoice_sent(catalog, invoice_yaml_path, invoice_data=None):
+    """
+    Sets the sent flag in the invoice yaml file and the InvoiceCatalog.
+    """
+    if invoice_data is None:
+        with open(invoice_yaml_path) as yaml_file:
+            invoice_data = yaml.safe_load(yaml_file)
+    with open(invoice_yaml_path, "w") as yaml_file:
+        invoice_data["sent"] = True
+        yaml_file.write(yaml.dump(invoice_data))
+    catalog.update(invoice_yaml_path, invoice_data)
+
+
+def send_invoices(
+    settings,
+    year,
+    month,
+    cid_only,
+    force,
+    suffix=None,
+    sessions=None,
+    per_minute=None,
+    delivery=None,
+    wait=False,
+):
     """
     Sends emails with the invoices as attachment.
-    
+
     For backwards compatibility: year and month are ignored, if suffix is given!
+
+    The invoices are sent over settings.smtp_sessions (or sessions) parallel
+    SMTP sessions, each renewed after settings.smtp_messages_per_connection
+    messages, with at most settings.smtp_messages_per_minute (or per_minute)
+    messages per minute. An invoice is marked as sent as soon as the server
+    accepted it, the results of all invoices are printed at the end.
+
+    With settings.mail_delivery (or delivery) set to maildir, mbox or sendmail,
+    the messages are handed to the local system instead, one after another.
+    Invoices piped into sendmail are marked as sent once it accepted them,
+    spooled invoices once hand_off_spool passed them on.
+
+    The invoices are selected from the InvoiceCatalog, which knows the sent
+    flag, and queued in the Outbox. Mails which failed with transient errors
+    are retried with exponential backoff: by the next run, or within this run
+    if wait is set, until they are sent or failed for good. An interrupted run
+    is resumed by running it again.
+
+    Returns the number of invoices, which failed for good.
     """
-    mail_template = get_template(settings.invoice_mail_template_file)
+    import asyncio
+    import time
+    from .mail import (
+        INVOICE_HEADER,
+        get_sender,
+        is_temporary_smtp_error,
+        send_concurrently,
+        spool_deliveries,
+    )
+    from .outbox import Outbox, DEFERRED, FAILED, SENT, SPOOLED
+
+    delivery = delivery or settings.mail_delivery
+    sessions = sessions or settings.smtp_sessions
+    if per_minute is None:
+        per_minute = settings.smtp_messages_per_minute
+    if delivery != "smtp":
+        sessions, per_minute = 1, 0
+    spool = delivery in spool_deliveries
+    mail_template = get_template(settings, settings.invoice_mail_template_file)
 
     if force:
         print("Force resend enabled")
 
-    for d in settings.invoices_dir.iterdir():
-        if cid_only and cid_only != d.name:
-            continue
-        else:
-            print(f"Only sending to {cid_only}")
-
-        customer_invoice_dir = settings.invoices_dir / d
-        if customer_invoice_dir.iterdir():
-            for filename in customer_invoice_dir.glob("*.yaml"):
-                if suffix:
-                    if not filename.name.endswith(f"{suffix}.yaml"):
-                        continue
-                elif not filename.name.endswith(f"{year}.{month:02}.yaml"):
+    if cid_only:
+        print(f"Only sending to {cid_only}")
+
+    with InvoiceCatalog(settings) as catalog, Outbox(settings) as outbox:
+        selected = []
+        for entry in catalog.select(year, month, cid_only, suffix):
+            # don't send invoices multiple times, sent invoices are not opened
+            if entry["sent"] and not force:
+                print(f"Skip previously sent invoice {entry['id']}")
+                continue
+            invoice_id = entry["id"] or Path(entry["path"]).stem
+            outbox.enqueue(invoice_id, entry["path"])
+            selected.append(invoice_id)
+
+        def generate_invoice_emails(due):
+            for mail in due:
+                filename = Path(mail["path"])
+                try:
+                    invoice_data, invoice_email = generate_invoice_email(
+                        settings, mail_template, filename
+                    )
+                except Exception as e:
+                    print(f"Could not create email for invoice {mail['invoice']}: {e}")
+                    outbox.mark_failed(mail["invoice"], e)
                     continue
+                print(f"Sending invoice {mail['invoice']}")
+                if spool:
+                    invoice_email[INVOICE_HEADER] = mail["invoice"]
+                yield (mail["invoice"], filename, invoice_data), invoice_email
+
+        def handle_result(key, accepted, error):
+            invoice_id, filename, invoice_data = key
+            if accepted and spool:
+                outbox.mark_spooled(invoice_id)
+            elif accepted:
+                mark_invoice_sent(catalog, filename, invoice_data)
+                outbox.mark_sent(invoice_id)
+            else:
+                state = outbox.mark_failed(
+                    invoice_id, error, is_temporary_smtp_error(error)
+                )
+                print(f"Sending invoice {invoice_id} {state}: {error}")
+
+        while True:
+            due = outbox.get_due(set(selected))
+            if due:
+                asyncio.run(
+                    send_concurrently(
+                        generate_invoice_emails(due),
+                        lambda: get_sender(settings, delivery, report_errors=False),
+                        sessions,
+                        per_minute,
+                        handle_result,
+                    )
+                )
+                continue
+            next_attempt = outbox.get_next_attempt(set(selected))
+            if next_attempt is None or not wait:
+                break
+            delay = max(0, next_attempt - time.time())
+            print(f"Retrying deferred invoices in {delay:.0f} seconds")
+            time.sleep(delay)
+
+        results = [outbox.get(invoice_id) for invoice_id in sorted(selected)]
+
+    if results:
+        print("Delivery results:")
+        for mail in results:
+            if mail["state"] == SENT:
+                print(f"  {mail['invoice']}: sent")
+            else:
+                print(f"  {mail['invoice']}: {mail['state']}, {mail['error']}")
+        sent = sum(mail["state"] == SENT for mail in results)
+        print(f"Sent {sent} of {len(results)} invoices.")
+        spooled = sum(mail["state"] == SPOOLED for mail in results)
+        if spooled:
+            print(f"Spooled {spooled} invoices, hand-off-spool marks them as sent.")
+        deferred = sum(mail["state"] == DEFERRED for mail in results)
+        if deferred:
+            print(f"Deferred {deferred} invoices, run the command again to retry them.")
+    return sum(mail["state"] == FAILED for mail in results)
+
+
+def hand_off_spool(settings, spool="maildir", command=None):
+    """
+    Hands off the spool to the local MTA (see mail.hand_off_spool) and marks
+    the spooled invoices as sent, once sendmail accepted their emails.
 
-                with open(customer_invoice_dir / filename) as yaml_file:
-                    invoice_data = yaml.safe_load(yaml_file)
+    Returns the number of emails handed off and the number of failures.
+    """
+    from .mail import INVOICE_HEADER, hand_off_spool as hand_off
+    from .outbox import Outbox, SPOOLED
 
-                # don't send invoices multiple times
-                if invoice_data.get("sent") and not force:
-                    print(f"Skip previously sent invoice {invoice_data['id']}")
-                    continue
+    with InvoiceCatalog(settings) as catalog, Outbox(settings) as outbox:
 
-                invoice_pdf_filename = (
-                    f"{settings.company_name} {filename.with_suffix('.pdf').name}"
-                )
-                invoice_pdf_path = customer_invoice_dir / filename.with_suffix(".pdf")
-                invoice_mail_text = mail_template.render(invoice=invoice_data)
-
-                invoice_email = generate_email(
-                    settings,
-                    invoice_data["email"],
-                    f"{settings.invoice_mail_subject} {invoice_data['id']}",
-                    invoice_mail_text,
-                    [(invoice_pdf_path, invoice_pdf_filename)],
-                )
+        def handle_handed_off(headers):
+            mail = outbox.get(headers[INVOICE_HEADER] or "")
+            if mail and mail["state"] == SPOOLED:
+                mark_invoice_sent(catalog, Path(mail["path"]))
+                outbox.mark_sent(mail["invoice"])
 
-                print(f"Sending invoice {invoice_data['id']}")
-
-                if send_email(
-                    invoice_email,
-                    settings.server,
-                    settings.username,
-                    settings.password,
-                    settings.insecure,
-                ):
-                    with open(customer_invoice_dir / filename, "w") as yaml_file:
-                        invoice_data["sent"] = True
-                        yaml_file.write(yaml.dump(invoice_data))
+        return hand_off(settings, spool, command, handle_handed_off)
@@ -0,0 +1,446 @@
+import asyncio
+import mailbox
+import shlex
+import smtplib
+import ssl
+import subprocess
+
+from abc import ABC, abstractmethod
+from email.parser import BytesHeaderParser
+
+# Spools in settings.spool_dir, which the local MTA can deliver from
+SPOOL_MAILDIR = "maildir"
+SPOOL_MBOX = "outgoing.mbox"
+
+# Header of spooled invoice emails, to mark the invoice sent on hand-off
+INVOICE_HEADER = "X-Rechnung-Invoice"
+
+
+class UnknownMailDeliveryError(Exception):
+    """
+    If settings.mail_delivery names an unknown delivery mode, this exception
+    is thrown.
+    """
+
+    pass
+
+
+def is_transient_smtp_error(error):
+    """
+    Checks if error means the session is gone, but the message might be
+    accepted on a new connection: the server disconnected, or replied with
+    421 (service not available, closing transmission channel).
+    """
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code == 421 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code == 421
+    return isinstance(error, ConnectionError)
+
+
+def is_temporary_smtp_error(error):
+    """
+    Checks if sending the message might succeed later on: the error is
+    transient, or the server replied with a 4xx code (e.g. 450 or 451 of
+    greylisting or a full mailbox).
+    """
+    if is_transient_smtp_error(error):
+        return True
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return False
+
+
+class SMTPSender:
+    """
+    Sends emails over one persistent, authenticated SMTP session, instead of
+    connecting, doing STARTTLS and logging in again for every single message.
+
+    The session is opened with the first message and renewed after
+    max_messages messages. If the server disconnects or replies with 421,
+    the sender reconnects and retries the message (up to retries times).
+    Use it as a context manager to close the session when done.
+
+    Args:
+        server (str): hostname of the SMTP server
+        username (str): login name, no login is done if not set
+        password (str): password for the login
+        insecure (bool): don't verify the certificate of the server
+        port (int): port of the SMTP server
+        max_messages (int): messages to be sent over one connection
+        starttls (bool): upgrade the connection to TLS before the login
+        retries (int): reconnects per message after transient errors
+        report_errors (bool): print errors, they are kept in error in any case
+    """
+
+    def __init__(
+        self,
+        server,
+        username,
+        password,
+        insecure=True,
+        port=587,
+        max_messages=100,
+        starttls=True,
+        retries=1,
+        report_errors=True,
+    ):
+        self.server = server
+        self.username = username
+        self.password = password
+        self.insecure = insecure
+        self.port = port
+        self.max_messages = max_messages
+        self.starttls = starttls
+        self.retries = retries
+        self.report_errors = report_errors
+
+        self.conn = None
+        self.conn_messages = 0
+        self.connections = 0
+        self.messages = 0
+        self.error = None
+
+    @classmethod
+    def from_settings(cls, settings, **kwargs):
+        """
+        Creates a sender for the mail server configured in settings.
+        """
+        return cls(
+            settings.server,
+            settings.username,
+            settings.password,
+            settings.insecure,
+            settings.smtp_port,
+            settings.smtp_messages_per_connection,
+            settings.smtp_starttls,
+            **kwargs,
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def connect(self):
+        """
+        Opens a new (authenticated) session, closing the current one.
+        """
+        self.close()
+        conn = smtplib.SMTP(self.server, self.port)
+        try:
+            if self.starttls:
+                context = ssl.create_default_context() if not self.insecure else None
+                conn.starttls(context=context)
+            if self.username:
+                conn.login(self.username, self.password)
+        except Exception:
+            conn.close()
+            raise
+        self.conn = conn
+        self.conn_messages = 0
+        self.connections += 1
+
+    def close(self):
+        """
+        Politely ends the current session, if there is one.
+        """
+        if self.conn is None:
+            return
+        try:
+            self.conn.quit()
+        except (smtplib.SMTPException, OSError):
+            self.conn.close()
+        self.conn = None
+
+    def drop(self):
+        """
+        Throws away the current session without talking to the server.
+        """
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def send(self, msg):
+        """
+        Sends the message, reusing the current session if possible.
+
+        Like send_email, errors are printed (unless report_errors is False)
+        and not raised. The error of the last message is kept in error.
+
+        Args:
+            msg (email.EmailMessage): The email to be sent.
+
+        Returns:
+            bool: True if the server accepted the message.
+        """
+        self.error = None
+        for attempt in range(self.retries + 1):
+            try:
+                if self.conn is None or self.conn_messages >= self.max_messages:
+                    self.connect()
+                self.conn.send_message(msg)
+            except Exception as e:
+                transient = is_transient_smtp_error(e)
+                if transient:
+                    self.drop()
+                if not transient or attempt == self.retries:
+                    self.error = e
+                    if self.report_errors:
+                        print(e)
+                    return False
+            else:
+                self.conn_messages += 1
+                self.messages += 1
+                return True
+
+
+class LocalSender(ABC):
+    """
+    Base of the senders which hand the messages to the local system instead
+    of a mail server, with the interface of SMTPSender: use them as context
+    managers, send returns if the message was accepted and keeps the error.
+    """
+
+    def __init__(self, report_errors=True):
+        self.report_errors = report_errors
+        self.messages = 0
+        self.error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        pass
+
+    @abstractmethod
+    def deliver(self, msg):
+        """
+        Hands the message to the local system, raises on errors.
+        """
+
+    def send(self, msg):
+        self.error = None
+        try:
+            self.deliver(msg)
+        except Exception as e:
+            self.error = e
+            if self.report_errors:
+                print(e)
+            return False
+        self.messages += 1
+        return True
+
+
+class MaildirSender(LocalSender):
+    """
+    Writes the messages into a Maildir spool (settings.spool_dir/maildir).
+    """
+
+    def __init__(self, path, report_errors=True):
+        super().__init__(report_errors)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.mailbox = mailbox.Maildir(path, create=True)
+
+    @classmethod
+    def from_settings(cls, settings, **kwargs):
+        return cls(settings.spool_dir / SPOOL_MAILDIR, **kwargs)
+
+    def deliver(self, msg):
+        self.mailbox.add(msg)
+
+
+class MboxSender(LocalSender):
+    """
+    Appends the messages to a mbox spool (settings.spool_dir/outgoing.mbox),
+    which is locked until the sender is closed.
+    """
+
+    def __init__(self, path, report_errors=True):
+        super().__init__(report_errors)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.mailbox = mailbox.mbox(path)
+        self.mailbox.lock()
+
+    @classmethod
+    def from_settings(cls, settings, **kwargs):
+        return cls(settings.spool_dir / SPOOL_MBOX, **kwargs)
+
+    def deliver(self, msg):
+        self.mailbox.add(msg)
+
+    def close(self):
+        self.mailbox.close()
+
+
+class SendmailSender(LocalSender):
+    """
+    Pipes every message into a sendmail compatible command, which reads the
+    recipients from the headers (settings.sendmail_command, "sendmail -t -oi").
+    """
+
+    def __init__(self, command, report_errors=True):
+        super().__init__(report_errors)
+        self.command = shlex.split(command)
+
+    @classmethod
+    def from_settings(cls, settings, **kwargs):
+        return cls(settings.sendmail_command, **kwargs)
+
+    def deliver(self, msg):
+        self.pipe(msg.as_bytes())
+
+    def pipe(self, data):
+        process = subprocess.run(self.command, input=data, capture_output=True)
+        if process.returncode:
+            raise RuntimeError(
+                f"{self.command[0]} failed with exit code {process.returncode}: "
+                f"{process.stderr.decode(errors='replace').strip()}"
+            )
+
+
+mail_deliveries = {
+    "smtp": SMTPSender,
+    "maildir": MaildirSender,
+    "mbox": MboxSender,
+    "sendmail": SendmailSender,
+}
+
+# Deliveries, which only write the messages into a spool
+spool_deliveries = ["maildir", "mbox"]
+
+
+def get_sender(settings, delivery=None, **kwargs):
+    """
+    Returns the sender for the delivery mode configured in
+    settings.mail_delivery (or the given delivery).
+    """
+    delivery = delivery or settings.mail_delivery
+    try:
+        sender_class = mail_deliveries[delivery]
+    except KeyError:
+        raise UnknownMailDeliveryError(
+            f"Mail delivery {delivery} is unknown, use one of "
+            f"{', '.join(mail_deliveries)}."
+        )
+    return sender_class.from_settings(settings, **kwargs)
+
+
+def hand_off_spool(settings, spool="maildir", command=None, on_handed_off=None):
+    """
+    Pipes all messages of the Maildir or mbox spool into the sendmail command
+    (settings.sendmail_command if not given), so the local MTA delivers them.
+    Messages the command accepted are removed from the spool, the others
+    stay for the next attempt. on_handed_off is called with the headers
+    (email.message.Message) of every message the command accepted.
+
+    Returns the number of messages handed off and the number of failures.
+    """
+    sendmail = SendmailSender(command or settings.sendmail_command)
+    settings.spool_dir.mkdir(parents=True, exist_ok=True)
+    if spool == "mbox":
+        spool_mailbox = mailbox.mbox(settings.spool_dir / SPOOL_MBOX)
+    else:
+        spool_mailbox = mailbox.Maildir(settings.spool_dir / SPOOL_MAILDIR)
+
+    handed_off = failed = 0
+    spool_mailbox.lock()
+    try:
+        for key in list(spool_mailbox.keys()):
+            data = spool_mailbox.get_bytes(key)
+            try:
+                sendmail.pipe(data)
+            except Exception as e:
+                print(f"Could not hand off {key}: {e}")
+                failed += 1
+            else:
+                spool_mailbox.remove(key)
+                handed_off += 1
+                if on_handed_off:
+                    on_handed_off(BytesHeaderParser().parsebytes(data))
+    finally:
+        spool_mailbox.close()
+    return handed_off, failed
+
+
+class RateLimiter:
+    """
+    Spaces out the messages sent by all sessions of an event loop, so no
+    more than per_minute messages are sent per minute. 0 means no limit.
+    """
+
+    def __init__(self, per_minute=0):
+        self.interval = 60 / per_minute if per_minute else 0
+        self.next_slot = 0
+
+    async def wait(self):
+        """
+        Waits until the next message may be sent.
+        """
+        if not self.interval:
+            return
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        await asyncio.sleep(slot - now)
+
+
+async def send_concurrently(
+    messages, create_sender, sessions=1, per_minute=0, on_result=None
+):
+    """
+    Sends messages over several SMTP sessions in parallel.
+
+    Every session is an SMTPSender, whose blocking send runs in a thread,
+    while the messages are taken from the iterable and the results are handled
+    on the event loop, i.e. in the calling thread. Only a few messages are
+    built ahead of the sessions.
+
+    Args:
+        messages: iterable of (key, email.EmailMessage) tuples.
+        create_sender: called without arguments for every session, returns
+                       an SMTPSender.
+        sessions (int): number of parallel SMTP sessions.
+        per_minute (int): messages per minute of all sessions, 0 for no limit.
+        on_result: called with key, accepted (bool) and error (None if accepted)
+                   as soon as the server replied to a message.
+
+    Returns:
+        list: (key, accepted, error) tuples, in the order of the replies.
+    """
+    queue = asyncio.Queue(maxsize=sessions)
+    limiter = RateLimiter(per_minute)
+    results = []
+
+    async def produce():
+        for item in messages:
+            await queue.put(item)
+        for _ in range(sessions):
+            await queue.put(None)
+
+    async def consume():
+        sender = create_sender()
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                key, msg = item
+                await limiter.wait()
+                accepted = await asyncio.to_thread(sender.send, msg)
+                results.append((key, accepted, sender.error))
+                if on_result:
+                    on_result(key, accepted, sender.error)
+        finally:
+            await asyncio.to_thread(sender.close)
+
+    await asyncio.gather(produce(), *[consume() for _ in range(sessions)])
+    return results
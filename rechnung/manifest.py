@@ -0,0 +1,143 @@
+import hashlib
+import yaml
+
+from .helpers import get_template_variables, read_cache, write_cache
+
+# File in settings.cache_dir holding the render manifest
+RENDER_MANIFEST_FILE = "render_manifest.pickle"
+RENDER_MANIFEST_VERSION = 2
+
+# Settings the documents are formatted with, besides the ones their templates read
+RENDER_SETTINGS = ["locale", "arrow_locale"]
+
+# Keys of the yaml data written after rendering, which don't show in the pdf
+UNRENDERED_KEYS = ["sent", "paid"]
+
+
+class RenderManifest:
+    """
+    Records the hashes of the inputs (yaml data, template, stylesheet, logo
+    and the settings) every pdf was rendered from, so only documents with changed
+    inputs need to be rendered again.
+
+    The hash of every input file is kept with its mtime and size, so files
+    which didn't change are neither opened nor hashed again. Yaml data is
+    hashed without the UNRENDERED_KEYS, so marking an invoice as sent or
+    paid doesn't render it again. Of the settings only the ones the template
+    reads (and the RENDER_SETTINGS) are hashed. Pdfs rendered before the
+    manifest existed are taken as up to date once.
+
+    Args:
+        settings: the settings, the manifest is kept in settings.cache_dir.
+    """
+
+    def __init__(self, settings):
+        self.path = settings.cache_dir / RENDER_MANIFEST_FILE
+        manifest = read_cache(self.path, RENDER_MANIFEST_VERSION) or {}
+        self.files = manifest.get("files", {})
+        self.outputs = manifest.get("outputs", {})
+        self.changed = False
+        self.settings = settings
+        self.templates = {
+            str(settings.invoice_template_file),
+            str(settings.contract_template_file),
+        }
+        self.settings_digests = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.save()
+
+    def get_digest(self, path):
+        """
+        Returns the hash of the file contents, None if there is no such file.
+        """
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = self.files.get(str(path))
+        if cached is None or cached[0] != signature:
+            with open(path, "rb") as input_file:
+                data = input_file.read()
+            if path.suffix == ".yaml":
+                data = self.get_rendered_data(data)
+            cached = (signature, hashlib.sha256(data).hexdigest())
+            self.files[str(path)] = cached
+            self.changed = True
+        return cached[1]
+
+    @staticmethod
+    def get_rendered_data(data):
+        """
+        Returns the yaml data without the UNRENDERED_KEYS, serialized in a
+        canonical form.
+        """
+        try:
+            data = yaml.safe_load(data)
+        except yaml.YAMLError:
+            # the file can't be rendered anyway, its contents are hashed as is
+            return data
+        if isinstance(data, dict):
+            data = {k: v for k, v in data.items() if k not in UNRENDERED_KEYS}
+        return yaml.safe_dump(data, sort_keys=True).encode()
+
+    def get_settings_digest(self, template_path):
+        """
+        Returns the hash of the settings the template (None for all templates)
+        reads, and of the RENDER_SETTINGS.
+        """
+        key = str(template_path)
+        if key not in self.settings_digests:
+            if template_path is None:
+                names = set(self.settings._fields)
+            else:
+                variables = get_template_variables(self.settings, template_path)
+                names = variables & set(self.settings._fields)
+            values = self.settings._asdict()
+            used = {name: values[name] for name in sorted(names | set(RENDER_SETTINGS))}
+            self.settings_digests[key] = hashlib.sha256(
+                repr(sorted(used.items())).encode()
+            ).hexdigest()
+        return self.settings_digests[key]
+
+    def get_digests(self, inputs):
+        digests = {str(path): self.get_digest(path) for path in inputs}
+        templates = [path for path in inputs if str(path) in self.templates]
+        for template_path in templates or [None]:
+            digests[f"settings {template_path}"] = self.get_settings_digest(
+                template_path
+            )
+        return digests
+
+    def is_stale(self, pdf_path, inputs):
+        """
+        Checks if the pdf has to be rendered (again), because it is missing,
+        or any of the inputs changed since it was rendered.
+        """
+        if not pdf_path.is_file():
+            return True
+        recorded = self.outputs.get(str(pdf_path))
+        if recorded is None:
+            self.record(pdf_path, inputs)
+            return False
+        return recorded != self.get_digests(inputs)
+
+    def record(self, pdf_path, inputs):
+        """
+        Records the inputs the pdf was rendered from.
+        """
+        self.outputs[str(pdf_path)] = self.get_digests(inputs)
+        self.changed = True
+
+    def save(self):
+        if self.changed:
+            write_cache(
+                self.path,
+                RENDER_MANIFEST_VERSION,
+                {"files": self.files, "outputs": self.outputs},
+            )
+            self.changed = False
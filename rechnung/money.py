@@ -0,0 +1,100 @@
+from array import array
+from collections import namedtuple
+from decimal import Decimal, ROUND_HALF_UP
+
+# Totals of one invoice, all amounts in integer cents
+Totals = namedtuple("Totals", ["subtotals", "net", "vat", "gross"])
+
+
+def to_cents(amount):
+    """
+    Converts an amount in euro (float, int, str or Decimal) to integer cents,
+    rounding half up. Floats are taken by their shortest repr, i.e. 13.37 is
+    1337 cents, not 1336.9999999999998.
+    """
+    if isinstance(amount, int):
+        return amount * 100
+    if isinstance(amount, float):
+        amount = repr(amount)
+    return int((Decimal(amount) * 100).quantize(Decimal(1), ROUND_HALF_UP))
+
+
+def from_cents(cents):
+    """
+    Converts integer cents to an amount in euro, as float (like the amounts
+    in the yaml files). The float is the closest one to the exact amount, so
+    it is written as e.g. 60.21, not 60.209999999999994.
+    """
+    return cents / 100
+
+
+def multiply_cents(price_cents, quantity):
+    """
+    Returns the subtotal of quantity times the price in cents, rounded half up
+    to full cents. Integer quantities are multiplied exactly without Decimal.
+    """
+    if isinstance(quantity, int) or float(quantity).is_integer():
+        return price_cents * int(quantity)
+    if isinstance(quantity, float):
+        quantity = repr(quantity)
+    return int((price_cents * Decimal(quantity)).quantize(Decimal(1), ROUND_HALF_UP))
+
+
+def split_gross(gross_cents, vat):
+    """
+    Splits the gross amount in cents into net and vat, with the vat rate in
+    percent. The net amount is rounded half up, the vat is the rest, so net and
+    vat always add up to the gross amount.
+    """
+    rate = Decimal(repr(vat) if isinstance(vat, float) else vat)
+    net = (Decimal(gross_cents) * 100 / (100 + rate)).quantize(
+        Decimal(1), ROUND_HALF_UP
+    )
+    return int(net), gross_cents - int(net)
+
+
+def compute_totals(invoices_items, vat):
+    """
+    Computes the subtotals and the net, vat and gross totals of many invoices
+    in one batch, in integer cents.
+
+    The items of all invoices are laid out in flat columns (prices, quantities
+    and the offsets where each invoice starts), the subtotals are computed
+    column-wise and summed per invoice, instead of adding floats item by item.
+
+    Args:
+        invoices_items: iterable of the item lists of the invoices, every item
+                        is a dict with price and quantity (default 1).
+        vat: vat rate in percent.
+
+    Returns:
+        list: Totals of every invoice, in the given order.
+    """
+    prices = array("q")
+    quantities = []
+    offsets = array("q", [0])
+    for items in invoices_items:
+        for item in items:
+            prices.append(to_cents(item["price"]))
+            quantities.append(item.get("quantity", 1))
+        offsets.append(len(prices))
+
+    subtotals = array("q", map(multiply_cents, prices, quantities))
+
+    totals = []
+    for start, end in zip(offsets, offsets[1:]):
+        gross = sum(subtotals[start:end])
+        net, vat_cents = split_gross(gross, vat)
+        totals.append(Totals(subtotals[start:end].tolist(), net, vat_cents, gross))
+    return totals
+
+
+def compute_gross_totals(subtotals, vat):
+    """
+    Computes the totals of an invoice whose item subtotals (in euro) are
+    known already, e.g. from the billed items.
+    """
+    subtotals = [to_cents(subtotal) for subtotal in subtotals]
+    gross = sum(subtotals)
+    net, vat_cents = split_gross(gross, vat)
+    return Totals(subtotals, net, vat_cents, gross)
@@ -0,0 +1,171 @@
+import json
+import sqlite3
+import time
+
+# States of the invoice mails in the outbox
+PENDING = "pending"
+SENT = "sent"
+DEFERRED = "deferred"
+FAILED = "failed"
+SPOOLED = "spooled"
+
+
+class Outbox:
+    """
+    Persistent queue of the invoice mails to be sent, in a SQLite database
+    (settings.outbox_db_file).
+
+    Every invoice mail is pending, until it was sent or failed for good.
+    Mails written to the spool are spooled, until hand-off-spool passed them
+    to the local MTA.
+    Mails which failed with a transient error (e.g. the server replied 421
+    or was unreachable) are deferred and retried after settings.outbox_retry_delay
+    seconds, doubling the delay with every attempt, until they failed
+    settings.outbox_max_attempts times.
+
+    As the state is kept across runs, an interrupted run can be resumed: the
+    mails sent already are not touched again, pending and deferred ones are
+    sent by the next run.
+
+    Use it as a context manager to close the database when done.
+    """
+
+    def __init__(self, settings):
+        self.retry_delay = settings.outbox_retry_delay
+        self.max_attempts = settings.outbox_max_attempts
+        self.conn = sqlite3.connect(settings.outbox_db_file)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS outbox (
+                    invoice TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt REAL NOT NULL DEFAULT 0,
+                    error TEXT,
+                    updated REAL NOT NULL
+                )""")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state, next_attempt)"
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def enqueue(self, invoice_id, path):
+        """
+        Queues the mail of the invoice. Pending and deferred mails keep their
+        state, so a resumed run goes on where it stopped, spooled mails are
+        not spooled twice. Sent and failed mails are queued again, as the
+        invoice was selected to be sent anew.
+        """
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO outbox (invoice, path, state, updated) "
+                "VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (invoice) DO UPDATE SET path = excluded.path, "
+                "state = excluded.state, attempts = 0, next_attempt = 0, "
+                "error = NULL, updated = excluded.updated "
+                "WHERE state IN (?, ?)",
+                (invoice_id, str(path), PENDING, time.time(), SENT, FAILED),
+            )
+
+    def get(self, invoice_id):
+        row = self.conn.execute(
+            "SELECT * FROM outbox WHERE invoice = ?", (invoice_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def get_due(self, invoice_ids=None):
+        """
+        Returns the pending mails and the deferred ones due for a retry, of
+        all invoices or just the given ones, ordered by invoice.
+        """
+        # pending mails have next_attempt 0, so they are always due
+        query = "SELECT * FROM outbox WHERE state IN (?, ?) AND next_attempt <= ?"
+        query, parameters = self._select(
+            query, (PENDING, DEFERRED, time.time()), invoice_ids
+        )
+        rows = self.conn.execute(query + " ORDER BY invoice", parameters)
+        return [dict(row) for row in rows]
+
+    def get_next_attempt(self, invoice_ids=None):
+        """
+        Returns the time of the next retry of a deferred mail (of all invoices
+        or just the given ones), None if there is none.
+        """
+        query, parameters = self._select(
+            "SELECT MIN(next_attempt) FROM outbox WHERE state = ?",
+            (DEFERRED,),
+            invoice_ids,
+        )
+        return self.conn.execute(query, parameters).fetchone()[0]
+
+    @staticmethod
+    def _select(query, parameters, invoice_ids):
+        """
+        Restricts the query to the given invoices, passed as one JSON array
+        instead of a parameter per invoice.
+        """
+        if invoice_ids is None:
+            return query, parameters
+        return (
+            query + " AND invoice IN (SELECT value FROM json_each(?))",
+            parameters + (json.dumps(sorted(invoice_ids)),),
+        )
+
+    def set_state(self, invoice_id, state, error=None, attempts=None, next_attempt=0):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE outbox SET state = ?, error = ?, "
+                "attempts = COALESCE(?, attempts), next_attempt = ?, updated = ? "
+                "WHERE invoice = ?",
+                (state, error, attempts, next_attempt, time.time(), invoice_id),
+            )
+
+    def mark_sent(self, invoice_id):
+        self.set_state(invoice_id, SENT)
+
+    def mark_spooled(self, invoice_id):
+        self.set_state(invoice_id, SPOOLED)
+
+    def mark_failed(self, invoice_id, error, transient=False):
+        """
+        Records a failed attempt. Transient failures are deferred with
+        exponential backoff, until the maximum number of attempts is reached.
+
+        Returns the new state of the mail.
+        """
+        attempts = self.get(invoice_id)["attempts"] + 1
+        if transient and attempts < self.max_attempts:
+            next_attempt = time.time() + self.retry_delay * 2 ** (attempts - 1)
+            self.set_state(invoice_id, DEFERRED, str(error), attempts, next_attempt)
+            return DEFERRED
+        self.set_state(invoice_id, FAILED, str(error), attempts)
+        return FAILED
+
+    def get_states(self):
+        """
+        Returns the number of mails per state.
+        """
+        rows = self.conn.execute(
+            "SELECT state, COUNT(*) FROM outbox GROUP BY state ORDER BY state"
+        )
+        return {state: count for state, count in rows}
+
+    def get_failed(self):
+        """
+        Returns the failed and deferred mails, ordered by invoice.
+        """
+        rows = self.conn.execute(
+            "SELECT * FROM outbox WHERE state IN (?, ?) ORDER BY invoice",
+            (FAILED, DEFERRED),
+        )
+        return [dict(row) for row in rows]
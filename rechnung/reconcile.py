@@ -0,0 +1,187 @@
+import re
+import yaml
+
+from collections import defaultdict
+from pathlib import Path
+
+from .catalog import InvoiceCatalog
+from .contract import get_contracts
+from .money import to_cents
+from .transactions import read_csv_files
+
+# Invoice ids as they are found in the subject of a payment, e.g. 1000.2019.10
+INVOICE_ID = re.compile(r"\d+\.\d{4}\.\w+")
+
+
+def normalize_name(name):
+    return " ".join(name.lower().split())
+
+
+def normalize_iban(iban):
+    return iban.replace(" ", "").upper()
+
+
+class PaymentIndex:
+    """
+    Hash indexes over the open invoices, to match payments against them:
+    by invoice id, by amount (in cents), and by customer, whose cids are
+    looked up by IBAN (of the contract, or of earlier payments) and by
+    sender name (of the contract).
+
+    Every payment is matched with a few dictionary lookups, instead of
+    comparing it with every open invoice. The payments entered into paid
+    invoices are known as well, so reconciling a month again doesn't match
+    them twice.
+    """
+
+    def __init__(self, entries, contracts):
+        self.by_id = {}
+        self.by_amount = defaultdict(dict)
+        self.by_cid = defaultdict(dict)
+        self.cids_by_iban = defaultdict(set)
+        self.cids_by_sender = defaultdict(set)
+        self.payments = set()
+
+        for cid, contract in contracts.items():
+            if contract.get("iban"):
+                self.cids_by_iban[normalize_iban(contract["iban"])].add(cid)
+            for name in [contract.get("name"), contract.get("company")]:
+                if name:
+                    self.cids_by_sender[normalize_name(name)].add(cid)
+
+        for entry in entries:
+            if entry["payer_iban"]:
+                iban = normalize_iban(entry["payer_iban"])
+                self.cids_by_iban[iban].add(entry["cid"])
+                self.payments.add(
+                    (entry["paid"], iban, to_cents(entry["total_gross"] or 0))
+                )
+            if entry["paid"] is None and entry["id"] and entry["total_gross"]:
+                self.add(entry)
+
+    def add(self, entry):
+        entry["cents"] = to_cents(entry["total_gross"])
+        self.by_id[entry["id"]] = entry
+        self.by_amount[entry["cents"]][entry["id"]] = entry
+        self.by_cid[entry["cid"]][entry["id"]] = entry
+
+    def remove(self, entry):
+        """
+        Removes the (paid) invoice, so it is not matched again.
+        """
+        del self.by_id[entry["id"]]
+        del self.by_amount[entry["cents"]][entry["id"]]
+        del self.by_cid[entry["cid"]][entry["id"]]
+
+    def is_recorded(self, transaction):
+        """
+        Checks if the payment is entered into a paid invoice already.
+        """
+        key = (
+            str(transaction["date"].date()),
+            normalize_iban(transaction["iban"]),
+            to_cents(transaction["amount"]),
+        )
+        return key in self.payments
+
+    def get_cids(self, transaction):
+        """
+        Returns the cids the sender (or IBAN) of the transaction belongs to.
+        """
+        cids = set(self.cids_by_iban.get(normalize_iban(transaction["iban"]), ()))
+        cids |= self.cids_by_sender.get(normalize_name(transaction["sender"]), set())
+        return cids
+
+    def match(self, transaction):
+        """
+        Matches the transaction against the open invoices.
+
+        Returns the matched invoice (None if there is no certain match) and
+        the candidate invoices, i.e. the payment is ambiguous if there are
+        candidates but no match, and unmatched if there are none.
+        """
+        cents = to_cents(transaction["amount"])
+
+        # an invoice id in the subject is the best hint, if the amount fits
+        candidates = [
+            self.by_id[invoice_id]
+            for invoice_id in INVOICE_ID.findall(transaction["subject"])
+            if invoice_id in self.by_id
+        ]
+        if not candidates:
+            # the open invoices of the sender
+            candidates = [
+                entry
+                for cid in self.get_cids(transaction)
+                for entry in self.by_cid[cid].values()
+            ]
+        fitting = [entry for entry in candidates if entry["cents"] == cents]
+        if len(fitting) == 1:
+            return fitting[0], fitting
+        if candidates:
+            return None, sorted(fitting or candidates, key=lambda e: e["id"])
+
+        # the amount alone is no proof, such payments are reported as ambiguous
+        return None, sorted(self.by_amount[cents].values(), key=lambda e: e["id"])
+
+
+def mark_paid(invoice_path, transaction, catalog):
+    """
+    Enters the payment into the invoice yaml file.
+    """
+    with open(invoice_path) as yaml_file:
+        invoice_data = yaml.safe_load(yaml_file)
+    invoice_data["paid"] = {
+        "date": transaction["date"].date(),
+        "amount": transaction["amount"],
+        "sender": transaction["sender"],
+        "iban": transaction["iban"],
+    }
+    with open(invoice_path, "w") as yaml_file:
+        yaml_file.write(yaml.dump(invoice_data, default_flow_style=False))
+    catalog.update(invoice_path, invoice_data)
+
+
+def format_payment(transaction):
+    return "{} {:.2f}€ from {}".format(
+        transaction["date"].strftime("%d.%m.%Y"),
+        transaction["amount"],
+        transaction["sender"],
+    )
+
+
+def reconcile(settings, year, month, dry=False):
+    """
+    Matches the incoming payments of a month (see read_csv_files) against
+    the open invoices, and marks the matched invoices as paid. Ambiguous and
+    unmatched payments are reported, to be checked by hand.
+
+    Returns the numbers of matched, ambiguous and unmatched payments.
+    """
+    contracts = get_contracts(settings)
+    matched, ambiguous, unmatched = 0, 0, 0
+    with InvoiceCatalog(settings) as catalog:
+        index = PaymentIndex(catalog.select(), contracts)
+        for transaction in read_csv_files(settings, year, month):
+            if transaction["amount"] <= 0 or index.is_recorded(transaction):
+                continue
+            entry, candidates = index.match(transaction)
+            if entry is not None:
+                print(f"Matched {format_payment(transaction)} to {entry['id']}")
+                index.remove(entry)
+                if not dry:
+                    mark_paid(Path(entry["path"]), transaction, catalog)
+                matched += 1
+            elif candidates:
+                ids = ", ".join(sorted({entry["id"] for entry in candidates}))
+                print(f"Ambiguous {format_payment(transaction)}, candidates: {ids}")
+                ambiguous += 1
+            else:
+                print(
+                    f"Unmatched {format_payment(transaction)}: "
+                    f"{transaction['subject'].strip()}"
+                )
+                unmatched += 1
+
+    print(f"Matched {matched} payments, {ambiguous} ambiguous, {unmatched} unmatched.")
+    return matched, ambiguous, unmatched
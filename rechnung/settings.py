@@ -46,8 +46,23 @@ optional_settings = {
     "invoices_dir": "invoices",
     "logo_asset_file": "logo.svg",
     "policy_attachment_asset_file": "policy.pdf",
+    "print_run_template_file": "print_run_template.j2.html",
     "billed_items_dir": "billed_items",
+    "billed_items_backend": "yaml",
+    "billed_items_db_file": "billed_items.sqlite3",
+    "cache_dir": "cache",
     "arrow_locale": "de",
+    "smtp_port": 587,
+    "smtp_messages_per_connection": 100,
+    "smtp_starttls": True,
+    "smtp_sessions": 1,
+    "smtp_messages_per_minute": 0,
+    "mail_delivery": "smtp",
+    "spool_dir": "spool",
+    "sendmail_command": "sendmail -t -oi",
+    "outbox_db_file": "outbox.sqlite3",
+    "outbox_retry_delay": 60,
+    "outbox_max_attempts": 5,
 }
 possible_settings = set(required_settings + list(optional_settings.keys()))
 
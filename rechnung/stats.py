@@ -0,0 +1,70 @@
+from .contract import format_month, get_active_months
+from .money import compute_totals, from_cents
+
+# Columns of the revenue time series
+REVENUE_SERIES_FIELDS = ["month", "active", "new", "churned", "churn_rate", "mrr"]
+
+
+def get_revenue_series(contracts, vat, first, last):
+    """
+    Computes the monthly recurring revenue (gross), the number of active,
+    new and churned contracts and the churn rate for every month from first
+    to last (month indices, see month_index).
+
+    Every contract is turned into two events, its first active month and the
+    month after its last one, which are added up in month buckets. A single
+    sweep (prefix sum) over the buckets gives the series, instead of checking
+    all contracts for every month.
+
+    Args:
+        contracts: iterable of contract dicts.
+        vat: vat rate in percent.
+
+    Returns:
+        list: dicts with the REVENUE_SERIES_FIELDS, one per month.
+    """
+    contracts = list(contracts)
+    # the sweep starts a month early, to know the contracts churned in first
+    base = first - 1
+    buckets = last - base + 1
+    # the changes of active contracts and revenue, new and churned contracts
+    active_delta = [0] * (buckets + 1)
+    revenue_delta = [0] * (buckets + 1)
+    new = [0] * (buckets + 1)
+    churned = [0] * (buckets + 1)
+
+    totals = compute_totals((contract["items"] for contract in contracts), vat)
+    for contract, contract_totals in zip(contracts, totals):
+        start, end = get_active_months(contract)
+        stop = end + 1 if end is not None else None
+        if start > last or (stop is not None and (stop <= base or stop <= start)):
+            continue
+        bucket = max(start, base) - base
+        active_delta[bucket] += 1
+        revenue_delta[bucket] += contract_totals.gross
+        if start >= first:
+            new[bucket] += 1
+        if stop is not None and stop <= last:
+            active_delta[stop - base] -= 1
+            revenue_delta[stop - base] -= contract_totals.gross
+            churned[stop - base] += 1
+
+    series = []
+    active = revenue = 0
+    for n in range(buckets):
+        previous = active
+        active += active_delta[n]
+        revenue += revenue_delta[n]
+        if n == 0:
+            continue
+        series.append(
+            {
+                "month": format_month(base + n),
+                "active": active,
+                "new": new[n],
+                "churned": churned[n],
+                "churn_rate": round(churned[n] / previous, 4) if previous else 0.0,
+                "mrr": from_cents(revenue),
+            }
+        )
+    return series
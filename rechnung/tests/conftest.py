@@ -1,6 +1,9 @@
+import asyncio
 import pytest
 import rechnung.cli as cli
 import rechnung.settings as settings
+import socketserver
+import threading
 import yaml
 
 from click.testing import CliRunner
@@ -58,3 +61,178 @@ def cli_billed_tests_data_path(tmp_path_factory):
     copytree(Path("rechnung/tests/fixtures"), cli_path)
     cli.cwd = cli_path
     return cli.cli1, cli_path
+
+
+@pytest.fixture
+def fixtures_path(tmp_path):
+    """
+    Returns the click.CommandGroup of cli.py and a fresh copy of the test fixtures
+    for tests which change the data in ways the session fixtures can't share.
+    """
+    path = tmp_path / "rechnung_fixtures"
+    copytree(Path("rechnung/tests/fixtures"), path)
+    cli.cwd = path
+    return cli.cli1, path
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks just enough SMTP to accept messages, see SMTPSink.
+    """
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        sink = self.server
+        sink.connections += 1
+        accepted = 0
+        self.reply("220 localhost SMTP sink")
+        for line in self.rfile:
+            command = line.decode().strip().upper()
+            if command.startswith("EHLO"):
+                self.reply("250-localhost")
+                self.reply("250 AUTH PLAIN")
+            elif command.startswith("AUTH"):
+                sink.logins += 1
+                self.reply("235 Authentication successful")
+            elif command.startswith("MAIL"):
+                if sink.busy_replies:
+                    sink.busy_replies -= 1
+                    self.reply("421 Too many messages, closing channel")
+                    return
+                self.reply("250 OK")
+            elif command.startswith("DATA"):
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = b"".join(iter(self.rfile.readline, b".\r\n"))
+                sink.messages.append(data)
+                accepted += 1
+                self.reply("250 OK")
+                if accepted == sink.close_after:
+                    return
+            elif command.startswith("QUIT"):
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """
+    Local SMTP server which stores all messages it receives.
+
+    Set busy_replies to answer that many MAIL commands with 421 and close,
+    set close_after to drop every connection after that many messages.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), SMTPSinkHandler)
+        self.port = self.server_address[1]
+        self.messages = []
+        self.connections = 0
+        self.logins = 0
+        self.busy_replies = 0
+        self.close_after = None
+
+
+@pytest.fixture
+def smtp_sink():
+    """
+    Returns a running SMTPSink, listening on a free port of localhost.
+    """
+    sink = SMTPSink()
+    thread = threading.Thread(target=sink.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield sink
+    sink.shutdown()
+    sink.server_close()
+
+
+class AsyncSMTPStub:
+    """
+    Local SMTP server on an asyncio event loop in its own thread, which
+    answers every message only after latency seconds, like a remote relay.
+
+    It counts the sessions open at the same time (max_sessions), refuses
+    the recipients in reject with 550 and the recipients in greylist with 450,
+    as often as given.
+    """
+
+    def __init__(self, latency=0.0, reject=(), greylist=None):
+        self.latency = latency
+        self.reject = set(reject)
+        self.greylist = dict(greylist or {})
+        self.messages = []
+        self.sessions = 0
+        self.max_sessions = 0
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self.server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self.handle, "127.0.0.1", 0), self.loop
+        ).result()
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def stop(self):
+        self.server.close()
+        asyncio.run_coroutine_threadsafe(self.server.wait_closed(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def handle(self, reader, writer):
+        self.sessions += 1
+        self.max_sessions = max(self.max_sessions, self.sessions)
+
+        async def reply(line):
+            writer.write(f"{line}\r\n".encode())
+            await writer.drain()
+
+        try:
+            await reply("220 localhost SMTP stub")
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode().strip()
+                verb = command[:4].upper()
+                if verb == "RCPT":
+                    address = command.split(":", 1)[1].strip().strip("<>")
+                    if address in self.reject:
+                        await reply("550 No such user")
+                    elif self.greylist.get(address):
+                        self.greylist[address] -= 1
+                        await reply("450 Greylisted, try again later")
+                    else:
+                        await reply("250 OK")
+                elif verb == "DATA":
+                    await reply("354 End data with <CR><LF>.<CR><LF>")
+                    data = []
+                    while (line := await reader.readline()) != b".\r\n":
+                        data.append(line)
+                    await asyncio.sleep(self.latency)
+                    self.messages.append(b"".join(data))
+                    await reply("250 OK")
+                elif verb == "QUIT":
+                    await reply("221 Bye")
+                    break
+                else:
+                    await reply("250 OK")
+        finally:
+            self.sessions -= 1
+            writer.close()
+
+
+@pytest.fixture
+def async_smtp_stub():
+    """
+    Returns a running AsyncSMTPStub with 0.2 seconds latency per message.
+    """
+    stub = AsyncSMTPStub(latency=0.2)
+    stub.start()
+    yield stub
+    stub.stop()
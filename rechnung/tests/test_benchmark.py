@@ -0,0 +1,75 @@
+import json
+import rechnung.benchmark as benchmark
+import rechnung.settings as settings
+import yaml
+
+from click.testing import CliRunner
+
+
+def test_generate_dataset(fixtures_path, tmp_path):
+    cli1, path = fixtures_path
+    locale = settings.get_settings_from_cwd(path).locale
+
+    s = benchmark.generate_dataset(tmp_path / "data", 5, 3, 2, "2019-11", locale, 0, 20)
+
+    assert len(list(s.contracts_dir.glob("*.yaml"))) == 5
+    assert len(list(s.invoices_dir.glob("*/*.yaml"))) == 5 * 2
+    with open(s.billed_items_dir / "10004.yaml") as infile:
+        billed_items = yaml.safe_load(infile)
+    assert [item["key"] for item in billed_items][-1] == "2020-01"
+    assert {item["invoice"] for item in billed_items} == {
+        "10004.2019.11",
+        "10004.2019.12",
+        None,
+    }
+
+    with open(s.csv_dir / "gls" / "202002.csv", encoding="iso-8859-1") as infile:
+        assert len(infile.read().splitlines()) == 1 + 20 * 2
+
+    again = benchmark.generate_dataset(tmp_path / "again", 5, 3, 2, "2019-11", locale)
+    for contract_path in s.contracts_dir.glob("*.yaml"):
+        assert (
+            contract_path.read_text()
+            == (again.contracts_dir / contract_path.name).read_text()
+        )
+
+
+def test_benchmark_run(fixtures_path, tmp_path):
+    cli1, path = fixtures_path
+    locale = settings.get_settings_from_cwd(path).locale
+    data_path = tmp_path / "data"
+    benchmark.generate_dataset(data_path, 3, 2, 1, "2019-11", locale)
+
+    runner = CliRunner()
+    result = runner.invoke(
+        benchmark.benchmark,
+        [
+            "run",
+            str(data_path),
+            "-o",
+            str(tmp_path / "results.json"),
+            "-r",
+            "2",
+            "-s",
+            "print-stats",
+            "-s",
+            "bill-items",
+            "-s",
+            "create-billed-invoices",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+
+    with open(tmp_path / "results.json") as infile:
+        results = json.load(infile)
+    assert results["dataset"]["contracts"] == 3
+    assert list(results["stages"]) == [
+        "print-stats",
+        "bill-items",
+        "create-billed-invoices",
+    ]
+    for stage in results["stages"].values():
+        assert len(stage["runs"]) == 2
+        assert not stage["failed"]
+    # every repetition works on a fresh copy of the data set
+    assert len(list((data_path / "invoices").glob("*/*.yaml"))) == 3
@@ -22,6 +22,7 @@ import yaml
 from click.testing import CliRunner
 from shutil import copytree
 from pathlib import Path
+from rechnung.billed_items import YamlBilledItemsStore
 
 
 def test_billed_invoice_without_billed_items(cli_billed_tests_data_path):
@@ -63,7 +64,6 @@ def test_billed_items(cli_billed_tests_data_path):
     result = runner.invoke(cli1, ["bill-items", "2019", "10"])
     expected_results = [
         "Billing items for month 10 in 2019.",
-        "Ignoring 1001 with start 2030-06-01",
         "Billing items for 1000.",
         "Billing items for 1002.",
     ]
@@ -75,7 +75,6 @@ def test_billed_items(cli_billed_tests_data_path):
     result = runner.invoke(cli1, ["bill-items", "2019", "10"])
     expected_results = [
         "Billing items for month 10 in 2019.",
-        "Ignoring 1001 with start 2030-06-01",
         "Billing items for 1000.",
         "2019-10 already billed for 1000",
         "Billing items for 1002.",
@@ -197,3 +196,54 @@ def test_create_billed_invoices(cli_billed_tests_data_path):
         billed_items_1002 = yaml.safe_load(infile)
         for billed_item in billed_items_1002:
             assert billed_item['invoice'] == '1002.2019.Q4'
+
+
+def test_bill_items_range(fixtures_path, monkeypatch):
+    """
+    Tests if bill-items --from/--to bills all missing months in order, writing
+    the billed items of every customer once.
+    """
+    cli1, path = fixtures_path
+    s = settings.get_settings_from_cwd(path)
+    runner = CliRunner()
+    result = runner.invoke(cli1, ["bill-items", "2019", "10"])
+    assert result.exit_code == 0, result.output
+
+    writes = []
+    add_items = YamlBilledItemsStore.add_items
+
+    def counting_add_items(store, cid, billed_items):
+        writes.append(cid)
+        return add_items(store, cid, billed_items)
+
+    monkeypatch.setattr(YamlBilledItemsStore, "add_items", counting_add_items)
+    # the billed keys are read once per customer, not for every month
+    monkeypatch.setattr(YamlBilledItemsStore, "is_billed", None)
+    result = runner.invoke(cli1, ["bill-items", "--from", "2019-10", "--to", "2019-12"])
+    assert result.exit_code == 0, result.output
+    assert "Billing items for months 2019-10 to 2019-12." in result.output
+    assert "2019-10 already billed for 1000" in result.output
+    assert "Billing items for 1001." not in result.output
+    assert writes == ["1000", "1002"]
+
+    for cid in ["1000", "1002"]:
+        with open(s.billed_items_dir / f"{cid}.yaml") as infile:
+            billed_items = yaml.safe_load(infile)
+        golden_master_path = Path(
+            f"rechnung/tests/golden_masters/billed_items_{cid}.yaml"
+        )
+        with open(golden_master_path) as infile:
+            assert billed_items == yaml.safe_load(infile)
+
+    result = runner.invoke(cli1, ["bill-items", "--from", "2019-11", "--to", "2019-12"])
+    assert writes == ["1000", "1002"]
+
+    result = runner.invoke(cli1, ["bill-items", "--to", "2019-12"])
+    assert result.exit_code == 2
+    result = runner.invoke(cli1, ["bill-items", "2019", "11", "--from", "2019-10"])
+    assert result.exit_code == 2
+    assert "not both" in result.output
+    for month in ["2019", "2019-13", "19-1"]:
+        result = runner.invoke(cli1, ["bill-items", "--from", month])
+        assert result.exit_code == 2
+        assert f"{month} is no month (YYYY-MM)." in result.output
@@ -0,0 +1,107 @@
+"""
+Tests the SQLite billed items backend, by migrating the billed items of
+the fixtures and running the billing workflow on the migrated data.
+"""
+
+import pytest
+import rechnung.settings as settings
+import yaml
+
+from click.testing import CliRunner
+from pathlib import Path
+from rechnung.billed_items import get_billed_items_store
+
+
+def use_backend(path, backend):
+    settings_path = path / "settings.yaml"
+    settings_data = yaml.safe_load(settings_path.read_text())
+    settings_data["billed_items_backend"] = backend
+    settings_path.write_text(yaml.dump(settings_data))
+    return settings.get_settings_from_cwd(path)
+
+
+def test_migrate_billed_items(fixtures_path):
+    """
+    Tests if the migration copies the billed items unchanged, and can be repeated.
+    """
+    cli1, path = fixtures_path
+    s = settings.get_settings_from_cwd(path)
+    runner = CliRunner()
+    for _ in range(2):
+        result = runner.invoke(cli1, ["migrate-billed-items"])
+        assert "Migrated billed items of 1 customers from yaml to sqlite." in (
+            result.output
+        )
+
+    with open(s.billed_items_dir / "1000.yaml") as infile:
+        billed_items_1000 = yaml.safe_load(infile)
+    with get_billed_items_store(s, "sqlite") as store:
+        assert store.get_cids() == ["1000"]
+        assert store.get_items("1000") == billed_items_1000
+
+
+def test_sqlite_billing_workflow(fixtures_path):
+    """
+    Tests if billing and invoicing with the SQLite backend gives the same
+    results as with the yaml files.
+    """
+    cli1, path = fixtures_path
+    runner = CliRunner()
+    runner.invoke(cli1, ["migrate-billed-items"])
+    s = use_backend(path, "sqlite")
+
+    for month in ["10", "11", "12"]:
+        runner.invoke(cli1, ["bill-items", "2019", month])
+    result = runner.invoke(cli1, ["bill-items", "2019", "10"])
+    assert "2019-10 already billed for 1000" in result.output
+    assert "2019-10 already billed for 1002" in result.output
+    assert not (s.billed_items_dir / "1002.yaml").is_file()
+
+    with get_billed_items_store(s) as store:
+        assert store.get_keys("1002") == {"2019-10", "2019-11", "2019-12"}
+        for cid in ["1000", "1002"]:
+            with open(
+                Path(f"rechnung/tests/golden_masters/billed_items_{cid}.yaml")
+            ) as infile:
+                assert store.get_items(cid) == yaml.safe_load(infile)
+
+    runner.invoke(cli1, ["create-billed-invoices", "2019.Q4"])
+    with open(s.invoices_dir / "1002" / "1002.2019.Q4.yaml") as infile:
+        invoice = yaml.safe_load(infile)
+        assert len(invoice["items"]) == 6
+        assert invoice["total_gross"] == 145.35
+    with get_billed_items_store(s) as store:
+        assert not store.get_open_items("1000")
+        assert all(i["invoice"] == "1002.2019.Q4" for i in store.get_items("1002"))
+
+
+def test_billed_items_index(fixtures_path, monkeypatch):
+    """
+    Tests if the index of the yaml backend answers billing and invoicing
+    lookups without parsing the billed items, and notices manual changes.
+    """
+    cli1, path = fixtures_path
+    s = settings.get_settings_from_cwd(path)
+    runner = CliRunner()
+    runner.invoke(cli1, ["bill-items", "2019", "10"])
+
+    with get_billed_items_store(s) as store:
+        billed_items_1000 = store.get_items("1000")
+        monkeypatch.setattr(store, "get_items", None)
+        assert store.is_billed("1000", "2019-10")
+        assert not store.is_billed("1000", "2019-11")
+        assert store.get_keys("1000") == {"2019-9", "2019-10"}
+        assert [ref for ref, _ in store.get_open_items("1000")] == [2, 3]
+        store.add_items("1000", billed_items_1000[2:])
+        assert [ref for ref, _ in store.get_open_items("1000")] == [2, 3, 4, 5]
+        monkeypatch.undo()
+        assert store.get_items("1000")[4:] == billed_items_1000[2:]
+
+    # The index is rebuilt, after the billed items file was edited
+    (s.billed_items_dir / "1000.yaml").write_text(yaml.dump(billed_items_1000[:2]))
+    with get_billed_items_store(s) as store:
+        assert not store.is_billed("1000", "2019-10")
+        assert not store.get_open_items("1000")
+
+    result = runner.invoke(cli1, ["rebuild-billed-items-index"])
+    assert "Rebuilt billed items index of 2 customers." in result.output
@@ -0,0 +1,105 @@
+import rechnung.catalog as catalog
+import rechnung.settings as settings
+import yaml
+
+from click.testing import CliRunner
+
+
+def count_yaml_loads(monkeypatch):
+    """
+    Counts the invoice yaml files the catalog parses.
+    """
+    loads = []
+    safe_load = yaml.safe_load
+
+    def counting_safe_load(stream):
+        loads.append(stream.name)
+        return safe_load(stream)
+
+    monkeypatch.setattr(catalog.yaml, "safe_load", counting_safe_load)
+    return loads
+
+
+def test_invoice_catalog(fixtures_path, monkeypatch):
+    """
+    Tests if invoices are selected from the catalog, without parsing the
+    invoice files again, and if changes made by hand are found by a rebuild,
+    or when customer directories are added.
+    """
+    cli1, path = fixtures_path
+    s = settings.get_settings_from_cwd(path)
+    runner = CliRunner()
+    runner.invoke(cli1, ["create-invoices", "2019", "10"])
+    runner.invoke(cli1, ["create-invoices", "2019", "11"])
+
+    loads = count_yaml_loads(monkeypatch)
+    with catalog.InvoiceCatalog(s) as invoice_catalog:
+        selected = invoice_catalog.select(2019, 10)
+        assert [entry["id"] for entry in selected] == ["1000.2019.10", "1002.2019.10"]
+        assert [e["id"] for e in invoice_catalog.select(suffix="2019.11")] == [
+            "1000.2019.11",
+            "1002.2019.11",
+        ]
+        assert len(invoice_catalog.select(cid_only="1002")) == 2
+        assert invoice_catalog.select(suffix="201?.11") == []
+        assert len(invoice_catalog.select(suffix="2019")) == 4
+        assert invoice_catalog.select(suffix="2019.1") == []
+        for query, parameters in [
+            ("suffix = ?", ["2019.10"]),
+            ("(suffix = ? OR suffix GLOB ?)", ["2019", "2019.*"]),
+        ]:
+            plan = invoice_catalog.conn.execute(
+                f"EXPLAIN QUERY PLAN SELECT * FROM invoices WHERE {query}",
+                parameters,
+            ).fetchall()
+            details = [step["detail"] for step in plan]
+            assert not [detail for detail in details if detail.startswith("SCAN")]
+            assert any("invoices_suffix" in detail for detail in details)
+        assert selected[0]["total_gross"] == 60.21
+        assert not selected[0]["sent"]
+        assert not loads
+
+        # mark an invoice as sent by hand
+        invoice_1000 = s.invoices_dir / "1000" / "1000.2019.10.yaml"
+        with open(invoice_1000) as infile:
+            invoice_data = yaml.safe_load(infile)
+        invoice_data["sent"] = True
+        with open(invoice_1000, "w") as outfile:
+            yaml.dump(invoice_data, outfile)
+        # remove one and copy one into the directory by hand
+        (s.invoices_dir / "1002" / "1002.2019.11.yaml").unlink()
+        invoice_data["id"] = "1000.2019.Q4"
+        with open(s.invoices_dir / "1000" / "1000.2019.Q4.yaml", "w") as outfile:
+            yaml.dump(invoice_data, outfile)
+        loads.clear()
+
+        # without a rebuild the catalog doesn't look at the files
+        selected = invoice_catalog.select(2019, 10)
+        assert [entry["sent"] for entry in selected] == [0, 0]
+        assert len(invoice_catalog.select(suffix="2019.11")) == 2
+        assert not loads
+
+        invoice_catalog.rebuild()
+        loads.clear()
+        selected = invoice_catalog.select(2019, 10)
+        assert [entry["sent"] for entry in selected] == [1, 0]
+        assert invoice_catalog.select(suffix="2019.Q4")[0]["id"] == "1000.2019.Q4"
+        assert len(invoice_catalog.select(suffix="2019.11")) == 1
+        assert not loads
+
+        # a new customer directory is found
+        (s.invoices_dir / "1003").mkdir()
+        invoice_data["id"] = "1003.2019.10"
+        with open(s.invoices_dir / "1003" / "1003.2019.10.yaml", "w") as outfile:
+            yaml.dump(invoice_data, outfile)
+        selected = invoice_catalog.select(2019, 10)
+        assert [entry["id"] for entry in selected][-1] == "1003.2019.10"
+        assert [name.split("/")[-1] for name in loads] == ["1003.2019.10.yaml"]
+
+
+def test_rebuild_invoice_catalog(fixtures_path):
+    cli1, path = fixtures_path
+    runner = CliRunner()
+    runner.invoke(cli1, ["create-invoices", "2019", "10"])
+    result = runner.invoke(cli1, ["rebuild-invoice-catalog"])
+    assert "Rebuilt invoice catalog with 2 invoices." in result.output
@@ -36,7 +36,7 @@ def test_init_files_directories(initialized_path):
 
 def test_print_stats(cli_test_data_path):
     """
-    Test the print-stats function. 
+    Test the print-stats function.
     It checks if the amount of active contracts and the total income per month is calculated
     correctly.
     """
@@ -98,7 +98,6 @@ def test_invoice_create_force(cli_test_data_path):
     runner = CliRunner()
     result = runner.invoke(cli1, ["create-invoices", "2019", "10"])
     expected_results = [
-        "Ignoring 1001 with start 2030-06-01",
         "Creating invoice yaml 1000.2019.10",
         "invoices/1000/1000.2019.10.yaml already exists.",
         "Creating invoice yaml 1002.2019.10",
@@ -135,3 +134,116 @@ def test_invoice_render(cli_test_data_path):
     assert path.joinpath(s.invoices_dir, "1000", "1000.2019.10.pdf").is_file()
     assert not path.joinpath(s.invoices_dir, "1001", "1001.2019.10.pdf").is_file()
     assert path.joinpath(s.invoices_dir, "1002", "1002.2019.10.pdf").is_file()
+    # both invoices are rendered with a single parse of the stylesheet
+    assert "Rendered 2 invoices with 1 stylesheet parses (1 avoided" in result.output
+
+
+def test_invoice_render_jobs(cli_test_data_path):
+    """
+    Tests if render-all with several worker processes renders the same invoices,
+    and reports them in the order of the invoice files.
+    """
+    cli1, path = cli_test_data_path
+    s = settings.get_settings_from_cwd(path)
+    invoice_1000_pdf = path.joinpath(s.invoices_dir, "1000", "1000.2019.10.pdf")
+    invoice_1002_pdf = path.joinpath(s.invoices_dir, "1002", "1002.2019.10.pdf")
+    invoice_1000_pdf.unlink()
+    invoice_1002_pdf.unlink()
+    runner = CliRunner()
+    result = runner.invoke(cli1, ["render-all", "--jobs", "2"])
+    assert invoice_1000_pdf.is_file()
+    assert invoice_1002_pdf.is_file()
+    assert result.output.index("Rendered invoice pdf for 1000.2019.10") < (
+        result.output.index("Rendered invoice pdf for 1002.2019.10")
+    )
+
+
+def test_render_manifest(fixtures_path):
+    """
+    Tests if render-all renders exactly the documents whose inputs changed
+    since they were rendered.
+    """
+    cli1, path = fixtures_path
+    s = settings.get_settings_from_cwd(path)
+    runner = CliRunner()
+    runner.invoke(cli1, ["create-invoices", "2019", "10"])
+    result = runner.invoke(cli1, ["render-all"])
+    assert "Rendered invoice pdf for 1000.2019.10" in result.output
+
+    result = runner.invoke(cli1, ["render-all"])
+    assert "Rendered invoice" not in result.output
+
+    invoice_1000_yaml = path.joinpath(s.invoices_dir, "1000", "1000.2019.10.yaml")
+    with open(invoice_1000_yaml, "a") as outfile:
+        outfile.write("notice: Thank you!\n")
+    result = runner.invoke(cli1, ["render-all"])
+    assert "Invoice {} is outdated".format(invoice_1000_yaml.with_suffix(".pdf")) in (
+        result.output
+    )
+    assert "Rendered invoice pdf for 1000.2019.10" in result.output
+    assert "Rendered invoice pdf for 1002.2019.10" not in result.output
+
+    # sending, paying and settings the templates don't read change nothing
+    with open(invoice_1000_yaml) as infile:
+        invoice_data = yaml.safe_load(infile)
+    invoice_data["sent"] = True
+    invoice_data["paid"] = {"date": "2019-11-04", "amount": 60.21}
+    with open(invoice_1000_yaml, "w") as outfile:
+        yaml.dump(invoice_data, outfile)
+    settings_path = path / settings.SETTINGS_FILE
+    settings_data = yaml.safe_load(settings_path.read_text())
+    settings_data["smtp_sessions"] = 4
+    settings_data["password"] = "secret"
+    settings_path.write_text(yaml.dump(settings_data))
+    result = runner.invoke(cli1, ["render-all"])
+    assert "Rendered invoice" not in result.output
+
+    with open(s.invoice_template_file, "a") as outfile:
+        outfile.write("{{ company_name }}\n")
+    result = runner.invoke(cli1, ["render-all"])
+    assert "Rendered 2 invoices" in result.output
+    settings_data["company_name"] = "Westnetz"
+    settings_path.write_text(yaml.dump(settings_data))
+    result = runner.invoke(cli1, ["render-all"])
+    assert "Rendered 2 invoices" in result.output
+
+    with open(s.invoice_css_asset_file, "a") as outfile:
+        outfile.write("\n/* changed */\n")
+    result = runner.invoke(cli1, ["render-all"])
+    assert "Rendered 2 invoices" in result.output
+
+
+def test_render_print_run(fixtures_path):
+    """
+    Tests if the invoices of a period are rendered into one pdf, with all or
+    just the postal invoices.
+    """
+    cli1, path = fixtures_path
+    s = settings.get_settings_from_cwd(path)
+    runner = CliRunner()
+    runner.invoke(cli1, ["create-invoices", "2019", "10"])
+    result = runner.invoke(cli1, ["render-print-run", "2019.10"])
+    assert result.exit_code == 0, result.output
+    assert "Wrote 2 invoices with" in result.output
+    print_run_pdf = s.invoices_dir / "print_run.2019.10.pdf"
+    assert print_run_pdf.read_bytes().startswith(b"%PDF")
+    # the single pdfs are not needed
+    assert not (s.invoices_dir / "1000" / "1000.2019.10.pdf").is_file()
+
+    with open(s.contracts_dir / "1002.yaml") as infile:
+        contract = yaml.safe_load(infile)
+    contract["postal"] = True
+    with open(s.contracts_dir / "1002.yaml", "w") as outfile:
+        yaml.dump(contract, outfile)
+    output = path / "postal.pdf"
+    result = runner.invoke(
+        cli1, ["render-print-run", "2019.10", "--postal", "-o", str(output)]
+    )
+    assert "Laid out invoice 1002.2019.10" in result.output
+    assert "Laid out invoice 1000.2019.10" not in result.output
+    assert "Wrote 1 invoices with" in result.output
+    assert output.is_file()
+
+    result = runner.invoke(cli1, ["render-print-run", "2019.11"])
+    assert result.exit_code == 1
+    assert "No invoices to print for 2019.11" in result.output
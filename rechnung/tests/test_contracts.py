@@ -0,0 +1,96 @@
+import pytest
+import rechnung.contract as contract
+import rechnung.settings as settings
+import yaml
+
+from click.testing import CliRunner
+
+
+def count_yaml_loads(monkeypatch):
+    loads = []
+    safe_load = yaml.safe_load
+
+    def counting_safe_load(stream):
+        if "contracts" in getattr(stream, "name", ""):
+            loads.append(stream.name)
+        return safe_load(stream)
+
+    monkeypatch.setattr(contract.yaml, "safe_load", counting_safe_load)
+    return loads
+
+
+def test_contract_cache(fixtures_path, monkeypatch):
+    """
+    Tests if contracts are parsed once, and only parsed again after a change.
+    """
+    cli1, path = fixtures_path
+    s = settings.get_settings_from_cwd(path)
+    loads = count_yaml_loads(monkeypatch)
+
+    contracts = contract.get_contracts(s)
+    assert list(contracts) == ["1000", "1001", "1002"]
+    assert len(loads) == 3
+    assert s.cache_dir.joinpath(contract.CONTRACTS_CACHE_FILE).is_file()
+
+    assert contract.get_contracts(s) == contracts
+    assert len(loads) == 3
+
+    contract_path = s.contracts_dir / "1001.yaml"
+    contract_data = yaml.safe_load(contract_path.read_text())
+    contract_data["name"] = "Mike Murks-Meier"
+    contract_path.write_text(yaml.dump(contract_data))
+    s.contracts_dir.joinpath("1002.yaml").unlink()
+
+    contracts = contract.get_contracts(s)
+    assert len(loads) == 4
+    assert list(contracts) == ["1000", "1001"]
+    assert contracts["1001"]["name"] == "Mike Murks-Meier"
+
+
+def test_contract_no_cache(fixtures_path, monkeypatch):
+    """
+    Tests if --no-cache parses all contracts and doesn't write a cache.
+    """
+    cli1, path = fixtures_path
+    s = settings.get_settings_from_cwd(path)
+    loads = count_yaml_loads(monkeypatch)
+    runner = CliRunner()
+    result = runner.invoke(cli1, ["print-contracts", "--no-cache"])
+    assert result.output.startswith("1000: Martha Muster")
+    result = runner.invoke(cli1, ["print-contracts", "--no-cache"])
+    assert len(loads) == 6
+    assert not s.cache_dir.joinpath(contract.CONTRACTS_CACHE_FILE).exists()
+
+
+def test_contract_index(fixtures_path, monkeypatch):
+    """
+    Tests if the active contracts of a month are looked up in the index,
+    which is kept in the contract cache.
+    """
+    cli1, path = fixtures_path
+    s = settings.get_settings_from_cwd(path)
+
+    contracts, index = contract.get_contract_index(s)
+    assert index.get_active_cids(2019, 5) == ()
+    assert index.get_active_cids(2019, 6) == ("1000", "1002")
+    assert index.get_active_cids(2030, 6) == ("1000", "1001", "1002")
+    for year in range(2018, 2032):
+        for month in range(1, 13):
+            assert list(index.get_active_cids(year, month)) == [
+                cid
+                for cid, data in contracts.items()
+                if contract.is_active(data, year, month)
+            ]
+
+    # the index is read from the cache, and rebuilt after a change
+    monkeypatch.setattr(contract, "get_active_months", None)
+    assert list(contract.get_contracts(s, 2019, 10)) == ["1000", "1002"]
+    monkeypatch.undo()
+    contract_path = s.contracts_dir / "1002.yaml"
+    contract_data = yaml.safe_load(contract_path.read_text())
+    contract_data["end"] = "2019-09-30"
+    contract_path.write_text(yaml.dump(contract_data))
+    assert list(contract.get_contracts(s, 2019, 9)) == ["1000", "1002"]
+    assert list(contract.get_contracts(s, 2019, 10)) == ["1000"]
+    assert list(contract.get_contracts(s, 2019, 10, use_cache=False)) == ["1000"]
+    assert list(contract.get_contracts(s, 2019, 10, cid_only="1002")) == []
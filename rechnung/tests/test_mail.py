@@ -0,0 +1,415 @@
+"""
+Tests the SMTP delivery against a local SMTP sink.
+"""
+
+import asyncio
+import mailbox
+import pytest
+import rechnung.contract as contract_module
+import rechnung.helpers as helpers
+import rechnung.settings as settings
+import shlex
+import sys
+import time
+import yaml
+
+from click.testing import CliRunner
+from email.message import EmailMessage
+from rechnung.mail import SMTPSender, send_concurrently
+from rechnung.outbox import Outbox, DEFERRED, PENDING, SENT, SPOOLED
+
+
+def generate_messages(count):
+    messages = []
+    for n in range(count):
+        msg = EmailMessage()
+        msg["To"] = f"customer{n}@email.tld"
+        msg["From"] = "accounting@company.tld"
+        msg["Subject"] = f"Invoice {n}"
+        msg.set_content("Please find your invoice attached.")
+        messages.append(msg)
+    return messages
+
+
+def get_sender(smtp_sink, **kwargs):
+    return SMTPSender(
+        "127.0.0.1",
+        "accounting@company.tld",
+        "secret",
+        port=smtp_sink.port,
+        starttls=False,
+        **kwargs,
+    )
+
+
+def test_sender_reuses_session(smtp_sink):
+    """
+    Tests if all messages are sent over one connection with a single login.
+    """
+    with get_sender(smtp_sink) as sender:
+        for msg in generate_messages(5):
+            assert sender.send(msg)
+    assert len(smtp_sink.messages) == 5
+    assert smtp_sink.connections == 1
+    assert smtp_sink.logins == 1
+
+
+def test_sender_max_messages(smtp_sink):
+    """
+    Tests if the session is renewed after max_messages messages.
+    """
+    with get_sender(smtp_sink, max_messages=2) as sender:
+        for msg in generate_messages(5):
+            assert sender.send(msg)
+    assert len(smtp_sink.messages) == 5
+    assert smtp_sink.connections == 3
+
+
+def test_sender_reconnects_after_disconnect(smtp_sink):
+    """
+    Tests if the sender reconnects transparently, if the server drops the connection.
+    """
+    smtp_sink.close_after = 2
+    with get_sender(smtp_sink) as sender:
+        for msg in generate_messages(5):
+            assert sender.send(msg)
+    assert len(smtp_sink.messages) == 5
+    assert smtp_sink.connections == 3
+
+
+def test_sender_reconnects_after_421(smtp_sink):
+    """
+    Tests if a message is retried on a new connection, after a 421 reply.
+    """
+    smtp_sink.busy_replies = 1
+    with get_sender(smtp_sink) as sender:
+        for msg in generate_messages(3):
+            assert sender.send(msg)
+    assert len(smtp_sink.messages) == 3
+    assert smtp_sink.connections == 2
+
+
+def test_sender_gives_up(smtp_sink):
+    """
+    Tests if the sender reports a failure, if the server keeps replying with 421.
+    """
+    smtp_sink.busy_replies = 2
+    with get_sender(smtp_sink, retries=1) as sender:
+        assert not sender.send(generate_messages(1)[0])
+    assert not smtp_sink.messages
+
+
+def send_messages_concurrently(stub, count, sessions, per_minute=0):
+    messages = enumerate(generate_messages(count))
+    return asyncio.run(
+        send_concurrently(
+            messages,
+            lambda: SMTPSender("127.0.0.1", None, None, port=stub.port, starttls=False),
+            sessions,
+            per_minute,
+        )
+    )
+
+
+def test_send_concurrently(async_smtp_stub):
+    """
+    Tests if messages are sent over several sessions in parallel, so the
+    latency of the server is not paid for every single message.
+    """
+    started = time.monotonic()
+    results = send_messages_concurrently(async_smtp_stub, 8, sessions=4)
+    elapsed = time.monotonic() - started
+
+    assert sorted(key for key, accepted, error in results if accepted) == list(range(8))
+    assert len(async_smtp_stub.messages) == 8
+    assert async_smtp_stub.max_sessions == 4
+    # sequentially, this takes 8 * 0.2 seconds
+    assert elapsed < 8 * 0.2 * 0.75
+
+
+def test_send_concurrently_rate_limit(async_smtp_stub):
+    """
+    Tests if the messages of all sessions are spaced out to the rate limit.
+    """
+    async_smtp_stub.latency = 0
+    started = time.monotonic()
+    results = send_messages_concurrently(async_smtp_stub, 5, 4, per_minute=600)
+    elapsed = time.monotonic() - started
+
+    assert len(results) == 5
+    # 600 messages per minute is one message every 0.1 seconds
+    assert elapsed >= 0.4
+
+
+def use_smtp_stub(path, stub, **kwargs):
+    """
+    Configures the stub as mail server in the settings, returns the settings.
+    """
+    with open(path / "settings.yaml") as infile:
+        settings_data = yaml.safe_load(infile)
+    settings_data.update(
+        server="127.0.0.1",
+        smtp_port=stub.port,
+        smtp_starttls=False,
+        sender="accounting@company.tld",
+        **kwargs,
+    )
+    with open(path / "settings.yaml", "w") as outfile:
+        yaml.dump(settings_data, outfile)
+    return settings.get_settings_from_cwd(path)
+
+
+def test_send_invoices_concurrently(fixtures_path, async_smtp_stub, monkeypatch):
+    """
+    Tests if send-invoices sends over parallel sessions, marks only the invoices
+    accepted by the server as sent and reports every invoice in the summary.
+    """
+    cli1, path = fixtures_path
+    s = use_smtp_stub(path, async_smtp_stub)
+
+    with open(s.contracts_dir / "1000.yaml") as infile:
+        contract = yaml.safe_load(infile)
+    for cid in ["1003", "1004", "1005"]:
+        contract.update(cid=cid, email=f"{cid}@email.tld")
+        with open(s.contracts_dir / f"{cid}.yaml", "w") as outfile:
+            yaml.dump(contract, outfile)
+    async_smtp_stub.reject.add("frank.nord@email.tld")
+
+    runner = CliRunner()
+    runner.invoke(cli1, ["create-invoices", "2019", "10"])
+    for invoice_yaml in s.invoices_dir.glob("*/*.yaml"):
+        invoice_yaml.with_suffix(".pdf").write_bytes(b"%PDF")
+
+    started = time.monotonic()
+    result = runner.invoke(cli1, ["send-invoices", "2019", "10", "--sessions", "5"])
+    elapsed = time.monotonic() - started
+    assert result.exit_code == 1, result.output  # as one invoice failed
+    assert "  1000.2019.10: sent" in result.output
+    assert "  1002.2019.10: failed" in result.output
+    assert "Sent 4 of 5 invoices." in result.output
+    assert len(async_smtp_stub.messages) == 4
+    assert elapsed < 5 * 0.2 * 0.75
+
+    with open(s.invoices_dir / "1000" / "1000.2019.10.yaml") as infile:
+        assert yaml.safe_load(infile)["sent"]
+    with open(s.invoices_dir / "1002" / "1002.2019.10.yaml") as infile:
+        assert "sent" not in yaml.safe_load(infile)
+
+    result = runner.invoke(cli1, ["send-invoices", "2019", "10"])
+    assert "Skip previously sent invoice 1000.2019.10" in result.output
+    assert "Sent 0 of 1 invoices." in result.output
+
+
+def create_invoices_with_pdfs(cli1, s):
+    CliRunner().invoke(cli1, ["create-invoices", "2019", "10"])
+    for invoice_yaml in s.invoices_dir.glob("*/*.yaml"):
+        invoice_yaml.with_suffix(".pdf").write_bytes(b"%PDF")
+
+
+def test_send_invoices_retries_deferred(fixtures_path, async_smtp_stub):
+    """
+    Tests if invoices refused with a temporary error are deferred to the next
+    run, or sent again with exponential backoff with --wait, and given up after
+    the maximum attempts.
+    """
+    cli1, path = fixtures_path
+    async_smtp_stub.latency = 0
+    s = use_smtp_stub(
+        path, async_smtp_stub, outbox_retry_delay=0.1, outbox_max_attempts=3
+    )
+    create_invoices_with_pdfs(cli1, s)
+    async_smtp_stub.greylist["frank.nord@email.tld"] = 2
+
+    # one pass leaves the deferred invoice for the next run
+    result = CliRunner().invoke(cli1, ["send-invoices", "2019", "10"])
+    assert result.exit_code == 0, result.output
+    assert "Sending invoice 1002.2019.10 deferred" in result.output
+    assert "Sent 1 of 2 invoices." in result.output
+    assert "Deferred 1 invoices, run the command again" in result.output
+    with Outbox(s) as outbox:
+        assert outbox.get_states() == {DEFERRED: 1, SENT: 1}
+        assert outbox.get_due() == []
+
+    started = time.monotonic()
+    result = CliRunner().invoke(cli1, ["send-invoices", "--wait", "2019", "10"])
+    elapsed = time.monotonic() - started
+    assert result.exit_code == 0, result.output
+    assert result.output.count("Sending invoice 1002.2019.10 deferred") == 1
+    assert "Sent 1 of 1 invoices." in result.output
+    # waited for the retries after 0.1 and 0.2 seconds
+    assert elapsed >= 0.2
+    with Outbox(s) as outbox:
+        assert outbox.get("1002.2019.10")["attempts"] == 2
+        assert outbox.get_states() == {SENT: 2}
+
+    # give up after three attempts
+    async_smtp_stub.greylist["frank.nord@email.tld"] = 3
+    result = CliRunner().invoke(cli1, ["send-invoices", "-f", "-w", "2019", "10"])
+    assert result.exit_code == 1, result.output
+    assert "Sending invoice 1002.2019.10 failed" in result.output
+    assert "  1002.2019.10: failed, " in result.output
+    assert "Sent 1 of 2 invoices." in result.output
+    result = CliRunner().invoke(cli1, ["print-outbox"])
+    assert "failed: 1\nsent: 1\n" in result.output
+    assert "  1002.2019.10: failed after 3 attempts" in result.output
+
+
+def test_send_invoices_resume(fixtures_path, async_smtp_stub, monkeypatch):
+    """
+    Tests if an interrupted send-invoices run is resumed, without sending the
+    invoices delivered before the interruption again.
+    """
+    cli1, path = fixtures_path
+    async_smtp_stub.latency = 0
+    s = use_smtp_stub(path, async_smtp_stub)
+    create_invoices_with_pdfs(cli1, s)
+
+    send = SMTPSender.send
+
+    def interrupted_send(sender, msg):
+        if sender.messages == 1:
+            raise KeyboardInterrupt
+        return send(sender, msg)
+
+    monkeypatch.setattr(SMTPSender, "send", interrupted_send)
+    result = CliRunner().invoke(cli1, ["send-invoices", "2019", "10"])
+    assert result.exit_code == 1  # click aborts on KeyboardInterrupt
+    assert len(async_smtp_stub.messages) == 1
+    with Outbox(s) as outbox:
+        assert outbox.get_states() == {PENDING: 1, SENT: 1}
+
+    monkeypatch.setattr(SMTPSender, "send", send)
+    result = CliRunner().invoke(cli1, ["send-invoices", "2019", "10"])
+    assert result.exit_code == 0, result.output
+    assert "Skip previously sent invoice 1000.2019.10" in result.output
+    assert "Sent 1 of 1 invoices." in result.output
+    assert len(async_smtp_stub.messages) == 2
+
+
+def test_send_invoices_maildir_hand_off(fixtures_path, tmp_path):
+    """
+    Tests if invoices are written to the maildir spool without any network
+    delivery, and if the spool is handed off to sendmail completely. Invoices
+    are marked as sent only once sendmail accepted them.
+    """
+    cli1, path = fixtures_path
+    s = settings.get_settings_from_cwd(path)
+    create_invoices_with_pdfs(cli1, s)
+
+    runner = CliRunner()
+    result = runner.invoke(
+        cli1, ["send-invoices", "2019", "10", "--delivery", "maildir"]
+    )
+    assert "Sent 0 of 2 invoices." in result.output
+    assert "Spooled 2 invoices, hand-off-spool marks them as sent." in result.output
+    spool = mailbox.Maildir(s.spool_dir / "maildir")
+    assert sorted(message["To"] for message in spool) == [
+        "frank.nord@email.tld",
+        "martha.muster@email.tld",
+    ]
+    invoice_yaml = s.invoices_dir / "1000" / "1000.2019.10.yaml"
+    with open(invoice_yaml) as infile:
+        assert not yaml.safe_load(infile).get("sent")
+    with Outbox(s) as outbox:
+        assert outbox.get_states() == {SPOOLED: 2}
+
+    # spooled invoices are not spooled again
+    result = runner.invoke(
+        cli1, ["send-invoices", "2019", "10", "--delivery", "maildir"]
+    )
+    assert len(mailbox.Maildir(s.spool_dir / "maildir")) == 2
+
+    # a failed hand-off keeps the invoices unsent
+    result = runner.invoke(cli1, ["hand-off-spool", "--command", "false"])
+    assert result.exit_code == 1
+    assert "Handed off 0 emails, 2 failed." in result.output
+    assert len(mailbox.Maildir(s.spool_dir / "maildir")) == 2
+    with open(invoice_yaml) as infile:
+        assert not yaml.safe_load(infile).get("sent")
+
+    # a sendmail, which stores the messages it reads
+    handed_off = tmp_path / "handed_off"
+    handed_off.mkdir()
+    sendmail = tmp_path / "sendmail.py"
+    sendmail.write_text(
+        "import sys, uuid\n"
+        f"path = {str(handed_off)!r} + '/' + uuid.uuid4().hex\n"
+        "open(path, 'wb').write(sys.stdin.buffer.read())\n"
+    )
+    command = f"{shlex.quote(sys.executable)} {shlex.quote(str(sendmail))} -t -oi"
+    result = runner.invoke(cli1, ["hand-off-spool", "--command", command])
+    assert "Handed off 2 emails, 0 failed." in result.output
+    assert len(list(handed_off.iterdir())) == 2
+    assert not len(mailbox.Maildir(s.spool_dir / "maildir"))
+    with open(invoice_yaml) as infile:
+        assert yaml.safe_load(infile)["sent"]
+    with Outbox(s) as outbox:
+        assert outbox.get_states() == {SENT: 2}
+
+    result = runner.invoke(cli1, ["hand-off-spool", "--command", "false"])
+    assert "Handed off 0 emails, 0 failed." in result.output
+
+
+def test_send_contract_mbox(fixtures_path):
+    """
+    Tests if contracts can be appended to the mbox spool.
+    """
+    cli1, path = fixtures_path
+    s = settings.get_settings_from_cwd(path)
+    (s.contracts_dir / "1000.pdf").write_bytes(b"%PDF")
+
+    runner = CliRunner()
+    runner.invoke(cli1, ["send-contract", "1000", "--delivery", "mbox"])
+    runner.invoke(cli1, ["send-contract", "1000", "--delivery", "mbox"])
+    spool = mailbox.mbox(s.spool_dir / "outgoing.mbox")
+    assert [message["To"] for message in spool] == ["martha.muster@email.tld"] * 2
+    assert spool[0]["Subject"] == "Your new contract"
+
+
+def test_send_contracts_attachment_cache(fixtures_path):
+    """
+    Tests if contracts are sent in bulk, with the product descriptions and the
+    policy attached from the cache, encoded only once.
+    """
+    cli1, path = fixtures_path
+    s = settings.get_settings_from_cwd(path)
+    with open(s.contracts_dir / "1000.yaml") as infile:
+        contract = yaml.safe_load(infile)
+    contract.update(cid="1003", email="1003@email.tld")
+    with open(s.contracts_dir / "1003.yaml", "w") as outfile:
+        yaml.dump(contract, outfile)
+    for cid in ["1000", "1003"]:
+        (s.contracts_dir / f"{cid}.pdf").write_bytes(b"%PDF " + cid.encode())
+    (s.assets_dir / "A great product.pdf").write_bytes(b"%PDF product")
+    s.policy_attachment_asset_file.write_bytes(b"%PDF policy")
+
+    result = CliRunner().invoke(
+        cli1, ["send-contracts", "1000", "1003", "1004", "--delivery", "mbox"]
+    )
+    assert "Contract 1004 not found" in result.output
+    assert "Sent 2 of 3 contracts." in result.output
+    spool = mailbox.mbox(s.spool_dir / "outgoing.mbox")
+    assert [message["To"] for message in spool] == [
+        "martha.muster@email.tld",
+        "1003@email.tld",
+    ]
+    for message, cid in zip(spool, ["1000", "1003"]):
+        attachments = [
+            (part.get_filename(), part.get_payload(decode=True))
+            for part in message.walk()
+            if part.get_content_disposition() == "attachment"
+        ]
+        assert attachments == [
+            (f"{s.company_name} {cid}.pdf", b"%PDF " + cid.encode()),
+            ("A great product.pdf", b"%PDF product"),
+            ("policy.pdf", b"%PDF policy"),
+        ]
+
+    cache = helpers.AttachmentCache()
+    template = helpers.get_template(s, s.contract_mail_template_file)
+    emails = [
+        contract_module.generate_contract_email(s, template, cid, cache)
+        for cid in ["1000", "1003"]
+    ]
+    assert (cache.misses, cache.hits) == (2, 2)
+    assert emails[0].as_bytes().count(b"JVBERiBwb2xpY3k=") == 1
@@ -0,0 +1,147 @@
+import random
+
+from decimal import Decimal, ROUND_HALF_UP
+
+from rechnung.money import (
+    compute_gross_totals,
+    compute_totals,
+    from_cents,
+    multiply_cents,
+    split_gross,
+    to_cents,
+)
+
+
+def float_totals(items, vat):
+    """
+    The float calculation of fill_invoice_items before the money engine.
+    """
+    gross = float()
+    subtotals = []
+    for item in items:
+        subtotal = round(item.get("quantity", 1) * item["price"], 2)
+        subtotals.append(subtotal)
+        gross += subtotal
+    net = round(gross / (1.0 + vat / 100.0), 2)
+    return subtotals, net, round(gross - net, 2), gross
+
+
+def generate_items(rng):
+    items = []
+    for _ in range(rng.randint(0, 12)):
+        item = {"price": rng.randint(0, 99999) / 100}
+        if rng.random() < 0.8:
+            item["quantity"] = rng.randint(1, 20)
+        items.append(item)
+    return items
+
+
+def test_totals_match_float_calculation():
+    """
+    Tests with random invoices if the totals in integer cents are the ones the
+    float calculation gave, for prices in cents and whole quantities.
+    """
+    rng = random.Random(0)
+    for vat in [19, 16, 7, 0, 19.0]:
+        invoices_items = [generate_items(rng) for _ in range(500)]
+        totals = compute_totals(invoices_items, vat)
+        assert len(totals) == len(invoices_items)
+        for items, invoice_totals in zip(invoices_items, totals):
+            subtotals, net, vat_amount, gross = float_totals(items, vat)
+            assert list(map(from_cents, invoice_totals.subtotals)) == subtotals
+            assert from_cents(invoice_totals.gross) == round(gross, 2)
+            assert from_cents(invoice_totals.net) == net
+            assert from_cents(invoice_totals.vat) == vat_amount
+            assert invoice_totals.net + invoice_totals.vat == invoice_totals.gross
+            # the batch gives the same as every invoice on its own
+            assert compute_totals([items], vat) == [invoice_totals]
+            assert compute_gross_totals(subtotals, vat) == invoice_totals
+
+
+def test_no_cent_drift():
+    """
+    Tests if many items add up exactly, where floats drift away.
+    """
+    items = [{"price": 0.1, "quantity": 1}] * 1000
+    assert sum(0.1 for _ in items) != 100
+    assert compute_totals([items], 19)[0].gross == 10000
+    assert from_cents(compute_totals([[{"price": 20.1}]], 19)[0].gross) == 20.1
+
+
+def test_rounding():
+    assert to_cents(13.37) == 1337
+    assert to_cents(1.005) == 101
+    assert to_cents("2.675") == 268
+    assert to_cents(3) == 300
+    # fractional quantities are rounded half up, not by the binary float
+    assert multiply_cents(1337, 0.5) == 669
+    assert multiply_cents(1337, 2.0) == 2674
+    assert split_gross(11900, 19) == (10000, 1900)
+    assert split_gross(100, 19) == (84, 16)
+    assert split_gross(0, 19) == (0, 0)
+
+
+def half_up(value):
+    return int(value.quantize(Decimal(1), ROUND_HALF_UP))
+
+
+def decimal_totals(items, vat):
+    """
+    The totals computed in Decimal: prices rounded to cents, subtotals and
+    the net amount rounded half up to cents.
+    """
+    subtotals = [
+        half_up(
+            half_up(Decimal(str(item["price"])) * 100)
+            * Decimal(str(item.get("quantity", 1)))
+        )
+        for item in items
+    ]
+    gross = sum(subtotals)
+    net = half_up(Decimal(gross) * 100 / (100 + Decimal(str(vat))))
+    return subtotals, net, gross - net, gross
+
+
+def test_totals_match_decimal_calculation():
+    """
+    Tests with random invoices with sub-cent prices and fractional quantities
+    if the totals are rounded like the Decimal reference.
+    """
+    rng = random.Random(16)
+    for vat in [19, 7, 60, 100, 19.5]:
+        invoices_items = []
+        for _ in range(300):
+            items = []
+            for _ in range(rng.randint(0, 8)):
+                price = rng.randint(0, 999999) / 1000
+                quantity = rng.choice(
+                    [rng.randint(1, 400) / 100, rng.randint(1, 9) / 8, 0.5, 3]
+                )
+                items.append(
+                    {"price": rng.choice([price, str(price)]), "quantity": quantity}
+                )
+            invoices_items.append(items)
+        for items, totals in zip(invoices_items, compute_totals(invoices_items, vat)):
+            assert tuple(totals) == decimal_totals(items, vat)
+
+
+def test_rounding_ties():
+    """
+    Tests if exact ties of half a cent are rounded up.
+    """
+    assert to_cents(0.125) == 13
+    assert to_cents("0.005") == 1
+    assert to_cents(Decimal("10.995")) == 1100
+    # 1 cent times 0.5, 3 cents times 1.5, 25 cents times 0.1 (float)
+    assert multiply_cents(1, 0.5) == 1
+    assert multiply_cents(3, 1.5) == 5
+    assert multiply_cents(25, 0.1) == 3
+    assert multiply_cents(25, "0.1") == 3
+    # 5 * 100 / 200 = 2.5 and 4 * 100 / 160 = 2.5
+    assert split_gross(5, 100) == (3, 2)
+    assert split_gross(4, 60) == (3, 1)
+    for items, vat in [
+        ([{"price": 0.005, "quantity": 1}], 19),
+        ([{"price": 0.01, "quantity": 0.5}, {"price": 0.03, "quantity": 1.5}], 100),
+    ]:
+        assert tuple(compute_totals([items], vat)[0]) == decimal_totals(items, vat)
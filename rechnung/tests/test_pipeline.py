@@ -0,0 +1,92 @@
+"""
+Tests the memory bound of the create-billed-invoices pipeline.
+"""
+
+import gc
+import pytest
+import rechnung.invoice as invoice
+import rechnung.settings as settings
+import tracemalloc
+import yaml
+
+from rechnung.billed_items import get_billed_items_store
+
+
+def add_customers(s, count, months=6):
+    """
+    Adds count customers with months of unbilled items each.
+    """
+    for n in range(count):
+        cid = str(5000 + n)
+        contract = {
+            "cid": cid,
+            "email": f"{cid}@email.tld",
+            "name": f"Customer {cid}",
+            "start": "2018-01-01",
+            "items": [
+                {"description": "A great product", "price": 13.37, "quantity": 1}
+            ],
+        }
+        with open(s.contracts_dir / f"{cid}.yaml", "w") as outfile:
+            yaml.dump(contract, outfile)
+        billed_items = [
+            {
+                "description": f"A great product {month} " + "x" * 500,
+                "invoice": None,
+                "key": f"{2016 + month // 12}-{month % 12 + 1:02}",
+                "price": 13.37,
+                "quantity": 1,
+                "subtotal": 13.37,
+            }
+            for month in range(months)
+        ]
+        with open(s.billed_items_dir / f"{cid}.yaml", "w") as outfile:
+            yaml.dump(billed_items, outfile)
+
+
+# Memory the date libraries keep in their caches is not held by the pipeline
+LIBRARY_CACHES = [
+    tracemalloc.Filter(False, "*/arrow/*"),
+    tracemalloc.Filter(False, "*/dateutil/*"),
+    tracemalloc.Filter(False, tracemalloc.__file__),
+]
+
+
+def held_memory_generate_billed_invoices(s, suffix):
+    """
+    Returns the memory held by the pipeline after each generated invoice.
+    Cyclic garbage is collected first, as it is no memory held by the pipeline.
+    """
+    held = []
+    with get_billed_items_store(s) as store:
+        tracemalloc.start()
+        for invoice_data in invoice.generate_billed_invoices(s, suffix, store):
+            invoice.save_invoice_yaml(s, invoice_data)
+            del invoice_data
+            gc.collect()
+            snapshot = tracemalloc.take_snapshot().filter_traces(LIBRARY_CACHES)
+            held.append(sum(stat.size for stat in snapshot.statistics("filename")))
+        tracemalloc.stop()
+    return held
+
+
+def test_generate_billed_invoices_memory_bound(fixtures_path):
+    """
+    Tests if the memory held while creating billed invoices is independent of the
+    number of customers, i.e. customers are loaded and processed one by one.
+    """
+    cli1, path = fixtures_path
+    s = settings.get_settings_from_cwd(path)
+
+    # warm up, s.t. lazily filled caches of the libraries are not measured
+    add_customers(s, 4)
+    held_memory_generate_billed_invoices(s, "2018.W")
+    add_customers(s, 20)
+    held = held_memory_generate_billed_invoices(s, "2018.A")
+
+    assert len(held) == 20
+    # Only the list of paths may grow with the customers, which is a small
+    # fraction of the billed items of a single customer
+    customer_size = (s.billed_items_dir / "5000.yaml").stat().st_size
+    growth_per_customer = (held[-1] - held[4]) / (len(held) - 5)
+    assert growth_per_customer < customer_size / 4
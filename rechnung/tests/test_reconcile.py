@@ -0,0 +1,84 @@
+import rechnung.settings as settings
+import yaml
+
+from click.testing import CliRunner
+from rechnung.catalog import InvoiceCatalog
+from rechnung.tests.test_transactions import gls_row, write_gls_statement
+
+
+def credit(sender, subject, iban, amount, date="05.11.2019"):
+    return gls_row(
+        date,
+        sender,
+        f"Überweisungsgutschr.{subject} IBAN: {iban} BIC: GENODEM1GLS",
+        amount,
+    )
+
+
+def test_reconcile(fixtures_path):
+    """
+    Tests if payments are matched by invoice id, or by sender and amount, and
+    if ambiguous and unmatched payments are reported.
+    """
+    cli1, path = fixtures_path
+    s = settings.get_settings_from_cwd(path)
+    runner = CliRunner()
+    runner.invoke(cli1, ["create-invoices", "2019", "10"])
+    runner.invoke(cli1, ["create-invoices", "2019", "11"])
+
+    write_gls_statement(
+        s.csv_dir / "gls" / "201911.csv",
+        [
+            credit("Martha Muster", "Rechnung 1000.2019.10", "DE11 1111", "60,21"),
+            # the sender has two open invoices of this amount
+            credit("Frank Nord", "Internet", "DE22", "48,45"),
+            credit("Someone", "Spende", "DE33", "99,99"),
+            gls_row(
+                "06.11.2019",
+                "Frank Nord",
+                "Basislastschrift1002.2019.10 IBAN: DE22 BIC: GENODEM1GLS",
+                "-48,45",
+            ),
+            # the amount doesn't fit the invoice
+            credit("Martha Muster", "1000.2019.11", "DE11 1111", "10,00"),
+        ],
+    )
+
+    runner.invoke(cli1, ["ingest-csv"])
+    result = runner.invoke(cli1, ["reconcile", "2019", "11"])
+    assert result.exit_code == 0, result.output
+    assert "Matched 05.11.2019 60.21€ from Martha Muster to 1000.2019.10" in (
+        result.output
+    )
+    assert (
+        "Ambiguous 05.11.2019 48.45€ from Frank Nord, "
+        "candidates: 1002.2019.10, 1002.2019.11"
+    ) in result.output
+    assert "Unmatched 05.11.2019 99.99€ from Someone: Spende" in result.output
+    assert "candidates: 1000.2019.11" in result.output
+    assert "Matched 1 payments, 2 ambiguous, 1 unmatched." in result.output
+
+    with open(s.invoices_dir / "1000" / "1000.2019.10.yaml") as infile:
+        paid = yaml.safe_load(infile)["paid"]
+    assert str(paid["date"]) == "2019-11-05"
+    assert paid["iban"] == "DE11 1111"
+    with InvoiceCatalog(s) as catalog:
+        assert [entry["paid"] for entry in catalog.select(2019, 10)] == [
+            "2019-11-05",
+            None,
+        ]
+
+    # the known payment is skipped, the IBAN is known from it now
+    write_gls_statement(
+        s.csv_dir / "gls" / "201911.csv",
+        [
+            credit("Martha Muster", "Rechnung 1000.2019.10", "DE11 1111", "60,21"),
+            credit("M. Muster", "November", "DE111111", "60,21", "30.11.2019"),
+        ],
+    )
+    runner.invoke(cli1, ["ingest-csv"])
+    result = runner.invoke(cli1, ["reconcile", "2019", "11", "--dry"])
+    assert "to 1000.2019.10" not in result.output
+    assert "Matched 30.11.2019 60.21€ from M. Muster to 1000.2019.11" in result.output
+    with open(s.invoices_dir / "1000" / "1000.2019.11.yaml") as infile:
+        assert "paid" not in yaml.safe_load(infile)
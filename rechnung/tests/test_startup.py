@@ -0,0 +1,61 @@
+"""
+Tests that commands which only read data don't load the rendering and mailing
+libraries, as importing WeasyPrint alone takes longer than the command itself.
+"""
+
+import os
+import pytest
+import rechnung
+import subprocess
+import sys
+
+from pathlib import Path
+
+HEAVY_MODULES = ["weasyprint", "jinja2", "smtplib"]
+
+
+def imported_modules(path, args):
+    """
+    Runs the rechnung cli with args in path and returns the names of all
+    modules imported, as reported by python -X importtime.
+    """
+    # the tests may run against a checkout, which is not installed
+    env = dict(os.environ)
+    package_parent = str(Path(rechnung.__file__).parent.parent)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [package_parent, env.get("PYTHONPATH")])
+    )
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            "import rechnung.cli; rechnung.cli.cli()",
+            *args,
+        ],
+        cwd=path,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    modules = set()
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            modules.add(line.rsplit("|", 1)[1].strip())
+    return modules
+
+
+@pytest.mark.parametrize(
+    "args",
+    [["print-contracts"], ["print-stats"], ["print-csv", "2019", "11"]],
+)
+def test_read_only_commands_skip_heavy_imports(fixtures_path, args):
+    cli1, path = fixtures_path
+    (path / "csv").mkdir(exist_ok=True)
+    modules = imported_modules(path, args)
+
+    assert "rechnung.contract" in modules
+    for heavy in HEAVY_MODULES:
+        assert not [m for m in modules if m.split(".")[0] == heavy]
@@ -0,0 +1,109 @@
+import datetime
+import json
+import random
+
+from click.testing import CliRunner
+
+from rechnung.contract import format_month, is_active, month_index, parse_month
+from rechnung.money import compute_totals, from_cents
+from rechnung.stats import get_revenue_series
+
+
+def generate_contracts(rng, n):
+    contracts = []
+    for cid in range(n):
+        start = datetime.date(2015, 1, 1) + datetime.timedelta(rng.randint(0, 2500))
+        contract = {
+            "cid": str(cid),
+            "start": start,
+            "items": [
+                {"price": rng.randint(0, 9999) / 100, "quantity": rng.randint(1, 3)}
+                for _ in range(rng.randint(0, 3))
+            ],
+        }
+        if rng.random() < 0.5:
+            contract["end"] = start + datetime.timedelta(rng.randint(0, 1000))
+        contracts.append(contract)
+    return contracts
+
+
+def brute_force_series(contracts, vat, first, last):
+    """
+    Checks every contract in every month with is_active.
+    """
+    totals = compute_totals((contract["items"] for contract in contracts), vat)
+    series = []
+    previous = None
+    for index in range(first - 1, last + 1):
+        year, month = index // 12, index % 12 + 1
+        active = {
+            n
+            for n, contract in enumerate(contracts)
+            if is_active(contract, year, month)
+        }
+        if previous is None:
+            previous = active
+            continue
+        churned = len(previous - active)
+        series.append(
+            {
+                "month": format_month(index),
+                "active": len(active),
+                "new": len(active - previous),
+                "churned": churned,
+                "churn_rate": round(churned / len(previous), 4) if previous else 0.0,
+                "mrr": from_cents(sum(totals[n].gross for n in active)),
+            }
+        )
+        previous = active
+    return series
+
+
+def test_month_index():
+    assert month_index(2019, 1) + 11 == month_index(2019, 12)
+    assert month_index(2019, 12) + 1 == month_index(2020, 1)
+    assert format_month(parse_month("2019-07")) == "2019-07"
+
+
+def test_revenue_series_brute_force():
+    rng = random.Random(23)
+    contracts = generate_contracts(rng, 300)
+    first, last = parse_month("2016-01"), parse_month("2021-12")
+
+    series = get_revenue_series(contracts, 19, first, last)
+
+    assert len(series) == last - first + 1
+    assert series == brute_force_series(contracts, 19, first, last)
+    assert sum(month["churned"] for month in series) > 0
+
+
+def test_print_stats_series(cli_test_data_path):
+    cli1, path = cli_test_data_path
+    runner = CliRunner()
+
+    result = runner.invoke(
+        cli1, ["print-stats", "--from", "2019-05", "--to", "2019-07", "-f", "json"]
+    )
+    assert result.exit_code == 0, result.output
+    series = json.loads(result.output)
+    assert [month["month"] for month in series] == ["2019-05", "2019-06", "2019-07"]
+    assert [month["active"] for month in series] == [0, 2, 2]
+    assert series[1]["new"] == 2
+    assert series[-1]["mrr"] == 108.66
+
+    result = runner.invoke(
+        cli1, ["print-stats", "--from", "2019-06", "--to", "2019-06", "-f", "csv"]
+    )
+    assert result.output.splitlines() == [
+        "month,active,new,churned,churn_rate,mrr",
+        "2019-06,2,2,0,0.0,108.66",
+    ]
+
+    result = runner.invoke(
+        cli1, ["print-stats", "--from", "2019-07", "--to", "2019-06"]
+    )
+    assert result.exit_code == 2
+
+    result = runner.invoke(cli1, ["print-stats", "--to", "2019-13"])
+    assert result.exit_code == 2
+    assert "2019-13 is no month (YYYY-MM)." in result.output
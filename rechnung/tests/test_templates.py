@@ -0,0 +1,68 @@
+import jinja2
+import rechnung.helpers as helpers
+import rechnung.settings as settings
+
+
+def count_compiles(monkeypatch):
+    """
+    Counts the templates compiled from source.
+    """
+    compiled = []
+    compile = jinja2.Environment.compile
+
+    def counting_compile(environment, source, name=None, filename=None, **kwargs):
+        compiled.append(name)
+        return compile(environment, source, name, filename, **kwargs)
+
+    monkeypatch.setattr(jinja2.Environment, "compile", counting_compile)
+    return compiled
+
+
+def test_template_bytecode_cache(fixtures_path, monkeypatch):
+    """
+    Tests if compiled templates are reused by later runs (i.e. new
+    environments), and compiled again when their source changed.
+    """
+    cli1, path = fixtures_path
+    s = settings.get_settings_from_cwd(path)
+    compiled = count_compiles(monkeypatch)
+    monkeypatch.setattr(helpers, "_environments", {})
+
+    template = helpers.get_template(s, s.invoice_mail_template_file)
+    assert compiled == ["invoice_mail_template.j2"]
+    assert list((s.cache_dir / helpers.TEMPLATE_CACHE_DIR).iterdir())
+
+    # a new run loads the compiled template from the cache
+    monkeypatch.setattr(helpers, "_environments", {})
+    cached = helpers.get_template(s, s.invoice_mail_template_file)
+    assert compiled == ["invoice_mail_template.j2"]
+    assert cached.render(invoice={"id": "1"}) == template.render(invoice={"id": "1"})
+
+    with open(s.invoice_mail_template_file, "a") as outfile:
+        outfile.write("\nchanged")
+    monkeypatch.setattr(helpers, "_environments", {})
+    changed = helpers.get_template(s, s.invoice_mail_template_file)
+    assert compiled == ["invoice_mail_template.j2"] * 2
+    assert changed.render(invoice={"id": "1"}).endswith("changed")
+
+
+def test_template_inheritance(fixtures_path):
+    """
+    Tests if templates in the assets can extend each other, and if the
+    shipped templates are found when missing in the assets.
+    """
+    cli1, path = fixtures_path
+    s = settings.get_settings_from_cwd(path)
+    (s.assets_dir / "base.j2").write_text(
+        "Dear customer, {% block text %}{% endblock %}"
+    )
+    (s.assets_dir / "reminder.j2").write_text(
+        '{% extends "base.j2" %}{% block text %}please pay {{ id }}.{% endblock %}'
+    )
+    template = helpers.get_template(s, s.assets_dir / "reminder.j2")
+    assert (
+        template.render(id="1000.2019.10") == "Dear customer, please pay 1000.2019.10."
+    )
+
+    s.print_run_template_file.unlink()
+    assert helpers.get_template(s, s.print_run_template_file).render(invoices=[])
@@ -0,0 +1,236 @@
+import csv
+import datetime
+import rechnung.settings as settings
+import rechnung.transactions as transactions
+
+from click.testing import CliRunner
+from dateutil.parser import parse
+
+
+def write_gls_statement(csv_path, rows):
+    csv_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(csv_path, "w", encoding="iso-8859-1", newline="") as csv_file:
+        csv.writer(csv_file, delimiter=";").writerows(rows)
+
+
+def gls_row(date, sender, booking_text, amount):
+    return [date, date, "166", sender, "", "", "", "", booking_text, "", "EUR", amount]
+
+
+def test_parser_gls(fixtures_path):
+    """
+    Tests if the GLS parser streams the transactions of a statement, skipping
+    the header, short rows and unknown booking texts.
+    """
+    cli1, path = fixtures_path
+    s = settings.get_settings_from_cwd(path)
+    write_gls_statement(
+        s.csv_dir / "gls" / "201910.csv",
+        [
+            ["Buchungstag", "Valuta", "Textschlüssel", "Auftraggeber"],
+            gls_row(
+                "01.10.2019",
+                "Martha Muster",
+                "Überweisungsgutschr.1000.2019.10\nIBAN: DE1234 BIC: GENODEM1GLS",
+                "60,21",
+            ),
+            gls_row("02.10.2019", "Bank", "Abschluss", "-3,00"),
+            gls_row(
+                "2019-10-31",
+                "Frank Nord",
+                "Basislastschrift1002.2019.10 IBAN: DE5678 BIC: GENODEM1GLS",
+                "-1.234,50",
+            ),
+            ["31.10.2019"],
+        ],
+    )
+
+    CliRunner().invoke(cli1, ["ingest-csv"])
+    parsed = transactions.read_csv_files(s, 2019, 10)
+    assert not isinstance(parsed, list)
+    assert list(parsed) == [
+        {
+            "type": "Überweisungsgutschr.",
+            "subject": "1000.2019.10",
+            "iban": "DE1234",
+            "bic": "GENODEM1GLS",
+            "date": datetime.datetime(2019, 10, 1),
+            "sender": "Martha Muster",
+            "amount": 60.21,
+        },
+        {
+            "type": "Basislastschrift",
+            "subject": "1002.2019.10 ",
+            "iban": "DE5678",
+            "bic": "GENODEM1GLS",
+            "date": datetime.datetime(2019, 10, 31),
+            "sender": "Frank Nord",
+            "amount": -1234.5,
+        },
+    ]
+
+
+def test_parse_date():
+    """
+    Tests if the fast path parses dates like dateutil with dayfirst.
+    """
+    day = datetime.date(2019, 1, 1)
+    while day.year < 2021:
+        value = day.strftime("%d.%m.%Y")
+        assert transactions.parse_date(value) == parse(value, dayfirst=True)
+        day += datetime.timedelta(days=1)
+    assert transactions.parse_date("1.2.2019") == datetime.datetime(2019, 2, 1)
+
+
+def test_parse_amount():
+    assert transactions.parse_amount("12,50") == 12.5
+    assert transactions.parse_amount("-1.234,56") == -1234.56
+    assert transactions.parse_amount("12.50") == 12.5
+
+
+def test_transaction_store(fixtures_path, monkeypatch):
+    """
+    Tests if every export is parsed once, only when syncing, and date ranges
+    are queried across months from the store.
+    """
+    cli1, path = fixtures_path
+    s = settings.get_settings_from_cwd(path)
+    parsed = []
+
+    def counting_parser(csv_path):
+        parsed.append(csv_path.name)
+        return transactions.parser_gls(csv_path)
+
+    monkeypatch.setitem(transactions.csv_parsers, "gls", counting_parser)
+    for month, day in [(10, "30.10.2019"), (11, "02.11.2019")]:
+        write_gls_statement(
+            s.csv_dir / "gls" / f"2019{month}.csv",
+            [
+                gls_row(
+                    day,
+                    "Martha Muster",
+                    f"Überweisungsgutschr.1000.2019.{month} IBAN: DE1 BIC: GLS",
+                    "60,21",
+                )
+            ],
+        )
+    # a copy of an export is not entered twice
+    (s.csv_dir / "gls" / "copy.csv").write_bytes(
+        (s.csv_dir / "gls" / "201911.csv").read_bytes()
+    )
+
+    with transactions.TransactionStore(s) as store:
+        assert store.sync() == 2
+        assert sorted(parsed) == ["201910.csv", "201911.csv"]
+        assert store.sync() == 0
+        dates = [
+            t["date"].day
+            for t in store.get_transactions(
+                datetime.date(2019, 10, 15), datetime.date(2019, 11, 15)
+            )
+        ]
+        assert dates == [30, 2]
+        assert list(store.get_transactions(banks=["other"])) == []
+
+    parsed.clear()
+    assert [t["subject"] for t in transactions.read_csv_files(s, 2019, 11)] == [
+        "1000.2019.11 "
+    ]
+    assert not parsed
+
+    # changed and removed exports
+    (s.csv_dir / "gls" / "201911.csv").unlink()
+    (s.csv_dir / "gls" / "copy.csv").unlink()
+    write_gls_statement(s.csv_dir / "gls" / "201910.csv", [])
+    assert len(list(transactions.read_transactions(s))) == 2
+    assert not parsed
+    with transactions.TransactionStore(s) as store:
+        assert store.sync() == 0
+    assert list(transactions.read_transactions(s)) == []
+    assert parsed == ["201910.csv"]
+
+    result = CliRunner().invoke(cli1, ["print-csv", "--from", "2019-10-01"])
+    assert result.exit_code == 0, result.output
+    result = CliRunner().invoke(cli1, ["print-csv"])
+    assert result.exit_code == 2
+
+
+def test_sync_copy_of_failed_export(fixtures_path, monkeypatch):
+    """
+    Tests if a copy of an export is only recorded once the original was
+    entered, so a failed parse is tried again by the next sync.
+    """
+    cli1, path = fixtures_path
+    s = settings.get_settings_from_cwd(path)
+    write_gls_statement(
+        s.csv_dir / "gls" / "201911.csv",
+        [
+            gls_row(
+                "02.11.2019",
+                "Martha Muster",
+                "Überweisungsgutschr.1000.2019.11 IBAN: DE1 BIC: GLS",
+                "60,21",
+            )
+        ],
+    )
+    (s.csv_dir / "gls" / "copy.csv").write_bytes(
+        (s.csv_dir / "gls" / "201911.csv").read_bytes()
+    )
+
+    def failing_parser(csv_path):
+        raise ValueError("broken")
+
+    with transactions.TransactionStore(s) as store:
+        monkeypatch.setitem(transactions.csv_parsers, "gls", failing_parser)
+        assert store.sync() == 0
+        monkeypatch.undo()
+        assert store.sync() == 1
+        assert store.sync() == 0
+
+
+def test_ingest_overlapping_exports(fixtures_path):
+    """
+    Tests if exports of several banks are ingested concurrently, their format
+    is recognized, and transactions in overlapping exports are entered once.
+    """
+    cli1, path = fixtures_path
+    s = settings.get_settings_from_cwd(path)
+    october = gls_row(
+        "30.10.2019",
+        "Martha Muster",
+        "Überweisungsgutschr.1000.2019.10 IBAN: DE1 BIC: GLS",
+        "60,21",
+    )
+    november = gls_row(
+        "02.11.2019",
+        "Martha Muster",
+        "Überweisungsgutschr.1000.2019.11 IBAN: DE1 BIC: GLS",
+        "60,21",
+    )
+    write_gls_statement(s.csv_dir / "gls" / "201910.csv", [october])
+    # an export of another account, spanning both months, with the same
+    # payment twice on the same day
+    write_gls_statement(
+        s.csv_dir / "giro" / "export.csv", [october, november, november]
+    )
+    (s.csv_dir / "other").mkdir()
+    (s.csv_dir / "other" / "export.csv").write_text("Date,Amount\n")
+
+    runner = CliRunner()
+    result = runner.invoke(cli1, ["ingest-csv", "--jobs", "2"])
+    assert result.exit_code == 0, result.output
+    assert "Unknown CSV format of" in result.output
+    assert "Ingested 3 new transactions." in result.output
+
+    result = runner.invoke(cli1, ["ingest-csv"])
+    assert "Ingested 0 new transactions." in result.output
+
+    # the overlapping export is gone, its other transactions as well
+    (s.csv_dir / "giro" / "export.csv").unlink()
+    runner.invoke(cli1, ["ingest-csv"])
+    assert [t["subject"] for t in transactions.read_transactions(s)] == [
+        "1000.2019.10 "
+    ]
+
+    result = runner.invoke(cli1, ["ingest-csv", "--rebuild"])
+    assert "Ingested 1 new transactions." in result.output
@@ -1,54 +1,426 @@
 import datetime
+import hashlib
 import locale
 import os
 import os.path
+import sqlite3
 import yaml
 import csv
 import re
-from dateutil.parser import parse
+from collections import defaultdict
 
 from pathlib import Path
+from .helpers import run_jobs
+from .money import from_cents, to_cents
 
+# Booking text of the GLS transactions which are parsed
+GLS_TRANSACTION = re.compile(
+    r"(?P<type>Dauerauftragsbelast|Dauerauftragsgutschr|Überweisungsauftrag|Basislastschrift|Überweisungsgutschr\.)"
+    r"(?P<subject>.*)IBAN:\s?(?P<iban>.+) BIC:\s?(?P<bic>.+)"
+)
 
-def parser_gls(csv_path):
+
+def parse_date(value):
     """
-    Parses CSV files from the GLS bank
+    Parses a DD.MM.YYYY date, as found in the bank exports, directly. Other
+    formats are handed to dateutil (day first).
     """
-    groups = [
-        r"(?P<type>Dauerauftragsbelast|Dauerauftragsgutschr|Überweisungsauftrag|Basislastschrift|Überweisungsgutschr\.)",
-        r"(?P<subject>.*)IBAN:\s?(?P<iban>.+) BIC:\s?(?P<bic>.+)",
-    ]
-    compiled_groups = re.compile("".join(groups))
-    transactions = []
+    if len(value) == 10 and value[2] == value[5] == ".":
+        return datetime.datetime(int(value[6:]), int(value[3:5]), int(value[:2]))
+    from dateutil.parser import parse
+
+    return parse(value, dayfirst=True)
 
-    with open(csv_path, encoding="iso-8859-1") as csv_file:
+
+def parse_amount(value):
+    """
+    Parses an amount with decimal comma and optional thousands dots, i.e.
+    1.234,56 (or a plain float like 1234.56).
+    """
+    if "," not in value:
+        return float(value)
+    if "." in value:
+        value = value.replace(".", "")
+    return float(value.replace(",", "."))
+
+
+def parser_gls(csv_path):
+    """
+    Generator which parses CSV files from the GLS bank, and yields the
+    transactions one by one, so large exports are never held in memory.
+    """
+    with open(csv_path, encoding="iso-8859-1", newline="") as csv_file:
         csv_reader = csv.reader(csv_file, delimiter=";")
 
         for row in csv_reader:
-            match = compiled_groups.match(row[8].replace("\n", ""))
+            if len(row) < 12:
+                continue
+            booking_text = row[8]
+            if "\n" in booking_text:
+                booking_text = booking_text.replace("\n", "")
+            match = GLS_TRANSACTION.match(booking_text)
             if match:
-                transactions.append(
-                    {
-                        **match.groupdict(),
-                        "date": parse(row[0], dayfirst=True),
-                        "sender": row[3],
-                        "amount": float(row[11].replace(",", ".")),
-                    }
-                )
-    return transactions
+                transaction = match.groupdict()
+                transaction["date"] = parse_date(row[0])
+                transaction["sender"] = row[3]
+                transaction["amount"] = parse_amount(row[11])
+                yield transaction
 
 
-def read_csv_files(settings, year, month):
+def sniff_gls(head):
+    """
+    Checks if the first line of an export looks like a GLS bank export:
+    at least 12 columns separated by semicolons, starting with the booking
+    day (or its header).
+    """
+    columns = head.split(";")
+    if len(columns) < 12:
+        return False
+    first = columns[0].strip('"')
+    return first == "Buchungstag" or bool(re.fullmatch(r"\d\d\.\d\d\.\d{4}", first))
+
+
+# File in settings.cache_dir holding the transaction store
+TRANSACTION_STORE_FILE = "transactions.sqlite3"
+TRANSACTION_STORE_VERSION = 2
+
+# Parsers of the CSV exports, by format, with the function recognizing the
+# format from the first line of an export
+csv_parsers = {"gls": parser_gls}
+csv_sniffers = {"gls": sniff_gls}
+
+
+class UnknownCSVFormatError(Exception):
+    """
+    If the format of a CSV export can't be determined, this exception is thrown.
+    """
+
+    pass
+
+
+def detect_csv_format(csv_path, bank):
+    """
+    Returns the format of the export: the name of its bank directory, if
+    there is a parser of that name, or else the format the first line of the
+    export is recognized as.
+    """
+    if bank in csv_parsers:
+        return bank
+    with open(csv_path, encoding="iso-8859-1", newline="") as csv_file:
+        head = csv_file.readline().strip()
+    for csv_format, sniff in csv_sniffers.items():
+        if sniff(head):
+            return csv_format
+    raise UnknownCSVFormatError(f"Unknown CSV format of {csv_path}")
+
+
+def get_file_hash(path):
+    """
+    Returns the sha256 hex digest of the file content.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as infile:
+        for chunk in iter(lambda: infile.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_fingerprint(transaction, occurrence=0):
     """
-    Parses CSV files of a specific year/month combo
+    Returns the key a transaction is recognized by in overlapping exports:
+    a hash of date, amount, IBAN and subject. occurrence counts identical
+    transactions within one export, so they are not merged.
     """
-    transactions = []
-    for bank in settings.csv_dir.iterdir():
-        csv_path = bank / f"{year}{month:02}.csv"
-        if csv_path.is_file():
-            if bank.stem == "gls":
-                transactions.extend(parser_gls(csv_path))
-            else:
-                print("Unknown CSV format")
+    key = "\x1f".join(
+        [
+            transaction["date"].date().isoformat(),
+            str(to_cents(transaction["amount"])),
+            transaction["iban"].replace(" ", "").upper(),
+            " ".join(transaction["subject"].split()),
+            str(occurrence),
+        ]
+    )
+    return hashlib.sha256(key.encode()).hexdigest()
 
-    return transactions
+
+def parse_export(csv_path, csv_format):
+    """
+    Parses the export, possibly in a worker process (see run_jobs).
+
+    Returns the rows to be entered into the TransactionStore: fingerprint,
+    date, type, subject, iban, bic, sender and amount in cents.
+    """
+    occurrences = {}
+    rows = []
+    for transaction in csv_parsers[csv_format](csv_path):
+        fingerprint = get_fingerprint(transaction)
+        occurrence = occurrences.get(fingerprint, 0)
+        occurrences[fingerprint] = occurrence + 1
+        if occurrence:
+            fingerprint = get_fingerprint(transaction, occurrence)
+        rows.append(
+            (
+                fingerprint,
+                transaction["date"].date().isoformat(),
+                transaction["type"],
+                transaction["subject"],
+                transaction["iban"],
+                transaction["bic"],
+                transaction["sender"],
+                to_cents(transaction["amount"]),
+            )
+        )
+    return rows
+
+
+class TransactionStore:
+    """
+    Parsed transactions of the bank CSV exports in settings.csv_dir
+    (csv_dir/<bank>/*.csv), kept in a SQLite database in settings.cache_dir
+    and indexed by date.
+
+    Every export is parsed once and recorded with the hash of its content:
+    sync only parses files which are new or whose content changed (files
+    whose mtime and size are unchanged are not even hashed), several at once
+    in worker processes. Transactions are entered by their fingerprint (see
+    get_fingerprint), so transactions contained in overlapping exports, or in
+    a statement imported again, are only entered once. Queries for date
+    ranges across months and banks are answered from the index.
+
+    The format of an export is given by its bank directory, or recognized
+    from its first line, see detect_csv_format.
+
+    The store is only a cache, it can be rebuilt from the exports at any
+    time. Use it as a context manager to close the database when done.
+    """
+
+    def __init__(self, settings):
+        self.csv_dir = settings.csv_dir
+        settings.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(settings.cache_dir / TRANSACTION_STORE_FILE)
+        self.conn.row_factory = sqlite3.Row
+        # the store can be rebuilt, it doesn't need to survive a crash
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=OFF")
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        with self.conn:
+            if version != TRANSACTION_STORE_VERSION:
+                for table in ["files", "sources", "transactions"]:
+                    self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+                self.conn.execute(f"PRAGMA user_version = {TRANSACTION_STORE_VERSION}")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    bank TEXT NOT NULL,
+                    hash TEXT NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    size INTEGER NOT NULL
+                )""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS files_hash ON files (hash)")
+            # the exports (by hash) every transaction was found in
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS sources (
+                    hash TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    PRIMARY KEY (hash, fingerprint)
+                ) WITHOUT ROWID""")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS sources_fingerprint "
+                "ON sources (fingerprint)"
+            )
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS transactions (
+                    fingerprint TEXT UNIQUE NOT NULL,
+                    bank TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    type TEXT,
+                    subject TEXT,
+                    iban TEXT,
+                    bic TEXT,
+                    sender TEXT,
+                    amount INTEGER NOT NULL
+                )""")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS transactions_date "
+                "ON transactions (date, bank)"
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def is_ingested(self, file_hash):
+        return bool(
+            self.conn.execute(
+                "SELECT 1 FROM files WHERE hash = ? LIMIT 1", (file_hash,)
+            ).fetchone()
+        )
+
+    def enter(self, bank, file_hash, rows):
+        """
+        Enters the parsed rows of an export (see parse_export), skipping the
+        transactions known already.
+
+        Returns the number of new transactions.
+        """
+        with self.conn:
+            before = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO transactions (fingerprint, bank, date, "
+                "type, subject, iban, bic, sender, amount) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                ((row[0], bank, *row[1:]) for row in rows),
+            )
+            new = self.conn.total_changes - before
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO sources (hash, fingerprint) VALUES (?, ?)",
+                ((file_hash, row[0]) for row in rows),
+            )
+        return new
+
+    def record_file(self, csv_path, bank, file_hash, stat):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (path, bank, hash, mtime_ns, size) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (str(csv_path), bank, file_hash, stat.st_mtime_ns, stat.st_size),
+            )
+
+    def sync(self, jobs=1):
+        """
+        Brings the store up to date with the exports in csv_dir, parsing new
+        and changed exports with jobs worker processes.
+
+        Returns the number of new transactions.
+        """
+        files = {row["path"]: row for row in self.conn.execute("SELECT * FROM files")}
+        current = set()
+        tasks = []
+        hashes = {}
+        # copies of the exports parsed in this run, by hash
+        copies = defaultdict(list)
+        for bank in sorted(self.csv_dir.iterdir()):
+            if not bank.is_dir():
+                continue
+            for csv_path in sorted(bank.glob("*.csv")):
+                current.add(str(csv_path))
+                stat = csv_path.stat()
+                known = files.get(str(csv_path))
+                if known and (known["mtime_ns"], known["size"]) == (
+                    stat.st_mtime_ns,
+                    stat.st_size,
+                ):
+                    continue
+                file_hash = get_file_hash(csv_path)
+                if self.is_ingested(file_hash):
+                    # a copy of an export parsed already
+                    self.record_file(csv_path, bank.name, file_hash, stat)
+                    continue
+                if file_hash in hashes.values():
+                    # recorded once the original is entered, see below
+                    copies[file_hash].append((csv_path, bank.name, stat))
+                    continue
+                try:
+                    csv_format = detect_csv_format(csv_path, bank.name)
+                except UnknownCSVFormatError as e:
+                    print(e)
+                    continue
+                hashes[str(csv_path)] = file_hash
+                tasks.append((csv_path, csv_format))
+
+        new = 0
+        for (csv_path, csv_format), rows, error in run_jobs(parse_export, tasks, jobs):
+            if error:
+                print(f"Error parsing {csv_path}: {error}")
+                continue
+            file_hash = hashes[str(csv_path)]
+            bank = csv_path.parent.name
+            new += self.enter(bank, file_hash, rows)
+            self.record_file(csv_path, bank, file_hash, csv_path.stat())
+            for copy in copies[file_hash]:
+                self.record_file(copy[0], copy[1], file_hash, copy[2])
+
+        with self.conn:
+            for removed in set(files) - current:
+                self.conn.execute("DELETE FROM files WHERE path = ?", (removed,))
+            # transactions which are only found in exports which are gone
+            # (or changed)
+            self.conn.execute(
+                "DELETE FROM sources WHERE hash NOT IN (SELECT hash FROM files)"
+            )
+            self.conn.execute(
+                "DELETE FROM transactions WHERE fingerprint NOT IN "
+                "(SELECT fingerprint FROM sources)"
+            )
+        return new
+
+    def rebuild(self, jobs=1):
+        """
+        Parses all exports again.
+
+        Returns the number of transactions in the store.
+        """
+        with self.conn:
+            for table in ["files", "sources", "transactions"]:
+                self.conn.execute(f"DELETE FROM {table}")
+        return self.sync(jobs)
+
+    def get_transactions(self, start=None, end=None, banks=None):
+        """
+        Generator which yields the transactions from start to end (dates,
+        both included, open if not given) of all banks or just the given ones,
+        ordered by date and bank, in the order they were entered.
+        """
+        query = "SELECT * FROM transactions WHERE 1"
+        parameters = []
+        if start:
+            query += " AND date >= ?"
+            parameters.append(start.isoformat())
+        if end:
+            query += " AND date <= ?"
+            parameters.append(end.isoformat())
+        if banks:
+            query += f" AND bank IN ({', '.join('?' * len(banks))})"
+            parameters.extend(banks)
+        query += " ORDER BY date, bank, rowid"
+        for row in self.conn.execute(query, parameters):
+            yield {
+                "type": row["type"],
+                "subject": row["subject"],
+                "iban": row["iban"],
+                "bic": row["bic"],
+                "date": datetime.datetime.fromisoformat(row["date"]),
+                "sender": row["sender"],
+                "amount": from_cents(row["amount"]),
+            }
+
+
+def get_month_range(year, month):
+    """
+    Returns the first and the last day of the month.
+    """
+    start = datetime.date(year, month, 1)
+    end = datetime.date(year + month // 12, month % 12 + 1, 1)
+    return start, end - datetime.timedelta(days=1)
+
+
+def read_transactions(settings, start=None, end=None, banks=None):
+    """
+    Generator which yields the transactions of all banks (or just the given
+    ones) from start to end (dates, both included), from the TransactionStore.
+    New and changed CSV files are only read by TransactionStore.sync
+    (ingest-csv).
+    """
+    with TransactionStore(settings) as store:
+        yield from store.get_transactions(start, end, banks)
+
+
+def read_csv_files(settings, year, month):
+    """
+    Generator which yields the transactions of all banks booked in a specific
+    year/month combo, see read_transactions. The transactions are selected by
+    their booking date, not by the CSV file they were read from.
+    """
+    yield from read_transactions(settings, *get_month_range(year, month))